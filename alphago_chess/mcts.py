@@ -1,6 +1,5 @@
 import numpy as np
 import torch
-import copy
 from typing import Dict, Optional, Tuple
 
 
@@ -87,7 +86,7 @@ class MCTS:
         # Run simulations
         for _ in range(self.num_simulations):
             # Make a copy for simulation
-            game_copy = copy.deepcopy(game)
+            game_copy = game.copy()
             
             # Run one simulation
             self._simulate(game_copy, root)
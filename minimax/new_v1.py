@@ -165,7 +165,7 @@ class QuantumChessAI:
 
             # Apply move
             try:
-                game_copy = copy.deepcopy(game)
+                game_copy = game.copy()
                 game_copy.run_short_cmd(move, tag_print=False)
 
                 # Quantum moves introduce probability branching
@@ -249,7 +249,7 @@ class QuantumChessAI:
 
             # Apply move
             try:
-                game_copy = copy.deepcopy(game)
+                game_copy = game.copy()
                 game_copy.run_short_cmd(move, tag_print=False)
 
                 # Quantum moves introduce probability branching
@@ -536,16 +536,10 @@ class QuantumChessAI:
         return '+' in move or '->' in move or 'merge' in move or 'split' in move
 
     def _get_state_hash(self, game):
-        """Generate a simple hash for the transposition table."""
+        """Generate a hash for the transposition table."""
         try:
-            # Create a board representation
-            board_str = ''.join([p if p else '.' for p in game.sim.pos2tag[:64]])
-
-            # Include turn information
-            turn = 'w' if game.is_white else 'b'
-
-            # Return a hash
-            return hash(f"{board_str}_{turn}")
+            # Covers pieces, amplitudes, castling rights, en passant and turn
+            return game.get_hash()
         except:
             # Fallback to a simple unique identifier
             return hash(f"{game.current_step}_{game.is_white}")
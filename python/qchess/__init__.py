@@ -1,4 +1,7 @@
 from .chess_utils import QChessGame, QChessSparseSimulator, ChessPosition, run_QChessGame
+from .sparse_int import QChessSparseSimulatorInt
+from .sparse_numpy import QChessSparseSimulatorNumpy
+from .sparse_factor import QChessSparseSimulatorFactor
 
 def _has_pygame():
     try:
@@ -13,6 +16,12 @@ if _has_pygame():
     from . import gui
 from . import utils
 from . import chess_utils
+from . import sparse_int
+from . import sparse_numpy
+from . import sparse_factor
+from . import sparse_batch
+from . import movegen
+from . import perft
 from . import gym
 
 def _run_gui():
@@ -36,6 +45,9 @@ def _run_gui():
 
 
 def _run_terminal():
+    import sys
+    if (len(sys.argv)>1) and (sys.argv[1]=='perft'):
+        sys.exit(perft._run_perft(sys.argv[2:]))
     z0 = QChessGame()
     import argparse
     parser = argparse.ArgumentParser()
@@ -1,6 +1,7 @@
 import numpy as np
 import random
 from .utils import get_rng
+from .movegen import sample_available_move_bitboard
 
 piece_value = {
     'PAWN': 100,
@@ -514,16 +515,16 @@ def is_capture_move(board, move):
 def get_greedy_move_v0(game, split_weight = 1.0, noise = 0.5, last_moves=[]):
     to_importance = {'P':1.0, 'R':5.0, 'N':3.0, 'B':3.0, 'Q':9.0, 'K':20.0}
 
-    moves_temp = game.get_all_available_move()
+    moves_temp = game.get_all_available_move(as_move=True) #ChessMove, no string parsing below
     moves = []
     moves_queen_promotion = []
 
     for move in moves_temp:
-        if move in last_moves and len(last_moves) == 2 and last_moves[0] == last_moves[1]:
+        if str(move) in last_moves and len(last_moves) == 2 and last_moves[0] == last_moves[1]:
             continue
-        elif move[-1] in 'RBNrbn':
+        elif move.promotion in ('r','b','n'):
             continue
-        elif move[-1] in 'Qq':
+        elif move.promotion == 'q':
             moves_queen_promotion.append(move)
         else:
             moves.append(move)
@@ -532,15 +533,14 @@ def get_greedy_move_v0(game, split_weight = 1.0, noise = 0.5, last_moves=[]):
         moves = moves_queen_promotion
     size = len(moves)
 
-    ws0 = np.array([(split_weight if (len(x.split(',',1)[1])==4) else 1.0) for x in moves])
+    ws0 = np.array([(split_weight if (x.dst1 is not None) else 1.0) for x in moves])
 
     # capture first
     ws1 = np.zeros_like(ws0)
     for idx, move in enumerate(moves):
-        src_, tag_ = move.split(',')
-        if len(src_) == 2 and len(tag_) == 2:
-            src = game[src_]
-            tag = game[tag_]
+        if (move.src1 is None) and (move.dst1 is None) and (move.promotion is None):
+            src = game[move.src]
+            tag = game[move.dst]
             # capture case
             if src and tag and (src[0].isupper() != tag[0].isupper()):
                 importance = to_importance[tag[0].upper()]
@@ -551,7 +551,7 @@ def get_greedy_move_v0(game, split_weight = 1.0, noise = 0.5, last_moves=[]):
     ws = ws0 * (ws1 + ws2 + 0.5)
     moves_ws = list(zip(moves, ws))
     moves_ws.sort(key = lambda t: t[1], reverse=True)
-    picked_move = moves_ws[0][0]
+    picked_move = str(moves_ws[0][0])
     return picked_move
 
 def softmax(x, temperature=1.0):
@@ -560,23 +560,22 @@ def softmax(x, temperature=1.0):
     return e_x / e_x.sum(axis=0)
 
 def get_greedy_move_v1(game, low_prob=1e-4, last_moves=[]):
-    moves_temp = game.get_all_available_move()
+    moves_temp = game.get_all_available_move(as_move=True) #ChessMove, no string parsing below
     moves = []
     moves_low_src_prob = []
 
     for move in moves_temp:
-        src_, tag_ = move.split(',')
-        if (game[tag_[:2]] and game[tag_[:2]][0].isupper() != game[src_[:2]][0].isupper()):
-            src_prob = game[src_[:2]][1] if len(src_) == 2 else game[src_[:2]][1] + game[src_[2:]][1]
+        if (game[move.dst] and game[move.dst][0].isupper() != game[move.src][0].isupper()):
+            src_prob = game[move.src][1] if move.src1 is None else game[move.src][1] + game[move.src1][1]
             if src_prob < low_prob:
                 moves_low_src_prob.append(move)
 
     for move in moves_temp:
         if move in moves_low_src_prob:
             continue
-        elif move in last_moves and len(last_moves) == 2 and last_moves[0] == last_moves[1]:
+        elif str(move) in last_moves and len(last_moves) == 2 and last_moves[0] == last_moves[1]:
             continue
-        elif move[-1] in 'RBNrbn':
+        elif move.promotion in ('r','b','n'):
             continue
         else:
             moves.append(move)
@@ -590,21 +589,20 @@ def get_greedy_move_v1(game, low_prob=1e-4, last_moves=[]):
     is_white = float(game.is_white)
     board = game.sim.get_print_board()
     check_end = check_end_game(board)
-    ws = np.array([(move_value(board, move, check_end)) for move in moves])
+    ws = np.array([(move_value(board, str(move), check_end)) for move in moves])
     ws = (ws)  * (is_white * 2 - 1)
     moves_ws = list(zip(moves, ws))
     moves_ws.sort(key = lambda t: t[1], reverse=True)
-    picked_move = moves_ws[0][0]
+    picked_move = str(moves_ws[0][0])
     return picked_move
 
 def get_greedy_move_v2(game, low_prob=1e-4, last_moves=[]):
-    moves_temp = game.get_all_available_move()
+    moves_temp = game.get_all_available_move(as_move=True) #ChessMove, no string parsing below
     moves = []
     moves_low_src_prob = []
 
     for move in moves_temp:
-        src_, tag_ = move.split(',')
-        src_prob = game[src_[:2]][1] if len(src_) == 2 else game[src_[:2]][1] + game[src_[2:]][1]
+        src_prob = game[move.src][1] if move.src1 is None else game[move.src][1] + game[move.src1][1]
         if src_prob < low_prob:
             moves_low_src_prob.append(move)
         else:
@@ -615,17 +613,17 @@ def get_greedy_move_v2(game, low_prob=1e-4, last_moves=[]):
 
     board = game.sim.get_print_board()
     check_end = check_end_game(board)
-    ws = np.array([(move_value_v2(board, move, check_end)) for move in moves])
+    ws = np.array([(move_value_v2(board, str(move), check_end)) for move in moves])
     moves_ws = list(zip(moves, ws))
     moves_ws.sort(key = lambda t: t[1], reverse=True)
-    picked_move = moves_ws[0][0]
+    picked_move = str(moves_ws[0][0])
     return picked_move
 
 
 def get_random_move(game, seed=None, all_move=None, split_probability_weight=1.0):
     #rng = game.rng if (seed is None) else get_rng(seed)
     if all_move is None:
-        all_move = game.get_all_available_move()
+        return sample_available_move_bitboard(game, random.random(), split_probability_weight)
     assert len(all_move) > 0, 'something must be wrong, no move available'
     prob = np.array([(split_probability_weight if (len(x.split(',',1)[1])==4) else 1) for x in all_move])
     picked_move = random.choices(all_move, prob/prob.sum())[0]
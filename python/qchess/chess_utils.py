@@ -1,14 +1,193 @@
 import time
+import cmath
+import random
+import collections
 import numpy as np
 
 from .utils import (bitarray_to_int, hf_int_to_bitstr, get_rng, hf_swap_str_char, hf_invert_str01, hf_drop_str_char,
-            QChessInvalidCommand, hf_convert_pos_to_int, ChessPosition, hf_str_none_to_position)
+            QChessInvalidCommand, hf_convert_pos_to_int, ChessPosition, ChessMove, hf_str_none_to_position, ROOK_RAY, BISHOP_RAY, BETWEEN_LIST)
 
 _ZERO_EPS = 1e-12
 _DISCLAIMER = ''
 _GLOBAL_CONFIG = {'print_disclaimer':False}
 
+_MASK64 = (1<<64) - 1
+_ZOBRIST_TABLE = dict()
+_ZOBRIST_SCALE = 2**24 #amplitude is rounded to this resolution before hashing
+
+def hf_zobrist_key(*args):
+    # deterministic 64-bit random number, stable across processes (unlike hash(str))
+    ret = _ZOBRIST_TABLE.get(args)
+    if ret is None:
+        ret = random.Random(repr(args)).getrandbits(64)
+        _ZOBRIST_TABLE[args] = ret
+    return ret
+
+# amplitude hash: state accumulator C_j = sum_k value_k * exp(2j*pi*angle_j(k)/2**64) for each probe j
+# angle_j(k): sum (mod 2**64) of the random angle of the qubits which are 1 in key k
+# C(state1 x state2) = C(state1)*C(state2) for disjoint qubits, so a tensor product hashes as the joint state
+_ZOBRIST_NUM_PROBE = 2
+_ZOBRIST_ANGLE = [[hf_zobrist_key('angle', x, y) for y in range(256)] for x in range(_ZOBRIST_NUM_PROBE)] #qubit, including ancilla
+# the angles of all the probes in one int, 128 bits per probe so that the sum of 256 angles never overflows into the next one
+_ZOBRIST_BIT = [sum(x[y]<<(128*i) for i,x in enumerate(_ZOBRIST_ANGLE)) for y in range(256)]
+_ZOBRIST_MUL = hf_zobrist_key('mul') | 1
+
+def hf_zobrist_amplitude(key_hash:int, value:complex):
+    # contribution of one (basis, amplitude) pair to the state accumulator, key_hash: sum of _ZOBRIST_BIT
+    ret = tuple(value*cmath.exp(2j*cmath.pi*(((key_hash>>(128*x)) & _MASK64)/2**64)) for x in range(_ZOBRIST_NUM_PROBE))
+    return ret
+
+def hf_zobrist_digest(accumulator):
+    # 64-bit hash of the state accumulator, rounded to _ZOBRIST_SCALE
+    ret = 0
+    for x in accumulator:
+        for y in (x.real, x.imag):
+            tmp0 = (ret + round(y*_ZOBRIST_SCALE)*_ZOBRIST_MUL) & _MASK64
+            tmp0 = ((tmp0 ^ (tmp0>>31)) * 0xBF58476D1CE4E5B9) & _MASK64
+            ret = tmp0 ^ (tmp0>>29)
+    return ret
+
+def hf_fused_slide_table(gate_list):
+    # composite unitary of a gate sequence on 3 local qubits (bit 0,1,2), controlled by (path1 occupied, path2 occupied)
+    # gate_list: [(kind, x, y, hf_condition(p1,p2), tag_inverse)], kind: 'iswap' or 'sqrtiswap'
+    # table[2*p1+p2][state] = ((state_new, factor), ...), two outputs if a sqrtiswap acts, else one
+    s12 = 1/np.sqrt(2)
+    ret = []
+    for cond in range(4):
+        p1,p2 = cond>>1, cond&1
+        tmp0 = []
+        for state in range(8):
+            amp = {state:1}
+            for kind,x,y,hf0,tag_inverse in gate_list:
+                if not hf0(p1, p2):
+                    continue
+                phase = -1j if tag_inverse else 1j
+                tmp1 = dict()
+                for k,v in amp.items():
+                    if ((k>>x)^(k>>y)) & 1:
+                        k2 = k ^ ((1<<x) | (1<<y))
+                        if kind=='iswap':
+                            tmp1[k2] = tmp1.get(k2, 0) + v*phase
+                        else:
+                            tmp1[k] = tmp1.get(k, 0) + v*s12
+                            tmp1[k2] = tmp1.get(k2, 0) + v*phase*s12
+                    else:
+                        tmp1[k] = tmp1.get(k, 0) + v
+                amp = tmp1
+            tmp0.append(tuple(amp.items()))
+        ret.append(tuple(tmp0))
+    return tuple(ret)
+
+# split_slide(src, dst1, dst2): local qubit (src, dst1, dst2)
+_SPLIT_SLIDE_TABLE = hf_fused_slide_table([
+    ('sqrtiswap', 0, 1, lambda p1,p2: not (p1 or p2), False),
+    ('iswap', 0, 2, lambda p1,p2: not (p1 or p2), False),
+    ('iswap', 0, 1, lambda p1,p2: (not p1) and p2, False),
+    ('iswap', 0, 2, lambda p1,p2: (not p2) and p1, False),
+])
+# merge_slide(src1, src2, dst): local qubit (dst, src1, src2)
+_MERGE_SLIDE_TABLE = hf_fused_slide_table([
+    ('iswap', 0, 2, lambda p1,p2: (not p2) and p1, True),
+    ('iswap', 0, 1, lambda p1,p2: (not p1) and p2, True),
+    ('iswap', 0, 2, lambda p1,p2: not (p1 or p2), True),
+    ('sqrtiswap', 0, 1, lambda p1,p2: not (p1 or p2), True),
+])
+
+class QChessSquareIndex:
+    # square -> set of basis id, id -> basis key
+    # when a gate only swaps the (src,dst) qubits of a key, the id is kept and only the src/dst sets are touched
+    def __init__(self, num_qubit:int, key_one_list):
+        self.key_one_list = key_one_list #key -> index of the qubits in state 1
+        self.square = [set() for _ in range(num_qubit)]
+        self.key2id = dict()
+        self.id2key = dict()
+        self.next_id = 0
+
+    def copy(self):
+        ret = QChessSquareIndex(0, self.key_one_list)
+        ret.square = [set(x) for x in self.square]
+        ret.key2id = dict(self.key2id)
+        ret.id2key = dict(self.id2key)
+        ret.next_id = self.next_id
+        return ret
+
+    def add(self, key):
+        id_ = self.next_id
+        self.next_id += 1
+        self.key2id[key] = id_
+        self.id2key[id_] = key
+        for x in self.key_one_list(key):
+            self.square[x].add(id_)
+
+    def discard(self, key):
+        id_ = self.key2id.pop(key)
+        self.id2key.pop(id_)
+        for x in self.key_one_list(key):
+            self.square[x].discard(id_)
+
+    def rename(self, key0, key1, src:int, dst:int):
+        # key1 is key0 with exactly one of (src,dst) occupied and swapped
+        id_ = self.key2id.pop(key0)
+        self.key2id[key1] = id_
+        self.id2key[id_] = key1
+        if id_ in self.square[src]:
+            self.square[src].remove(id_)
+            self.square[dst].add(id_)
+        else:
+            self.square[dst].remove(id_)
+            self.square[src].add(id_)
+
+    def relabel(self, key_out, index_list, key_exist):
+        # key_out: [(key0, [(key1,state1), ...])], key1 differs from key0 only on index_list (bit i of state1 is index_list[i])
+        # the id of key0 goes to its first output in key_exist, the other outputs in key_exist are added
+        id_list = [self.key2id.pop(x) for x,_ in key_out]
+        for (key0,tmp0),id_ in zip(key_out, id_list):
+            key1,state1 = next(((x,y) for x,y in tmp0 if (x in key_exist) and (x not in self.key2id)), (None,None))
+            if key1 is None:
+                self.id2key.pop(id_)
+                for x in self.key_one_list(key0):
+                    self.square[x].discard(id_)
+                continue
+            self.key2id[key1] = id_
+            self.id2key[id_] = key1
+            for i,x in enumerate(index_list):
+                if (state1>>i)&1:
+                    self.square[x].add(id_)
+                else:
+                    self.square[x].discard(id_)
+        for _,tmp0 in key_out:
+            for key1,_ in tmp0:
+                if (key1 in key_exist) and (key1 not in self.key2id):
+                    self.add(key1)
+
+    def rename_all(self, key_drop, hf_key, index_list):
+        # key_drop are removed, the other keys are renamed by hf_key, which only sets the qubits in index_list to 0
+        for x in key_drop:
+            self.discard(x)
+        self.key2id = {hf_key(k):v for k,v in self.key2id.items()}
+        self.id2key = {v:k for k,v in self.key2id.items()}
+        for x in index_list:
+            self.square[x] = set()
+
+    def get_key(self, index_list):
+        # keys with any qubit in index_list being 1
+        tmp0 = set().union(*(self.square[x] for x in index_list))
+        ret = {self.id2key[x] for x in tmp0}
+        return ret
+
+
+class _QChessPeek(Exception):
+    # raised by the first measurement in peek mode before the state is changed, see QChessGame.peek_move()
+    def __init__(self, prob1:float):
+        super().__init__(prob1)
+        self.prob1 = prob1
+
+
 class QChessSparseSimulator:
+    _journal_by_snapshot = False #push_journal() keeps a copy-on-write snapshot instead of the change log
+    _hash_incremental = True #the gates update the amplitude hash, see get_hash()
+    _peek = False #measurement raises _QChessPeek with its probability, see QChessGame.peek_move()
+
     def __init__(self, state0:int=0xFFFF00000000FFFF, tag_list='RNBQKBNRPPPPPPPPpppppppprnbqkbnr', seed=None):
         assert (0<=state0) and (state0<2**64)
         basis0 = hf_int_to_bitstr(state0, 64)
@@ -28,7 +207,17 @@ class QChessSparseSimulator:
         self.tag_to_print_tag = tag_to_print_tag
         self.last_measure = None
         self.last_measure1_prob = None
-        self._cache_probability = dict()
+        # marginal probability of each qubit, updated incrementally by every gate
+        self._probability = [float(x is not None) for x in self.pos2tag]
+        self.check_probability = False #if True, compare with the full scan after every update (for test)
+        self._square_index = None #optional QChessSquareIndex, see enable_square_index()
+        self.truncate_threshold = None
+        self.truncate_max_branch = None
+        self.last_truncation_loss = 0
+        self._coeff_shared = False #copy-on-write, see copy()
+        self._journal = None #undo log, see push_journal()
+        self._journal_snapshot = []
+        self._hash_amplitude = None #state accumulator of hf_zobrist_amplitude(), None if not computed yet
 
     def _clone_from_sim(self, sim1):
         self.pos2tag = list(sim1.pos2tag)
@@ -36,10 +225,145 @@ class QChessSparseSimulator:
         self.coeff = dict(sim1.coeff)
         self.last_measure = sim1.last_measure
         self.last_measure1_prob = sim1.last_measure1_prob
-        self._cache_probability = dict(sim1._cache_probability)
+        self._probability = list(sim1._probability)
+        self._square_index = None if (sim1._square_index is None) else sim1._square_index.copy()
+        self.truncate_threshold = sim1.truncate_threshold
+        self.truncate_max_branch = sim1.truncate_max_branch
+        self.last_truncation_loss = sim1.last_truncation_loss
+        self._coeff_shared = False
+        self._journal = None
+        self._journal_snapshot = []
+        self._hash_amplitude = None
 
-    @staticmethod
-    def from_board(pos_list):
+    def copy(self):
+        # copy-on-write, coeff (and square index) is shared until one of the two simulators changes it
+        ret = type(self).__new__(type(self))
+        ret.__dict__.update(self.__dict__)
+        ret.pos2tag = list(self.pos2tag)
+        ret._probability = list(self._probability)
+        ret.tag_to_print_tag = dict(self.tag_to_print_tag)
+        ret.rng = random.Random()
+        ret.rng.setstate(self.rng.getstate())
+        ret._journal = None
+        ret._journal_snapshot = []
+        self._coeff_shared = True
+        ret._coeff_shared = True
+        return ret
+
+    def get_num_amplitude(self):
+        return len(self.coeff)
+
+    def _own_coeff(self):
+        # called before changing coeff in place
+        if self._coeff_shared:
+            self.coeff = dict(self.coeff)
+            if self._square_index is not None:
+                self._square_index = self._square_index.copy()
+            self._coeff_shared = False
+
+    def push_journal(self):
+        # start recording the changes, pop_journal() undo them in time proportional to what was touched
+        # the random number generator is not rewound
+        if self._journal_by_snapshot:
+            self._journal_snapshot.append(self.copy())
+            return
+        if self._journal is None:
+            self._journal = []
+        tmp0 = (list(self.pos2tag), list(self._probability), self.last_measure, self.last_measure1_prob,
+                self.last_truncation_loss, self._hash_amplitude)
+        self._journal.append([tmp0])
+
+    def pop_journal(self):
+        if self._journal_by_snapshot:
+            stack = self._journal_snapshot
+            rng = self.rng
+            self.__dict__.update(stack.pop().__dict__)
+            self.rng = rng
+            self._journal_snapshot = stack
+            return
+        frame = self._journal.pop()
+        if len(self._journal)==0:
+            self._journal = None
+        tag_rebuild = False #the number of qubits changed, rebuild the square index at the end
+        for x in frame[:0:-1]:
+            if x[0]=='coeff_delta':
+                _,coeff_old,key_new,src,dst = x
+                self._own_coeff()
+                for k in key_new:
+                    self.coeff.pop(k, None)
+                self.coeff.update(coeff_old)
+                if not tag_rebuild:
+                    self._update_square_index(key_new, coeff_old.keys(), src, dst)
+            else: #coeff
+                _,self.coeff,self._coeff_shared,key_readd = x
+                if key_readd is None:
+                    tag_rebuild = True
+                elif not tag_rebuild:
+                    self._update_square_index([], key_readd)
+        (self.pos2tag, self._probability, self.last_measure, self.last_measure1_prob,
+                self.last_truncation_loss, self._hash_amplitude) = frame[0]
+        if tag_rebuild:
+            self._rebuild_square_index()
+
+    def _on_coeff_delta(self, coeff_old:dict, key_new, src:int, dst:int):
+        # called after a gate, coeff_old: the value before the change, key_new: other keys changed
+        if self._journal is not None:
+            self._journal[-1].append(('coeff_delta', coeff_old, key_new, src, dst))
+        if self._hash_amplitude is not None:
+            tmp0 = list(self._hash_amplitude)
+            for k,v in coeff_old.items():
+                for x,y in enumerate(hf_zobrist_amplitude(self._key_hash(k), v)):
+                    tmp0[x] -= y
+            for k in set(key_new).union(coeff_old.keys()):
+                v = self.coeff.get(k)
+                if v is not None:
+                    for x,y in enumerate(hf_zobrist_amplitude(self._key_hash(k), v)):
+                        tmp0[x] += y
+            self._hash_amplitude = tuple(tmp0)
+
+    def _on_coeff_replace(self, key_readd=None):
+        # called before self.coeff is replaced by a new dict
+        # key_readd: keys to add back to the square index when undo, None to rebuild it
+        if self._journal is not None:
+            self._journal[-1].append(('coeff', self.coeff, self._coeff_shared, key_readd))
+        self._hash_amplitude = None
+
+    def _key_hash(self, key):
+        ret = 0
+        for x in self._key_one_list(key):
+            ret += _ZOBRIST_BIT[x]
+        return ret
+
+    def _compute_hash_accumulator(self):
+        # see hf_zobrist_amplitude()
+        ret = [0]*_ZOBRIST_NUM_PROBE
+        for k,v in self.coeff.items():
+            for x,y in enumerate(hf_zobrist_amplitude(self._key_hash(k), v)):
+                ret[x] += y
+        return tuple(ret)
+
+    def _compute_hash_amplitude(self):
+        return hf_zobrist_digest(self._compute_hash_accumulator())
+
+    def get_hash_amplitude(self):
+        # canonical digest of the amplitude distribution, independent of the backend, of the key order and of the factorization
+        if not self._hash_incremental:
+            return self._compute_hash_amplitude()
+        if self._hash_amplitude is None:
+            self._hash_amplitude = self._compute_hash_accumulator()
+        return hf_zobrist_digest(self._hash_amplitude)
+
+    def get_hash(self):
+        # 64-bit Zobrist-style hash of the piece tags and the amplitude distribution
+        # amplitude part is updated incrementally by the gates after the first call, other changes recompute it lazily
+        ret = self.get_hash_amplitude()
+        for x,y in enumerate(self.pos2tag[:64]):
+            if y is not None:
+                ret ^= hf_zobrist_key('tag', x, y)
+        return ret
+
+    @classmethod
+    def from_board(cls, pos_list):
         # [(a1,K), (b1,Q), (c3,k), ...)]
         if isinstance(pos_list, str):
             pos_list = pos_list.split(' ')
@@ -54,19 +378,156 @@ class QChessSparseSimulator:
         for x,_ in pos_list:
             tmp0[hf_convert_pos_to_int(x)] = 1
         state0 = bitarray_to_int(tmp0)
-        ret = QChessSparseSimulator(state0, tag_list)
+        ret = cls(state0, tag_list)
         return ret
 
-    def _get_probability_i(self, index:int):
-        if index in self._cache_probability:
-            ret = self._cache_probability[index]
+    def _key_to_str(self, key)->str:
+        return key
+
+    def _select_key(self, index:int, value:int):
+        if self._square_index is not None:
+            return self._select_key_index(index, value)
+        tmp0 = str(value)
+        ret = [x for x in self.coeff.keys() if x[index]==tmp0]
+        return ret
+
+    @staticmethod
+    def _key_mask(key):
+        # bit i is qubit i
+        return int(key[::-1], 2)
+
+    @staticmethod
+    def _key_ancilla_mask(key):
+        # bit i is the ancilla qubit 64+i
+        return int(key[:63:-1] or '0', 2)
+
+    @staticmethod
+    def _hf_release_key(index_list, num_qubit:int):
+        # key -> key with the qubits in index_list set to 0 and the qubits from num_qubit on removed
+        def hf0(key):
+            for x in index_list:
+                key = key[:x] + '0' + key[(x+1):]
+            return key[:num_qubit]
+        return hf0
+
+    def _hf_key_bit(self, index:int):
+        return lambda k: k[index]=='1'
+
+    @staticmethod
+    def _key_one_list(key):
+        # index of the qubits in state 1
+        ret = []
+        ind0 = key.find('1')
+        while ind0>=0:
+            ret.append(ind0)
+            ind0 = key.find('1', ind0+1)
+        return ret
+
+    def enable_square_index(self, enable:bool=True):
+        # gates and measurements only visit the keys with src/dst occupied, see QChessSquareIndex
+        if enable:
+            self._square_index = QChessSquareIndex(len(self.pos2tag), self._key_one_list)
+            for k in self.coeff.keys():
+                self._square_index.add(k)
         else:
-            assert (0<=index) and (index<len(self.pos2tag))
-            if self.pos2tag[index] is None:
-                ret = 0
+            self._square_index = None
+
+    def _rebuild_square_index(self):
+        if self._square_index is not None:
+            self.enable_square_index(True)
+
+    def _update_square_index(self, key_old, key_new, src:int|None=None, dst:int|None=None):
+        # key_old: keys might be removed from self.coeff, key_new: keys might be added
+        # a removed key whose (src,dst) swapped partner is added keeps its id
+        if self._square_index is None:
+            return
+        key2id = self._square_index.key2id
+        key_old = [k for k in key_old if k not in self.coeff]
+        key_new = {k for k in key_new if (k in self.coeff) and (k not in key2id)}
+        for k in key_old:
+            k2 = self._swap_key(k, src, dst) if (src is not None) else None
+            if k2 in key_new:
+                self._square_index.rename(k, k2, src, dst)
+                key_new.remove(k2)
             else:
-                ret = sum(v.real*v.real+v.imag*v.imag for k,v in self.coeff.items() if k[index]=='1')
-            self._cache_probability[index] = ret
+                self._square_index.discard(k)
+        for k in key_new:
+            self._square_index.add(k)
+
+    def _swap_key(self, key, src:int, dst:int):
+        return hf_swap_str_char(key, src, dst)
+
+    def _flip_key(self, key, index:int):
+        return hf_invert_str01(key, index)
+
+    def _hf_fused_key(self, index_list, path1, path2):
+        # (key -> local state, key -> 2*p1+p2, (key, local state) -> key), see _apply_fused_slide()
+        def hf_set(key, state):
+            tmp0 = list(key)
+            for i,x in enumerate(index_list):
+                tmp0[x] = '1' if ((state>>i)&1) else '0'
+            return ''.join(tmp0)
+        hf_state = lambda k: sum((k[x]=='1')<<i for i,x in enumerate(index_list))
+        hf_cond = lambda k: 2*any(k[x]=='1' for x in path1) + any(k[x]=='1' for x in path2)
+        return hf_state, hf_cond, hf_set
+
+    def _get_key_with_one(self, index_list):
+        # keys with any qubit in index_list being 1
+        if self._square_index is None:
+            ret = {k for k in self.coeff.keys() if any(k[x]=='1' for x in index_list)}
+        else:
+            ret = self._square_index.get_key(index_list)
+        return ret
+
+    def _select_key_index(self, index:int, value:int):
+        tmp0 = self._square_index.get_key([index])
+        ret = list(tmp0) if value else [x for x in self.coeff.keys() if x not in tmp0]
+        return ret
+
+    def _compute_probability_i(self, index:int):
+        # full scan, only used to rebuild or check self._probability
+        ret = sum(v.real*v.real+v.imag*v.imag for k,v in self.coeff.items() if k[index]=='1')
+        return ret
+
+    def _accumulate_probability(self, coeff_iter):
+        # [(key,value), ...] -> sum of |value|^2 on each qubit
+        ret = [0]*len(self.pos2tag)
+        for k,v in coeff_iter:
+            tmp0 = v.real*v.real + v.imag*v.imag
+            ind0 = k.find('1')
+            while ind0>=0:
+                ret[ind0] += tmp0
+                ind0 = k.find('1', ind0+1)
+        return ret
+
+    def _check_probability(self):
+        for x in range(len(self.pos2tag)):
+            tmp0 = self._compute_probability_i(x) if (self.pos2tag[x] is not None) else 0
+            assert abs(self._probability[x] - tmp0) < 1e-10, f'probability mismatch index={x}, {self._probability[x]} vs {tmp0}'
+
+    def _update_probability_after_drop(self, coeff_drop, norm_factor):
+        # coeff_drop: [(key,value), ...] removed, norm_factor: 1/sqrt(remaining probability)
+        if len(coeff_drop)*2 < len(self.coeff):
+            tmp0 = self._accumulate_probability(coeff_drop)
+            tmp1 = norm_factor*norm_factor
+            self._probability = [(x-y)*tmp1 for x,y in zip(self._probability, tmp0)]
+        else:
+            self._probability = self._accumulate_probability(self.coeff.items())
+        if self.check_probability:
+            self._check_probability()
+
+    def _update_probability_src_dst(self, src, dst, delta_src, delta_dst):
+        self._probability[src] += delta_src
+        self._probability[dst] += delta_dst
+        if self.check_probability:
+            self._check_probability()
+
+    def _get_probability_i(self, index:int):
+        assert (0<=index) and (index<len(self.pos2tag))
+        if self.pos2tag[index] is None:
+            ret = 0
+        else:
+            ret = min(max(self._probability[index], 0), 1)
         return ret
 
     def get_marginal_probability(self, index=None):
@@ -97,13 +558,16 @@ class QChessSparseSimulator:
         x2 = self.pos2tag[dst]
         assert ((x0 is None) and (x2 is not None)) or ((x0 is not None) and (x2 is None)) or ((x0==x2) and (x0 is not None))
         tag = x0 if (x0 is not None) else x2
-        index_list = {k for k in self.coeff.keys() if (k[src]+k[dst] in ('10','01','11'))}
-        self._cache_probability.clear()
+        self._own_coeff()
+        index_list = self._get_key_with_one([src,dst])
         coeff_old = dict()
         for x in index_list:
             coeff_old[x] = self.coeff.pop(x)
         src_index_list = set()
         dst_index_list = set()
+        touch_index_list = set()
+        prob_src_old = 0
+        prob_dst_old = 0
         for k0,v0 in coeff_old.items():
             k1 = k0[src]+k0[dst]
             if ((k1=='11') or ((control is not None) and any(k0[x]!='0' for x in control))
@@ -116,6 +580,12 @@ class QChessSparseSimulator:
                     dst_index_list.add(k0)
                 continue
             # k1 in ['01','10']
+            if k1[0]=='1':
+                prob_src_old += v0.real*v0.real + v0.imag*v0.imag
+            else:
+                prob_dst_old += v0.real*v0.real + v0.imag*v0.imag
+            touch_index_list.add(k0)
+            touch_index_list.add(hf_swap_str_char(k0, src, dst))
             if k0 in self.coeff:
                 tmp0 = self.coeff[k0] + v0/np.sqrt(2)
                 if tmp0.real**2 + tmp0.imag**2 < _ZERO_EPS:
@@ -148,8 +618,19 @@ class QChessSparseSimulator:
                 else:
                     src_index_list.add(k2)
                 self.coeff[k2] = (-v0*1j/np.sqrt(2)) if tag_inverse else (v0*1j/np.sqrt(2))
+        prob_src_new = 0
+        prob_dst_new = 0
+        for k0 in touch_index_list:
+            v0 = self.coeff.get(k0, 0)
+            if k0[src]=='1':
+                prob_src_new += v0.real*v0.real + v0.imag*v0.imag
+            else:
+                prob_dst_new += v0.real*v0.real + v0.imag*v0.imag
         self.pos2tag[src] = tag if len(src_index_list) else None
         self.pos2tag[dst] = tag if len(dst_index_list) else None
+        self._update_probability_src_dst(src, dst, prob_src_new-prob_src_old, prob_dst_new-prob_dst_old)
+        self._update_square_index(coeff_old.keys(), touch_index_list, src, dst)
+        self._on_coeff_delta(coeff_old, touch_index_list, src, dst)
 
     def apply_iswap(self, src:int, dst:int, control=None, negate_control=None, tag_inverse=False):
         # when control all zero, apply iswap
@@ -172,13 +653,15 @@ class QChessSparseSimulator:
         x2 = self.pos2tag[dst]
         assert ((x0 is None) and (x2 is not None)) or ((x0 is not None) and (x2 is None)) or ((x0==x2) and (x0 is not None)), f'src={src}, dst={dst}, x0={x0}, x2={x2}'
         tag = x0 if (x0 is not None) else x2
-        index_list = {k for k in self.coeff.keys() if (k[src]+k[dst] in ('10','01','11'))}
-        self._cache_probability.clear()
+        self._own_coeff()
+        index_list = self._get_key_with_one([src,dst])
         coeff_old = dict()
         for x in index_list:
             coeff_old[x] = self.coeff.pop(x)
         src_index_list = []
         dst_index_list = []
+        prob_src_to_dst = 0
+        prob_dst_to_src = 0
         for k0,v0 in coeff_old.items():
             k1 = k0[src]+k0[dst]
             if ((k1=='11') or ((control is not None) and any(k0[x]!='0' for x in control))
@@ -194,32 +677,134 @@ class QChessSparseSimulator:
             k2 = hf_swap_str_char(k0, src, dst)
             if k1[0]=='1':
                 dst_index_list.append(k2)
+                prob_src_to_dst += v0.real*v0.real + v0.imag*v0.imag
             else:
                 src_index_list.append(k2)
+                prob_dst_to_src += v0.real*v0.real + v0.imag*v0.imag
             self.coeff[k2] = (-v0*1j) if tag_inverse else (v0*1j)
         self.pos2tag[src] = tag if len(src_index_list) else None
         self.pos2tag[dst] = tag if len(dst_index_list) else None
+        tmp0 = prob_dst_to_src - prob_src_to_dst
+        self._update_probability_src_dst(src, dst, tmp0, -tmp0)
+        self._update_square_index(coeff_old.keys(), src_index_list+dst_index_list, src, dst)
+        self._on_coeff_delta(coeff_old, src_index_list+dst_index_list, src, dst)
 
     def change_tag(self, index:int, label:str):
         assert (0<=index) and (index<len(self.pos2tag)) and isinstance(label,str)
         assert self.pos2tag[index] is not None
         self.pos2tag[index] = label
-        self._cache_probability.pop(index, None)
 
     def drop_coeff(self, key_list):
-        if isinstance(key_list, str):
+        if isinstance(key_list, (str,int)):
             key_list = [key_list]
         if len(key_list):
-            self._cache_probability.clear()
-            for x0 in key_list:
-                self.coeff.pop(x0)
-            tmp0 = set(self.coeff.keys()) - set(key_list)
-            tmp1 = (self.coeff[x] for x in tmp0)
-            tmp1 = np.sqrt(sum(x.real*x.real+x.imag*x.imag for x in tmp1))
-            assert tmp1 > _ZERO_EPS, 'zero probability'
-            tmp1 = 1/tmp1
-            self.coeff = {k:self.coeff[k]*tmp1 for k in tmp0}
-            self.pos2tag = [(x1 if any(y[x0]=='1' for y in tmp0) else None) for x0,x1 in enumerate(self.pos2tag)]
+            tmp0 = set(key_list)
+            self._drop_coeff_by(lambda k: k in tmp0)
+
+    def _drop_coeff_where(self, index:int, value:int, release_ancilla:bool=False):
+        # drop the keys with the qubit index in value (measurement)
+        hf0 = self._hf_key_bit(index)
+        self._drop_coeff_by(lambda k: hf0(k)==value, release_ancilla)
+
+    def _get_release_ancilla(self, key_or:int, key_and:int):
+        # key_or/key_and: bitwise or/and over the keys of _key_ancilla_mask()
+        # return the ancilla qubits in use with the same value in every key, and the number of qubits without the free ones at the end
+        fixed = ~(key_or ^ key_and)
+        in_use = [x for x in range(64, len(self.pos2tag)) if self.pos2tag[x] is not None]
+        release = [x for x in in_use if (fixed>>(x-64))&1]
+        num_qubit = max((x for x in in_use if not ((fixed>>(x-64))&1)), default=63) + 1
+        return release, num_qubit
+
+    def _drop_coeff_by(self, hf_drop, release_ancilla:bool=False):
+        # partition, norm and occupancy of the kept keys in one pass over coeff, then renormalize in place
+        # release_ancilla: an ancilla left in a definite state goes back to the pool, the keys are renamed in the renormalize pass
+        coeff = dict()
+        coeff_drop = []
+        norm = 0
+        occupied = 0
+        hf_mask = self._key_mask if (self._square_index is None) else None
+        hf_anc = self._key_ancilla_mask if (release_ancilla and (len(self.pos2tag)>64)) else None
+        key_or = 0
+        key_and = -1
+        for k,v in self.coeff.items():
+            if hf_drop(k):
+                coeff_drop.append((k,v))
+            else:
+                coeff[k] = v
+                norm += v.real*v.real + v.imag*v.imag
+                if hf_mask is not None:
+                    occupied |= hf_mask(k)
+                if hf_anc is not None:
+                    tmp0 = hf_anc(k)
+                    key_or |= tmp0
+                    key_and &= tmp0
+        if len(coeff_drop)==0:
+            return
+        tmp1 = np.sqrt(norm)
+        assert tmp1 > _ZERO_EPS, 'zero probability'
+        tmp1 = 1/tmp1
+        release,num_qubit = ([],len(self.pos2tag)) if (hf_anc is None) else self._get_release_ancilla(key_or, key_and)
+        if len(release)==0:
+            for k,v in coeff.items():
+                coeff[k] = v*tmp1
+        else:
+            hf_key = self._hf_release_key([x for x in release if x<num_qubit], num_qubit)
+            coeff = {hf_key(k):(v*tmp1) for k,v in coeff.items()}
+        key_drop = [x for x,_ in coeff_drop]
+        # coeff is replaced, only the square index is changed in place
+        if self._coeff_shared and (self._square_index is not None):
+            self._square_index = self._square_index.copy()
+        self._on_coeff_replace(key_drop if (len(release)==0) else None)
+        self.coeff = coeff
+        self._coeff_shared = False
+        if self._square_index is None:
+            self.pos2tag = [(x1 if ((occupied>>x0)&1) else None) for x0,x1 in enumerate(self.pos2tag)]
+        elif len(release)==0:
+            self._update_square_index(key_drop, [])
+            self.pos2tag = [(x1 if len(self._square_index.square[x0]) else None) for x0,x1 in enumerate(self.pos2tag)]
+        else:
+            self._square_index.rename_all(key_drop, hf_key, release)
+            self.pos2tag = [(x1 if len(self._square_index.square[x0]) else None) for x0,x1 in enumerate(self.pos2tag)]
+            del self._square_index.square[num_qubit:]
+        if len(release)==0:
+            self._update_probability_after_drop(coeff_drop, tmp1)
+        else:
+            for x in release:
+                self.pos2tag[x] = None
+            del self.pos2tag[num_qubit:]
+            self._probability = self._accumulate_probability(self.coeff.items())
+            if self.check_probability:
+                self._check_probability()
+
+    def set_truncation(self, threshold:float|None=None, max_branch:int|None=None):
+        # approximation for bounded memory, see truncate()
+        assert (threshold is None) or (0<=threshold<1)
+        assert (max_branch is None) or (max_branch>=1)
+        self.truncate_threshold = threshold
+        self.truncate_max_branch = max_branch
+
+    def _get_truncate_key(self):
+        # the largest branch is always kept
+        prob_key = sorted(((v.real*v.real+v.imag*v.imag,k) for k,v in self.coeff.items()), key=lambda x: x[0], reverse=True)
+        num_keep = len(prob_key)
+        if self.truncate_max_branch is not None:
+            num_keep = min(num_keep, self.truncate_max_branch)
+        if self.truncate_threshold is not None:
+            while (num_keep>1) and (prob_key[num_keep-1][0]<self.truncate_threshold):
+                num_keep -= 1
+        key_list = [x for _,x in prob_key[num_keep:]]
+        loss = sum(x for x,_ in prob_key[num_keep:])
+        return key_list, loss
+
+    def truncate(self):
+        # drop the branch with probability below truncate_threshold, keep at most truncate_max_branch branches, renormalize
+        # return the dropped probability, which is 1-fidelity between the state before and after
+        ret = 0
+        if (self.truncate_threshold is not None) or (self.truncate_max_branch is not None):
+            key_list,ret = self._get_truncate_key()
+            self.drop_coeff(key_list)
+        self.last_truncation_loss = ret
+        return ret
 
     def measure(self, index, fix=None, seed=None):
         if fix is not None:
@@ -227,6 +812,7 @@ class QChessSparseSimulator:
             assert fix in {0,1}
         index = hf_convert_pos_to_int(index)
         prob = self._get_probability_i(index)
+        self._check_peek(prob)
         if (prob<_ZERO_EPS):
             if fix==1:
                 raise QChessInvalidCommand('zero probability but required fix=1')
@@ -240,14 +826,14 @@ class QChessSparseSimulator:
                 result = fix
             else:
                 result = int(get_rng(seed, self.rng).uniform(0,1)<prob)
-        self.drop_coeff([x for x in self.coeff.keys() if x[index]==str(1-result)])
-        # drop ancilla if not needed
-        hf0 = lambda x: (x<_ZERO_EPS) or (x>(1-_ZERO_EPS))
-        drop_ancilla_list = [x for x in range(64, len(self.pos2tag)) if hf0(self._get_probability_i(x))]
-        self.drop_ancilla(drop_ancilla_list)
+        self._drop_coeff_where(index, 1-result, release_ancilla=True)
         self.last_measure = result
         self.last_measure1_prob = prob
 
+    def _check_peek(self, prob1:float):
+        if self._peek:
+            raise _QChessPeek(prob1)
+
     def drop_ancilla(self, index:int|list):
         if not hasattr(index,'__len__'):
             index = [index]
@@ -255,19 +841,64 @@ class QChessSparseSimulator:
         assert all(x>=64 for x in index)
         tmp0 = (self._get_probability_i(x) for x in index)
         assert all((x<_ZERO_EPS) or (x>1-_ZERO_EPS) for x in tmp0)
-        self._cache_probability.clear()
+        self._on_coeff_replace()
         for x in index[::-1]:
             self.coeff = {hf_drop_str_char(k,x):v for k,v in self.coeff.items()}
             self.pos2tag.pop(x)
+            self._probability.pop(x)
+        self._rebuild_square_index()
 
     def add_ancilla(self):
+        self._on_coeff_replace()
         self.coeff = {(k+'0'):v for k,v in self.coeff.items()}
         self.pos2tag.append(None)
+        self._probability.append(0)
+        self._rebuild_square_index()
+
+    def _get_free_ancilla(self):
+        # ancilla pool: an ancilla qubit in state 0 for every key (pos2tag is None) is reused, add_ancilla() only if none is free
+        # the free ones at the end are removed by the measurement, see _drop_coeff_by()
+        ret = next((x for x in range(64, len(self.pos2tag)) if self.pos2tag[x] is None), None)
+        if ret is None:
+            ret = len(self.pos2tag)
+            self.add_ancilla()
+        return ret
+
+    def _is_definite_one(self, index:int):
+        # the qubit is 1 in every key
+        if self._get_probability_i(index) < 1-_ZERO_EPS:
+            return False
+        if self._square_index is not None:
+            return len(self._square_index.square[index])==len(self.coeff)
+        hf0 = self._hf_key_bit(index)
+        return all(hf0(k) for k in self.coeff.keys())
+
+    def _clear_definite_qubit(self, index:int, phase:complex):
+        # every key has the qubit in 1, set it to 0 and multiply the phase in one pass
+        if self._coeff_shared and (self._square_index is not None):
+            self._square_index = self._square_index.copy()
+        coeff_old = self.coeff
+        self.coeff = {self._flip_key(k, index):(v*phase) for k,v in coeff_old.items()}
+        self._coeff_shared = False
+        if self._square_index is not None:
+            self._square_index.rename_all([], lambda k: self._flip_key(k, index), [index])
+        self.pos2tag[index] = None
+        self._probability[index] = 0
+        self._on_coeff_delta(coeff_old, list(self.coeff.keys()), None, None)
+
+    def get_correlation(self):
+        # <n_i n_j> over the 64 squares
+        ret = np.zeros((64,64), dtype=np.float64)
+        for k,v in self.coeff.items():
+            tmp0 = np.array([x=='1' for x in k[:64]], dtype=np.bool_)
+            ret += (abs(v)**2)*(tmp0.reshape(-1,1)*tmp0)
+        return ret
 
     def print_verbose(self, space:int=4):
         dash = '\u2500'
         tag_list = [self.tag_to_print_tag[self.pos2tag[x]] for x in range(64)]
         for key,value in self.coeff.items():
+            key = self._key_to_str(key)
             tmp0 = [' | '.join(tag_list[8*x+y] if (key[8*x+y]=='1') else ' ' for y in range(8)) for x in range(8)]
             table = [(' '*space + f'{x+1} | ' + y + ' |') for x,y in enumerate(tmp0)]
             print(f'coeff: {value}')
@@ -309,6 +940,72 @@ class QChessSparseSimulator:
 
     __repr__ = __str__
 
+    def _apply_fused_slide(self, index_list, path1, path2, table):
+        # the gate sequence of split_slide()/merge_slide() in one pass over the keys with any of index_list occupied
+        # table: see hf_fused_slide_table(), the path qubits are not changed
+        tag = next(self.pos2tag[x] for x in index_list if self.pos2tag[x] is not None)
+        hf_state,hf_cond,hf_set = self._hf_fused_key(index_list, path1, path2)
+        self._own_coeff()
+        coeff_old = {k:self.coeff.pop(k) for k in self._get_key_with_one(index_list)}
+        coeff_new = dict()
+        key_split = set() #output of the sqrtiswap, dropped if the amplitude cancels
+        key_out = [] if (self._square_index is not None) else None #see QChessSquareIndex.relabel()
+        for k0,v0 in coeff_old.items():
+            state = hf_state(k0)
+            tmp0 = table[hf_cond(k0)][state]
+            tmp1 = []
+            for state1,factor in tmp0:
+                k1 = k0 if (state1==state) else hf_set(k0, state1)
+                coeff_new[k1] = coeff_new.get(k1, 0) + v0*factor
+                tmp1.append((k1,state1))
+                if len(tmp0)>1:
+                    key_split.add(k1)
+            if key_out is not None:
+                key_out.append((k0,tmp1))
+        prob = [0]*len(index_list)
+        occupied = 0
+        for k,v in coeff_new.items():
+            tmp0 = v.real*v.real + v.imag*v.imag
+            if (tmp0<_ZERO_EPS) and (k in key_split):
+                continue
+            self.coeff[k] = v
+            state = hf_state(k)
+            occupied |= state
+            for i in range(len(index_list)):
+                if (state>>i)&1:
+                    prob[i] += tmp0
+        for i,x in enumerate(index_list):
+            self.pos2tag[x] = tag if ((occupied>>i)&1) else None
+            self._probability[x] = prob[i]
+        if self.check_probability:
+            self._check_probability()
+        if key_out is not None:
+            self._square_index.relabel(key_out, index_list, self.coeff)
+        # the cancelled keys are in neither coeff nor the square index
+        self._on_coeff_delta(coeff_old, [k for k in coeff_new.keys() if k in self.coeff], None, None)
+
+    def is_classical(self):
+        # one basis key and no ancilla in use, every square is either empty or occupied for sure
+        return (self.get_num_amplitude()==1) and all(x is None for x in self.pos2tag[64:])
+
+    def _classical_move_key(self, src:int, dst:int, phase:complex):
+        key,value = next(iter(self.coeff.items()))
+        key_new = self._flip_key(key, src) if (self.pos2tag[dst] is not None) else self._swap_key(key, src, dst)
+        self._own_coeff()
+        self.coeff.pop(key)
+        self.coeff[key_new] = value*phase
+        self._update_square_index([key], [key_new], src, dst)
+        self._on_coeff_delta({key:value}, [key_new], src, dst)
+
+    def _classical_move(self, src:int, dst:int, phase:complex):
+        # classical fast path, the piece on src moves to dst (empty or captured) and the amplitude is multiplied by phase
+        # same result as the gates of normal_slide() (phase=1j) and capture_*() (phase=-1, the ancilla is dropped)
+        self._classical_move_key(src, dst, phase)
+        self.pos2tag[dst] = self.pos2tag[src]
+        self.pos2tag[src] = None
+        self._probability[dst] = self._probability[src]
+        self._probability[src] = 0
+
     def normal_jump(self, src, dst):
         self.normal_slide(src, dst, [])
 
@@ -329,6 +1026,11 @@ class QChessSparseSimulator:
             raise QChessInvalidCommand(f'invalid src="{src}", dst="{dst}"')
         if any(self.get_marginal_probability(x)>1-_ZERO_EPS for x in path):
             raise QChessInvalidCommand(f'invalid path="{path}"')
+        if self.is_classical():
+            # path is empty, the iswap does nothing if dst is occupied by the same tag
+            if tag_dst is None:
+                self._classical_move(src, dst, 1j)
+            return
         self.apply_iswap(src, dst, path)
 
     def split_slide(self, src, dst1, dst2, path1, path2):
@@ -351,6 +1053,10 @@ class QChessSparseSimulator:
             raise QChessInvalidCommand(f'invalid src="{src}", dst1="{dst1}", dst2="{dst2}"')
         if any(self.get_marginal_probability(x)>1-_ZERO_EPS for x in path1) and any(self.get_marginal_probability(x)>1-_ZERO_EPS for x in path2):
             raise QChessInvalidCommand(f'invalid path1="{path1}", path2="{path2}"')
+        self._apply_fused_slide([src, dst1, dst2], path1, path2, _SPLIT_SLIDE_TABLE)
+
+    def _split_slide_gate(self, src, dst1, dst2, path1, path2):
+        # gate sequence of split_slide() (without the checks), _SPLIT_SLIDE_TABLE is built from it
         # controlled split
         self.apply_sqrtiswap(src, dst1, set(path1)|set(path2))
         if (self.pos2tag[src] is not None) or (self.pos2tag[dst2] is not None):
@@ -382,6 +1088,10 @@ class QChessSparseSimulator:
             raise QChessInvalidCommand(f'invalid src1="{src1}", src2="{src2}", dst="{dst}"')
         if any(self.get_marginal_probability(x)>1-_ZERO_EPS for x in path1) and any(self.get_marginal_probability(x)>1-_ZERO_EPS for x in path2):
             raise QChessInvalidCommand(f'invalid path1="{path1}", path2="{path2}"')
+        self._apply_fused_slide([dst, src1, src2], path1, path2, _MERGE_SLIDE_TABLE)
+
+    def _merge_slide_gate(self, src1, src2, dst, path1, path2):
+        # gate sequence of merge_slide() (without the checks), _MERGE_SLIDE_TABLE is built from it
         # controlled slide src2
         self.apply_iswap(dst, src2, control=path2, negate_control=path1, tag_inverse=True)
         # controlled slide src1
@@ -432,6 +1142,8 @@ class QChessSparseSimulator:
         if ((src==dst) or (not (0<=src<64)) or (not (0<=dst<64)) or (len(tmp0)<len(path)) or (len(path)==0)
                 or (src in tmp0) or (dst in tmp0) or any(not (0<=x<64) for x in path)):
             raise QChessInvalidCommand(f'invalid src="{src}", dst="{dst}", path="{path}"')
+        if self._square_index is not None:
+            return self._get_capture_slide_measure_M0_m1_key_index(src, dst, path)
         M0_list = []
         M1_list = []
         tmp0 = {(False,False,False),(True,True,True),(True,True,False),(False,True,False)}
@@ -445,6 +1157,22 @@ class QChessSparseSimulator:
                 M1_list.append(key)
         return M0_list,M1_list
 
+    def _get_capture_slide_measure_M0_m1_key_index(self, src:int, dst:int, path:list[int]):
+        # M1 keys always have src or path occupied, so only visit those
+        square = self._square_index.square
+        id2key = self._square_index.id2key
+        index_path = [square[x] for x in path]
+        M1_list = []
+        for x in set().union(square[src], *index_path):
+            if any((x in y) for y in index_path):
+                if x not in square[dst]:
+                    M1_list.append(id2key[x])
+            elif x in square[src]:
+                M1_list.append(id2key[x])
+        tmp0 = set(M1_list)
+        M0_list = [x for x in self.coeff.keys() if x not in tmp0]
+        return M0_list,M1_list
+
     def get_capture_slide_measure_prob(self, src, dst, path):
         _,M1_list = self._get_capture_slide_measure_M0_m1_key(src, dst, path)
         tmp0 = (self.coeff[x] for x in M1_list)
@@ -460,6 +1188,7 @@ class QChessSparseSimulator:
             # raise QChessInvalidCommand(f'invalid src="{src}", dst="{dst}", path="{path}"')
             # cannot check this in advance, so we allow this
             return 'meaningless move'
+        self._check_peek(prob1)
         if measure_fix is not None:
             assert measure_fix in {0,1}
             result = measure_fix
@@ -468,11 +1197,12 @@ class QChessSparseSimulator:
             result = int(rng.uniform(0,1)<prob1)
         self.last_measure = result
         self.last_measure1_prob = prob1
-        self.drop_coeff(M1_list if result==0 else M0_list)
+        tmp0 = set(M1_list)
+        self._drop_coeff_by(lambda k: (k in tmp0)==(result==0), release_ancilla=True)
 
     def capture_slide(self, src, dst, path, measure_fix=None, seed=None, is_pawn=False):
         if len(path)==0:
-            self.capture_jump(src, dst, measure_fix, seed)
+            self.capture_jump(src, dst, measure_fix, seed, is_pawn)
             return
         src:int = hf_convert_pos_to_int(src)
         dst:int = hf_convert_pos_to_int(dst)
@@ -486,22 +1216,32 @@ class QChessSparseSimulator:
         if ((src==dst) or (not (0<=src<64)) or (not (0<=dst<64)) or (len(tmp0)<len(path)) or (len(path)==0)
                 or (src in tmp0) or (dst in tmp0) or any(not (0<=x<64) for x in path)):
             raise QChessInvalidCommand(f'invalid src="{src}", dst="{dst}", path="{path}"')
+        if self.is_classical() and (measure_fix!=0):
+            if any(self.pos2tag[x] is not None for x in path):
+                return #meaningless move, see _capture_slide_measure()
+            tmp0 = next(iter(self.coeff.values()))
+            prob1 = tmp0.real*tmp0.real + tmp0.imag*tmp0.imag
+            self._check_peek(prob1)
+            result = measure_fix if (measure_fix is not None) else int(get_rng(seed, self.rng).uniform(0,1)<prob1)
+            assert result==1, 'zero probability'
+            self.last_measure = result
+            self.last_measure1_prob = prob1
+            self._classical_move(src, dst, -1)
+            return
         tmp0 = self._capture_slide_measure(src, dst, path, measure_fix, seed)
         if (tmp0 is None) and (self.last_measure==1):
             ancilla = None
-            if self.pos2tag[dst] is not None:
-                ancilla = len(self.pos2tag)
-                self.add_ancilla()
+            is_capture = self.pos2tag[dst] is not None
+            if is_capture and self._is_definite_one(dst):
+                # the ancilla would be 1 in every key, so dst is cleared with the iswap phase instead of adding one
+                self._clear_definite_qubit(dst, 1j)
+            elif is_capture:
+                ancilla = self._get_free_ancilla()
                 self.apply_iswap(dst, ancilla, path)
-            if is_pawn:
-                if ancilla is not None:
-                    self.apply_iswap(src, dst, path, negate_control=[ancilla])
-            else:
+            if is_pawn and (ancilla is not None):
+                self.apply_iswap(src, dst, path, negate_control=[ancilla])
+            elif is_capture or (not is_pawn):
                 self.apply_iswap(src, dst, path)
-            if ancilla is not None:
-                tmp0 = self.get_marginal_probability(ancilla)
-                if (tmp0<_ZERO_EPS) or (tmp0>1-_ZERO_EPS):
-                    self.drop_ancilla(ancilla)
 
     def capture_jump(self, src, dst, measure_fix=None, seed=None, is_pawn=False):
         src:int = hf_convert_pos_to_int(src)
@@ -515,43 +1255,53 @@ class QChessSparseSimulator:
             raise QChessInvalidCommand(f'invalid src="{src}", dst="{dst}"')
         if self.get_marginal_probability(src) < _ZERO_EPS:
             raise QChessInvalidCommand(f'invalid src="{src}"')
+        if self.is_classical() and (measure_fix!=0):
+            # the measurement is certain, no random number is used
+            self._check_peek(self._get_probability_i(src))
+            self.last_measure = 1
+            self.last_measure1_prob = self._get_probability_i(src)
+            self._classical_move(src, dst, -1)
+            return
         self.measure(src, measure_fix, seed=seed)
         if self.last_measure==1:
             ancilla = None
-            if self.pos2tag[dst] is not None:
-                ancilla = len(self.pos2tag)
-                self.add_ancilla()
+            is_capture = self.pos2tag[dst] is not None
+            if is_capture and self._is_definite_one(dst):
+                # the ancilla would be 1 in every key, so dst is cleared with the iswap phase instead of adding one
+                self._clear_definite_qubit(dst, 1j)
+            elif is_capture:
+                ancilla = self._get_free_ancilla()
                 self.apply_iswap(dst, ancilla)
-            if is_pawn:
-                if ancilla is not None:
-                    self.apply_iswap(src, dst, negate_control=[ancilla])
-            else:
+            if is_pawn and (ancilla is not None):
+                self.apply_iswap(src, dst, negate_control=[ancilla])
+            elif is_capture or (not is_pawn):
                 self.apply_iswap(src, dst)
-            if ancilla is not None:
-                tmp0 = self.get_marginal_probability(ancilla)
-                if (tmp0<_ZERO_EPS) or (tmp0>1-_ZERO_EPS):
-                    self.drop_ancilla(ancilla)
 
     def add_piece(self, pos:int, tag:str):
         assert (0<=pos<len(self.pos2tag)) and (self.pos2tag[pos] is None)
         if tag not in self.tag_to_print_tag:
             hf0 = lambda x: (x if x.isupper() else f'\033[94m{x.upper()}\033[0m')
             self.tag_to_print_tag[tag] = hf0(tag)
-        self._cache_probability.clear()
+        self._on_coeff_replace()
         self.pos2tag[pos] = tag
         self.coeff = {hf_invert_str01(k,pos):v for k,v in self.coeff.items()}
+        self._probability[pos] = 1
+        self._rebuild_square_index()
 
     def remove_piece(self, pos:int):
         assert (0<=pos<len(self.pos2tag)) and (self._get_probability_i(pos)>1-_ZERO_EPS)
-        self._cache_probability.clear()
+        self._on_coeff_replace()
         self.pos2tag[pos] = None
         self.coeff = {hf_invert_str01(k,pos):v for k,v in self.coeff.items()}
+        self._probability[pos] = 0
+        self._rebuild_square_index()
 
     def remove_all_piece(self):
-        self.coeff.clear()
-        self.coeff['0000000000000000000000000000000000000000000000000000000000000000'] = 1
+        self._on_coeff_replace()
+        self.coeff = {'0000000000000000000000000000000000000000000000000000000000000000':1}
         self.pos2tag = [None]*64
-        self._cache_probability.clear()
+        self._probability = [0]*64
+        self._rebuild_square_index()
 
 ## command list
 # add a3 P
@@ -567,13 +1317,71 @@ def is_measured_wrapper(hf0):
 
 
 
+def get_simulator_class(backend:str='str'):
+    # str: '0'/'1' string basis key (reference implementation)
+    # int: python int basis key, bit i is square i
+    # numpy: parallel numpy arrays (uint64 basis key, complex128 amplitude), vectorized gate
+    # factor: int basis key, tensor product of independent components
+    if backend=='str':
+        ret = QChessSparseSimulator
+    elif backend=='int':
+        from .sparse_int import QChessSparseSimulatorInt
+        ret = QChessSparseSimulatorInt
+    elif backend=='numpy':
+        from .sparse_numpy import QChessSparseSimulatorNumpy
+        ret = QChessSparseSimulatorNumpy
+    elif backend=='factor':
+        from .sparse_factor import QChessSparseSimulatorFactor
+        ret = QChessSparseSimulatorFactor
+    else:
+        raise ValueError(f'invalid backend="{backend}"')
+    return ret
+
+
+class QChessUndoBuffer:
+    # ring buffer of the game snapshots, undo in constant time
+    # keep at most depth snapshots, the oldest are dropped when the total number of amplitudes exceeds max_amplitude
+    def __init__(self, depth:int=64, max_amplitude:int=2**20):
+        assert depth>=0
+        self.depth = depth
+        self.max_amplitude = max_amplitude
+        self.buffer = collections.deque()
+        self.num_amplitude = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def clear(self):
+        self.buffer.clear()
+        self.num_amplitude = 0
+
+    def push(self, snapshot):
+        tmp0 = snapshot.sim.get_num_amplitude()
+        self.buffer.append((snapshot, tmp0))
+        self.num_amplitude += tmp0
+        while (len(self.buffer)>self.depth) or (self.buffer and (self.num_amplitude>self.max_amplitude)):
+            self.num_amplitude -= self.buffer.popleft()[1]
+
+    def pop(self, step:int=1):
+        # return None if the buffer is not deep enough
+        if (step<1) or (step>len(self.buffer)):
+            return None
+        for _ in range(step):
+            ret,tmp0 = self.buffer.pop()
+            self.num_amplitude -= tmp0
+        return ret
+
+
 class QChessGame:
     # user interface
-    def __init__(self, seed=None):
+    def __init__(self, seed=None, backend:str='str'):
         if not _GLOBAL_CONFIG['print_disclaimer']:
             print(_DISCLAIMER)
             _GLOBAL_CONFIG['print_disclaimer'] = True
         self.rng = get_rng(seed)
+        self.backend = backend
+        self.truncation = (None, None) #(threshold, max_branch), see QChessSparseSimulator.set_truncation()
+        self.undo_buffer = QChessUndoBuffer(depth=0) #disabled, see set_undo_buffer()
         self._reset()
 
     def __str__(self):
@@ -583,9 +1391,29 @@ class QChessGame:
     __repr__ = __str__
 
     def copy(self):
-        ret = QChessGame()
-        ret.sim._clone_from_sim(self.sim)
-        ret.rng = ret.sim.rng
+        # cheap snapshot, the superposition is shared (copy-on-write) with self
+        ret = QChessGame.__new__(QChessGame)
+        ret.restore(self)
+        return ret
+
+    snapshot = copy
+
+    def restore(self, game1):
+        # restore from a snapshot, game1 is not changed and can be restored again
+        # the undo buffer is not copied, a new game (e.g. copy()) gets a disabled one
+        undo_buffer = self.__dict__.get('undo_buffer', None)
+        self.__dict__.update(game1.__dict__)
+        self.undo_buffer = QChessUndoBuffer(depth=0) if (undo_buffer is None) else undo_buffer
+        self.sim = game1.sim.copy()
+        self.rng = self.sim.rng
+        self.wpawn_last_twostep = list(game1.wpawn_last_twostep)
+        self.bpawn_last_twostep = list(game1.bpawn_last_twostep)
+        self.pawn_last_twostep = dict(game1.pawn_last_twostep)
+        self.tag_wcastling = list(game1.tag_wcastling)
+        self.tag_bcastling = list(game1.tag_bcastling)
+        self.history = list(game1.history)
+        self.truncation_loss = list(game1.truncation_loss)
+        self._move_stack = [] #the simulator undo log is not copied
 
     @property
     def is_white(self):
@@ -593,14 +1421,14 @@ class QChessGame:
         return self.current_step % 2 == 0
 
     def __getitem__(self, key):
-        if isinstance(key, int):
+        if isinstance(key, ChessPosition):
+            key = key.pos
+        elif isinstance(key, int):
             pass
         elif isinstance(key, str):
             key = hf_convert_pos_to_int(key)
         elif isinstance(key, tuple) and (len(key)==2) and isinstance(key[0],int) and isinstance(key[1],int):
             key = key[0] + 8*key[1]
-        elif isinstance(key, ChessPosition):
-            key = key.pos
         else:
             raise KeyError(f'invalid key="{key}"')
         if self.sim.pos2tag[key] is None:
@@ -624,7 +1452,11 @@ class QChessGame:
     def _reset(self, state0=0xFFFF00000000FFFF, tag_list='RNBQKBNRPPPPPPPPpppppppprnbqkbnr'):
         # white: upper case
         # black: lower case
-        self.sim = QChessSparseSimulator(state0, tag_list, self.rng)
+        self.sim = get_simulator_class(self.backend)(state0, tag_list, self.rng)
+        self.sim.set_truncation(*self.truncation)
+        self.truncation_loss = [] #dropped probability of each move
+        self._move_stack = [] #see push_move()
+        self._move_cache = None #QChessMoveCache, shared with the copies, see get_all_available_move()
         self.current_step = 0
         self.wpawn_last_twostep = [None]*8
         self.bpawn_last_twostep = [None]*8
@@ -635,24 +1467,11 @@ class QChessGame:
         self.history = []
 
     def get_two_point_path(self, src:ChessPosition, dst:ChessPosition):
-        file0 = src.file
-        rank0 = src.rank
-        file1 = dst.file
-        rank1 = dst.rank
-        if (file0==file1) and (rank0==rank1):
-            ret = []
-        elif file0==file1:
-            ret = [(file0, x) for x in range(min(rank0,rank1)+1, max(rank0,rank1))]
-        elif rank0==rank1:
-            ret = [(x, rank0) for x in range(min(file0,file1)+1, max(file0,file1))]
-        elif abs(file0-file1)==abs(rank0-rank1):
-            tmp0 = range(file0+1,file1) if (file0<file1) else range(file0-1,file1,-1)
-            tmp1 = range(rank0+1,rank1) if (rank0<rank1) else range(rank0-1,rank1,-1)
-            ret = list(zip(tmp0,tmp1))
-        else:
+        # occupied squares strictly between src and dst
+        if (src.pos!=dst.pos) and not (((ROOK_RAY[src.pos] | BISHOP_RAY[src.pos])>>dst.pos) & 1):
             raise QChessInvalidCommand(f'invalid path src="{src.str_}", dst="{dst.str_}"')
-        ret = (ChessPosition(x,y) for x,y in ret)
-        ret = [x for x in ret if self[x] is not None]
+        pos2tag = self.sim.pos2tag
+        ret = [ChessPosition(x) for x in BETWEEN_LIST[src.pos][dst.pos] if pos2tag[x] is not None]
         return ret
 
     def _is_valid_move_preprocess(self, src, src1, dst, dst1, tag):
@@ -681,7 +1500,7 @@ class QChessGame:
         assert (src is not None) and (dst is not None)
         tag_src = self[src]
         tag_dst = self[dst]
-        tag_path = self[(src.file,src.rank+(1 if is_white else -1))]
+        tag_path = self[src.pos+(8 if is_white else -8)]
         if (tag_src is None) or (tag_src[0]!=('P' if is_white else 'p')) or (src==dst):
             return ''
         if (promotion is not None) and (dst.rank != (7 if is_white else 0)):
@@ -703,8 +1522,8 @@ class QChessGame:
               and (tag_dst is not None) and (tag_dst[0].islower()!=tag_src[0].islower())):
             ret = 'capture'
         elif ((dst.rank==src.rank+(1 if is_white else -1)) and (dst.file in {src.file-1,src.file+1})
-              and (tag_dst is None) and (self[(dst.file,src.rank)] is not None)
-              and (self[(dst.file,src.rank)][0]==('p' if is_white else 'P'))
+              and (tag_dst is None) and (self[dst.file+8*src.rank] is not None)
+              and (self[dst.file+8*src.rank][0]==('p' if is_white else 'P'))
               and (self.pawn_last_twostep[ChessPosition(dst.file, src.rank).str_]==(self.current_step-1))):
             ret = 'en-passant'
         else:
@@ -715,55 +1534,7 @@ class QChessGame:
 
     @is_measured_wrapper
     def move_pawn(self, src: str, dst: str, promotion:str|None=None):
-        src, dst = hf_str_none_to_position(src, dst)
-        assert (src is not None) and (dst is not None)
-        kind = self.is_valid_move_pawn(src, dst, promotion)
-        if kind == 'one-step-move':
-            self.sim.normal_jump(src.pos, dst.pos)
-            self.pawn_last_twostep[dst.str_] = self.pawn_last_twostep.pop(src.str_)
-        elif kind == 'one-step-blocked-move':
-            self.sim.blocked_jump(src.pos, dst.pos, self.get_prefix_measure())
-            if self.sim.last_measure == 0:
-                self.pawn_last_twostep[dst.str_] = self.pawn_last_twostep.pop(src.str_)
-        elif kind == 'two-step-move':
-            assert self.pawn_last_twostep[src.str_] is None, 'something must be wrong'
-            tmp0 = ChessPosition(src.file, src.rank+(1 if self.is_white else -1))
-            if self[tmp0] is not None:
-                assert self[tmp0][1]<=1-_ZERO_EPS
-                path = [tmp0.pos]
-            else:
-                path = []
-            self.sim.normal_slide(src.pos, dst.pos, path)
-            self.pawn_last_twostep[dst.str_] = self.current_step
-            if len(path)==0:
-                self.pawn_last_twostep.pop(src.str_)
-        elif kind == 'two-step-blocked-move':
-            assert self.pawn_last_twostep[src.str_] is None, 'something must be wrong'
-            tmp0 = ChessPosition(src.file, src.rank+(1 if self.is_white else -1))
-            if self[tmp0] is not None:
-                assert self[tmp0][1]<=1-_ZERO_EPS
-                path = [tmp0.pos]
-            else:
-                path = []
-            self.sim.blocked_slide(src.pos, dst.pos, path, self.get_prefix_measure())
-            if self.sim.last_measure == 0:
-                self.pawn_last_twostep[dst.str_] = self.current_step
-                if len(path)==0:
-                    self.pawn_last_twostep.pop(src.str_)
-        elif kind == 'capture':
-            self.sim.capture_jump(src.pos, dst.pos, self.get_prefix_measure(), is_pawn=True)
-            self.pawn_last_twostep[dst.str_] = self.pawn_last_twostep.pop(src.str_)
-            if self[src] is not None: #partially captured
-                self.pawn_last_twostep[src.str_] = self.pawn_last_twostep[dst.str_]
-        elif kind == 'en-passant':
-            tmp0 = ChessPosition(dst.file, src.rank)
-            self.sim.capture_jump(src.pos, tmp0.pos, self.get_prefix_measure(), is_pawn=True)
-            self.sim.normal_jump(tmp0.pos, dst.pos)
-            self.pawn_last_twostep[dst.str_] = self.pawn_last_twostep.pop(src.str_)
-        else:
-            raise QChessInvalidCommand(f'invalid src="{src.str_}", dst="{dst.str_}"')
-        if promotion is not None:
-            self.sim.change_tag(dst.pos, promotion.upper() if self.is_white else promotion.lower())
+        self._make_move('P', src, None, dst, None, promotion)
 
     def is_valid_castling(self, srcK, srcR, dstK, dstR):
         srcK,srcR,dstK,dstR = hf_str_none_to_position(srcK, srcR, dstK, dstR)
@@ -786,20 +1557,7 @@ class QChessGame:
         return ret
 
     def move_castling(self, srcK:str, srcR:str, dstK:str, dstR:str):
-        srcK,srcR,dstK,dstR = hf_str_none_to_position(srcK, srcR, dstK, dstR)
-        assert (srcK is not None) and (srcR is not None) and (dstK is not None) and (dstR is not None)
-        kind = self.is_valid_castling(srcK, srcR, dstK, dstR)
-        if kind=='castling':
-            self.sim.normal_jump(srcK.pos, dstK.pos)
-            self.sim.normal_jump(srcR.pos, dstR.pos)
-            if self.is_white:
-                self.tag_wcastling[0] = False
-                self.tag_wcastling[1] = False
-            else:
-                self.tag_bcastling[0] = False
-                self.tag_bcastling[1] = False
-        else:
-            raise QChessInvalidCommand(f'invalid srcK="{srcK.str_}", srcR="{srcR.str_}", dstK="{dstK.str_}", dstR="{dstR.str_}"')
+        self._make_move('castling', srcK, srcR, dstK, dstR)
 
     def is_valid_move_rook(self, src, src1, dst, dst1):
         tmp0 = self._is_valid_move_preprocess(src, src1, dst, dst1, 'R')
@@ -836,33 +1594,7 @@ class QChessGame:
 
     @is_measured_wrapper
     def move_rook(self, src:str, src1:(str|None), dst:str, dst1:(str|None)):
-        src,src1,dst,dst1 = hf_str_none_to_position(src,src1,dst,dst1)
-        assert (src is not None) and (dst is not None)
-        path0 = self.get_two_point_path(src, dst)
-        if src1 is not None:
-            path1 = self.get_two_point_path(src1, dst)
-        if dst1 is not None:
-            path1 = self.get_two_point_path(src, dst1)
-        kind = self.is_valid_move_rook(src, src1, dst, dst1)
-        if kind=='normal-slide':
-            self.sim.normal_slide(src.pos, dst.pos, [x.pos for x in path0])
-        elif kind=='blocked-slide':
-            self.sim.blocked_slide(src.pos, dst.pos, [x.pos for x in path0], self.get_prefix_measure())
-        elif kind=='capture':
-            self.sim.capture_slide(src.pos, dst.pos, [x.pos for x in path0], self.get_prefix_measure())
-        elif kind=='split':
-            tmp0,tmp1 = hf_weird_split_slide(dst.pos, dst1.pos, [x.pos for x in path0], [x.pos for x in path1])
-            self.sim.split_slide(src.pos, dst.pos, dst1.pos, tmp0, tmp1)
-        elif kind=='merge':
-            tmp0,tmp1 = hf_weird_merge_slide(src.pos, src1.pos, [x.pos for x in path0], [x.pos for x in path1])
-            self.sim.merge_slide(src.pos, src1.pos, dst.pos, tmp0, tmp1)
-        else:
-            raise QChessInvalidCommand(f'invalid src="{src.str_}", src1="{src1}", dst="{dst.str_}", dst1="{dst1}"')
-        tmp0 = self[src]
-        if ((src.file,src.rank) in {(0,0),(7,0)}) and ((tmp0 is None) or (tmp0[1]<=1-_ZERO_EPS)):
-            self.tag_wcastling[0 if (src.file) else 1] = False
-        if ((src.file,src.rank) in {(0,7),(7,7)}) and ((tmp0 is None) or (tmp0[1]<=1-_ZERO_EPS)):
-            self.tag_bcastling[1 if (src.file) else 0] = False
+        self._make_move('R', src, src1, dst, dst1)
 
     def is_valid_move_bishop(self, src, src1, dst, dst1):
         tmp0 = self._is_valid_move_preprocess(src, src1, dst, dst1, 'B')
@@ -899,28 +1631,7 @@ class QChessGame:
 
     @is_measured_wrapper
     def move_bishop(self, src:str, src1:(str|None), dst:str, dst1:(str|None)):
-        src,src1,dst,dst1 = hf_str_none_to_position(src,src1,dst,dst1)
-        assert (src is not None) and (dst is not None)
-        path0 = self.get_two_point_path(src, dst)
-        if src1 is not None:
-            path1 = self.get_two_point_path(src1, dst)
-        if dst1 is not None:
-            path1 = self.get_two_point_path(src, dst1)
-        kind = self.is_valid_move_bishop(src, src1, dst, dst1)
-        if kind=='normal-slide':
-            self.sim.normal_slide(src.pos, dst.pos, [x.pos for x in path0])
-        elif kind=='blocked-slide':
-            self.sim.blocked_slide(src.pos, dst.pos, [x.pos for x in path0], self.get_prefix_measure())
-        elif kind=='capture':
-            self.sim.capture_slide(src.pos, dst.pos, [x.pos for x in path0], self.get_prefix_measure())
-        elif kind=='split':
-            tmp0,tmp1 = hf_weird_split_slide(dst.pos, dst1.pos, [x.pos for x in path0], [x.pos for x in path1])
-            self.sim.split_slide(src.pos, dst.pos, dst1.pos, tmp0, tmp1)
-        elif kind=='merge':
-            tmp0,tmp1 = hf_weird_merge_slide(src.pos, src1.pos, [x.pos for x in path0], [x.pos for x in path1])
-            self.sim.merge_slide(src.pos, src1.pos, dst.pos, tmp0, tmp1)
-        else:
-            raise QChessInvalidCommand(f'invalid src="{src.str_}", src1="{src1}", dst="{dst.str_}", dst1="{dst1}"')
+        self._make_move('B', src, src1, dst, dst1)
 
     def is_valid_move_queen(self, src, src1, dst, dst1):
         tmp0 = self._is_valid_move_preprocess(src, src1, dst, dst1, 'Q')
@@ -957,28 +1668,7 @@ class QChessGame:
 
     @is_measured_wrapper
     def move_queen(self, src:str, src1:(str|None), dst:str, dst1:(str|None)):
-        src,src1,dst,dst1 = hf_str_none_to_position(src,src1,dst,dst1)
-        assert (src is not None) and (dst is not None)
-        path0 = self.get_two_point_path(src, dst)
-        if src1 is not None:
-            path1 = self.get_two_point_path(src1, dst)
-        if dst1 is not None:
-            path1 = self.get_two_point_path(src, dst1)
-        kind = self.is_valid_move_queen(src, src1, dst, dst1)
-        if kind=='normal-slide':
-            self.sim.normal_slide(src.pos, dst.pos, [x.pos for x in path0])
-        elif kind=='blocked-slide':
-            self.sim.blocked_slide(src.pos, dst.pos, [x.pos for x in path0], self.get_prefix_measure())
-        elif kind=='capture':
-            self.sim.capture_slide(src.pos, dst.pos, [x.pos for x in path0], self.get_prefix_measure())
-        elif kind=='split':
-            tmp0,tmp1 = hf_weird_split_slide(dst.pos, dst1.pos, [x.pos for x in path0], [x.pos for x in path1])
-            self.sim.split_slide(src.pos, dst.pos, dst1.pos, tmp0, tmp1)
-        elif kind=='merge':
-            tmp0,tmp1 = hf_weird_merge_slide(src.pos, src1.pos, [x.pos for x in path0], [x.pos for x in path1])
-            self.sim.merge_slide(src.pos, src1.pos, dst.pos, tmp0, tmp1)
-        else:
-            raise QChessInvalidCommand(f'invalid src="{src.str_}", src1="{src1}", dst="{dst.str_}", dst1="{dst1}"')
+        self._make_move('Q', src, src1, dst, dst1)
 
     def is_valid_move_king(self, src, src1, dst, dst1):
         tmp0 = self._is_valid_move_preprocess(src, src1, dst, dst1, 'K')
@@ -1007,29 +1697,7 @@ class QChessGame:
 
     @is_measured_wrapper
     def move_king(self, src:str, src1:(str|None), dst:str, dst1:(str|None)):
-        src,src1,dst,dst1 = hf_str_none_to_position(src,src1,dst,dst1)
-        assert (src is not None) and (dst is not None)
-        kind = self.is_valid_move_king(src, src1, dst, dst1)
-        if kind=='normal-jump':
-            self.sim.normal_jump(src.pos, dst.pos)
-        elif kind=='blocked-jump':
-            self.sim.blocked_jump(src.pos, dst.pos, self.get_prefix_measure())
-        elif kind=='capture':
-            self.sim.capture_jump(src.pos, dst.pos, self.get_prefix_measure())
-        elif kind=='split':
-            self.sim.split_jump(src.pos, dst.pos, dst1.pos)
-        elif kind=='merge':
-            self.sim.merge_jump(src.pos, src1.pos, dst.pos)
-        else:
-            raise QChessInvalidCommand(f'invalid src="{src.str_}", src1="{src1}", dst="{dst.str_}", dst1="{dst1}"')
-        tmp0 = self[src]
-        if ((src.file,src.rank) in {(4,0),(4,7)}) and ((tmp0 is None) or (tmp0[1]<=1-_ZERO_EPS)):
-            if self.is_white:
-                self.tag_wcastling[0] = False
-                self.tag_wcastling[1] = False
-            else:
-                self.tag_bcastling[0] = False
-                self.tag_bcastling[1] = False
+        self._make_move('K', src, src1, dst, dst1)
 
     def is_valid_move_knight(self, src, src1, dst, dst1):
         tmp0 = self._is_valid_move_preprocess(src, src1, dst, dst1, 'N')
@@ -1058,67 +1726,251 @@ class QChessGame:
 
     @is_measured_wrapper
     def move_knight(self, src:str, src1:(str|None), dst:str, dst1:(str|None)):
-        src,src1,dst,dst1 = hf_str_none_to_position(src,src1,dst,dst1)
-        assert (src is not None) and (dst is not None)
-        kind = self.is_valid_move_knight(src, src1, dst, dst1)
-        if kind=='normal-jump':
-            self.sim.normal_jump(src.pos, dst.pos)
-        elif kind=='blocked-jump':
-            self.sim.blocked_jump(src.pos, dst.pos, self.get_prefix_measure())
-        elif kind=='capture':
-            self.sim.capture_jump(src.pos, dst.pos, self.get_prefix_measure())
-        elif kind=='split':
-            self.sim.split_jump(src.pos, dst.pos, dst1.pos)
-        elif kind=='merge':
-            self.sim.merge_jump(src.pos, src1.pos, dst.pos)
-        else:
-            raise QChessInvalidCommand(f'invalid src="{src.str_}", src1="{src1}", dst="{dst.str_}", dst1="{dst1}"')
+        self._make_move('N', src, src1, dst, dst1)
 
-    def run_short_cmd(self, cmd, tag_print=True, tag_step=True):
-        args = _parse_cmd(cmd) #a2b2,c3  a2,b2  e1h1,g1f1  a2,a3,0
-        if args['prefix_measure'] is not None:
-            self.set_prefix_measure(args['prefix_measure'])
-        src = args['src']
+    def _get_move_piece(self, src:ChessPosition, src1:ChessPosition|None, dst:ChessPosition, dst1:ChessPosition|None)->str:
+        # 'P', 'R', 'B', 'Q', 'K', 'N' of the piece at src, or 'castling', for _plan_piece_move()
         tag_src = self[src]
         if (tag_src is None) or (tag_src[0].isupper()!=self.is_white):
             raise QChessInvalidCommand(f'invalid src="{src}"')
-        src1 = args['src1']
-        dst = args['dst']
-        dst1 = args['dst1']
-        promotion = args['promotion']
         if (src1 is not None) and (dst1 is None) and (not self[src1][0]==tag_src[0]): #merge
             raise QChessInvalidCommand(f'invalid src="{src}", src1="{src1}"')
-        if (src1 is not None) and (dst1 is not None): #castling
+        if (src1 is not None) and (dst1 is not None):
+            return 'castling'
+        return tag_src[0].upper()
+
+    def _plan_piece_move(self, piece:str, src, src1, dst, dst1, promotion:str|None=None, measure_fix:int|None=None):
+        # the rules of a move, the game is not changed, QChessGameBatch._run_move() is the vectorized copy
+        # return (kind, pawn path is empty, [(simulator method, kwargs)] to run in order), path is a list of squares
+        src,src1,dst,dst1 = hf_str_none_to_position(src,src1,dst,dst1)
+        assert (src is not None) and (dst is not None)
+        hf0 = lambda name, **kwargs: (name, kwargs)
+        path_empty = True
+        plan = []
+        if piece=='castling':
+            kind = self.is_valid_castling(src, src1, dst, dst1)
+            if kind=='castling':
+                plan = [hf0('normal_slide', src=src.pos, dst=dst.pos, path=[]), hf0('normal_slide', src=src1.pos, dst=dst1.pos, path=[])]
+            else:
+                raise QChessInvalidCommand(f'invalid srcK="{src.str_}", srcR="{src1.str_}", dstK="{dst.str_}", dstR="{dst1.str_}"')
+        elif piece=='P':
+            kind = self.is_valid_move_pawn(src, dst, promotion)
+            path = []
+            if kind in {'two-step-move','two-step-blocked-move'}:
+                assert self.pawn_last_twostep[src.str_] is None, 'something must be wrong'
+                tmp0 = ChessPosition(src.file, src.rank+(1 if self.is_white else -1))
+                if self[tmp0] is not None:
+                    assert self[tmp0][1]<=1-_ZERO_EPS
+                    path = [tmp0.pos]
+                path_empty = len(path)==0
+            if kind in {'one-step-move','two-step-move'}:
+                plan = [hf0('normal_slide', src=src.pos, dst=dst.pos, path=path)]
+            elif kind in {'one-step-blocked-move','two-step-blocked-move'}:
+                plan = [hf0('blocked_slide', src=src.pos, dst=dst.pos, path=path, measure_fix=measure_fix)]
+            elif kind=='capture':
+                plan = [hf0('capture_slide', src=src.pos, dst=dst.pos, path=[], measure_fix=measure_fix, is_pawn=True)]
+            elif kind=='en-passant':
+                tmp0 = ChessPosition(dst.file, src.rank)
+                plan = [hf0('capture_slide', src=src.pos, dst=tmp0.pos, path=[], measure_fix=measure_fix, is_pawn=True),
+                        hf0('normal_slide', src=tmp0.pos, dst=dst.pos, path=[])]
+            else:
+                raise QChessInvalidCommand(f'invalid src="{src.str_}", dst="{dst.str_}"')
+            if promotion is not None:
+                plan.append(hf0('change_tag', index=dst.pos, label=(promotion.upper() if self.is_white else promotion.lower())))
+        else:
+            hf1 = {'R':self.is_valid_move_rook, 'B':self.is_valid_move_bishop, 'Q':self.is_valid_move_queen,
+                    'K':self.is_valid_move_king, 'N':self.is_valid_move_knight}.get(piece)
+            if hf1 is None:
+                raise QChessInvalidCommand(f'invalid src="{src}"')
+            path0,path1 = [],[]
+            if piece in 'RBQ':
+                path0 = [x.pos for x in self.get_two_point_path(src, dst)]
+                if src1 is not None:
+                    path1 = [x.pos for x in self.get_two_point_path(src1, dst)]
+                if dst1 is not None:
+                    path1 = [x.pos for x in self.get_two_point_path(src, dst1)]
+            kind = hf1(src, src1, dst, dst1)
+            if kind in {'normal-slide','normal-jump'}:
+                plan = [hf0('normal_slide', src=src.pos, dst=dst.pos, path=path0)]
+            elif kind in {'blocked-slide','blocked-jump'}:
+                plan = [hf0('blocked_slide', src=src.pos, dst=dst.pos, path=path0, measure_fix=measure_fix)]
+            elif kind=='capture':
+                plan = [hf0('capture_slide', src=src.pos, dst=dst.pos, path=path0, measure_fix=measure_fix)]
+            elif kind=='split':
+                tmp0,tmp1 = hf_weird_split_slide(dst.pos, dst1.pos, path0, path1)
+                plan = [hf0('split_slide', src=src.pos, dst1=dst.pos, dst2=dst1.pos, path1=tmp0, path2=tmp1)]
+            elif kind=='merge':
+                tmp0,tmp1 = hf_weird_merge_slide(src.pos, src1.pos, path0, path1)
+                plan = [hf0('merge_slide', src1=src.pos, src2=src1.pos, dst=dst.pos, path1=tmp0, path2=tmp1)]
+            else:
+                raise QChessInvalidCommand(f'invalid src="{src.str_}", src1="{src1}", dst="{dst.str_}", dst1="{dst1}"')
+        return kind, path_empty, plan
+
+    def _finish_move(self, piece:str, kind:str, src:ChessPosition, dst:ChessPosition, path_empty:bool):
+        # pawn and castling bookkeeping of a move planned by _plan_piece_move(), self.sim is the state after the move
+        # keep in sync with QChessGameBatch._run_move()
+        if kind=='castling':
+            tmp0 = self.tag_wcastling if self.is_white else self.tag_bcastling
+            tmp0[0] = False
+            tmp0[1] = False
+        elif piece=='P':
+            last_measure = self.sim.last_measure
+            if (kind in {'one-step-move','capture','en-passant'}) or ((kind=='one-step-blocked-move') and (last_measure==0)):
+                self.pawn_last_twostep[dst.str_] = self.pawn_last_twostep.pop(src.str_)
+                if (kind=='capture') and (self[src] is not None): #partially captured
+                    self.pawn_last_twostep[src.str_] = self.pawn_last_twostep[dst.str_]
+            elif (kind=='two-step-move') or ((kind=='two-step-blocked-move') and (last_measure==0)):
+                self.pawn_last_twostep[dst.str_] = self.current_step
+                if path_empty:
+                    self.pawn_last_twostep.pop(src.str_)
+        elif piece in {'R','K'}:
+            tmp0 = self[src]
+            if (tmp0 is None) or (tmp0[1]<=1-_ZERO_EPS):
+                if (piece=='R') and ((src.file,src.rank) in {(0,0),(7,0)}):
+                    self.tag_wcastling[0 if (src.file) else 1] = False
+                if (piece=='R') and ((src.file,src.rank) in {(0,7),(7,7)}):
+                    self.tag_bcastling[1 if (src.file) else 0] = False
+                if (piece=='K') and ((src.file,src.rank) in {(4,0),(4,7)}):
+                    tmp1 = self.tag_wcastling if self.is_white else self.tag_bcastling
+                    tmp1[0] = False
+                    tmp1[1] = False
+
+    def _make_move(self, piece:str, src, src1, dst, dst1, promotion:str|None=None):
+        src,src1,dst,dst1 = hf_str_none_to_position(src,src1,dst,dst1)
+        kind,path_empty,plan = self._plan_piece_move(piece, src, src1, dst, dst1, promotion, self.get_prefix_measure())
+        for name,kwargs in plan:
+            getattr(self.sim, name)(**kwargs)
+        self._finish_move(piece, kind, src, dst, path_empty)
+
+    def get_hash(self):
+        # position key for transposition table and cache: pieces, amplitudes, castling rights, en passant and turn
+        ret = self.sim.get_hash()
+        for x,y in enumerate(self.tag_wcastling+self.tag_bcastling):
+            if y:
+                ret ^= hf_zobrist_key('castling', x)
+        for x,y in self.pawn_last_twostep.items():
+            if (y is not None) and (y==(self.current_step-1)):
+                ret ^= hf_zobrist_key('en_passant', x)
+        if not self.is_white:
+            ret ^= hf_zobrist_key('turn')
+        return ret
+
+    def set_undo_buffer(self, depth:int=64, max_amplitude:int=2**20):
+        self.undo_buffer = QChessUndoBuffer(depth, max_amplitude)
+
+    def push_undo(self, snapshot=None):
+        # save the current state (or snapshot taken earlier) for undo(), run_short_cmd() calls it automatically
+        if self.undo_buffer.depth>0:
+            self.undo_buffer.push(self.snapshot() if (snapshot is None) else snapshot)
+
+    def undo(self, step:int=1):
+        # return False if the undo buffer is not deep enough, the game is not changed
+        snapshot = self.undo_buffer.pop(step)
+        if snapshot is None:
+            return False
+        self.restore(snapshot)
+        return True
+
+    def run_short_cmd(self, cmd:str|ChessMove, tag_print=True, tag_step=True, tag_undo=True):
+        snapshot = self.snapshot() if (tag_undo and (self.undo_buffer.depth>0)) else None
+        if isinstance(cmd, ChessMove):
+            move = cmd
+            cmd = str(move)
+        else:
+            move = ChessMove.from_str(cmd) #a2b2,c3  a2,b2  e1h1,g1f1  a2,a3,0
+        if move.prefix_measure is not None:
+            self.set_prefix_measure(move.prefix_measure)
+        # the move_*() below work on the interned ChessPosition
+        src,src1,dst,dst1 = hf_str_none_to_position(move.src, move.src1, move.dst, move.dst1)
+        piece = self._get_move_piece(src, src1, dst, dst1)
+        if piece=='castling':
             self.move_castling(src, src1, dst, dst1)
-        elif tag_src[0] in 'Pp':
-            self.move_pawn(src, dst, promotion=promotion)
-        elif tag_src[0] in 'Rr':
+        elif piece=='P':
+            self.move_pawn(src, dst, promotion=move.promotion)
+        elif piece=='R':
             self.move_rook(src, src1, dst, dst1)
-        elif tag_src[0] in 'Bb':
+        elif piece=='B':
             self.move_bishop(src, src1, dst, dst1)
-        elif tag_src[0] in 'Qq':
+        elif piece=='Q':
             self.move_queen(src, src1, dst, dst1)
-        elif tag_src[0] in 'Kk':
+        elif piece=='K':
             self.move_king(src, src1, dst, dst1)
-        elif tag_src[0] in 'Nn':
+        elif piece=='N':
             self.move_knight(src, src1, dst, dst1)
         else:
             raise QChessInvalidCommand(f'invalid src="{src}"')
+        self.truncation_loss.append(self.sim.truncate())
         if tag_print:
             print(self.sim)
         if tag_step:
             self.current_step += 1
         self.set_prefix_measure(None)
-        if args['prefix_measure'] is not None:
+        if move.prefix_measure is not None:
             self.history.append(cmd)
         else:
             self.history.append(cmd + (f',{self.sim.last_measure}' if self.sim.last_measure is not None else ''))
+        if snapshot is not None:
+            self.push_undo(snapshot)
+
+    def set_truncation(self, threshold:float|None=None, max_branch:int|None=None):
+        self.truncation = (threshold, max_branch)
+        self.sim.set_truncation(threshold, max_branch)
+
+    def _get_move_state(self):
+        ret = (self.current_step, list(self.wpawn_last_twostep), list(self.bpawn_last_twostep), dict(self.pawn_last_twostep),
+                list(self.tag_wcastling), list(self.tag_bcastling), self.prefix_measure, len(self.history), len(self.truncation_loss))
+        return ret
+
+    def _set_move_state(self, state):
+        (self.current_step, self.wpawn_last_twostep, self.bpawn_last_twostep, self.pawn_last_twostep,
+                self.tag_wcastling, self.tag_bcastling, self.prefix_measure, tmp0, tmp1) = state
+        del self.history[tmp0:]
+        del self.truncation_loss[tmp1:]
+
+    def push_move(self, cmd):
+        # make a move which can be undone by pop_move(), in time proportional to what the move touched
+        state = self._get_move_state()
+        self.sim.push_journal()
+        try:
+            self.run_short_cmd(cmd, tag_print=False, tag_undo=False)
+        except BaseException:
+            # any failure (not only an invalid command) may leave the move half applied
+            self.sim.pop_journal()
+            self._set_move_state(state)
+            raise
+        self._move_stack.append(state)
+
+    def peek_move(self, cmd):
+        # outcome probabilities of the measurement made by cmd, {0:prob0, 1:prob1} without the impossible outcome
+        # {None:1} if cmd makes no measurement, game is not changed
+        state = self._get_move_state()
+        self.sim.push_journal()
+        self.sim._peek = True
+        try:
+            self.run_short_cmd(cmd, tag_print=False, tag_undo=False)
+            prob1 = None
+        except _QChessPeek as e:
+            prob1 = e.prob1
+        finally:
+            self.sim._peek = False
+            self.sim.pop_journal()
+            self._set_move_state(state)
+        if prob1 is None:
+            return {None:1.0}
+        ret = {x:y for x,y in [(0,1-prob1),(1,prob1)] if y>=_ZERO_EPS}
+        return ret
+
+    def pop_move(self):
+        assert len(self._move_stack)>0, 'no move to pop'
+        self.sim.pop_journal()
+        self._set_move_state(self._move_stack.pop())
 
     def revert_cmd(self, step:int=1):
         assert step>=1
         step = min(step, len(self.history))
-        if step>0:
+        if (step>0) and (not self.undo(step)):
             history = list(self.history)[:(-step)]
+            self.undo_buffer.clear()
             self._reset()
             for x in history:
                 self.run_short_cmd(x, tag_print=False)
@@ -1212,8 +2064,26 @@ class QChessGame:
                     ret += [f'{src.str_}{x.str_},{y.str_}' for y in dst_list if ((x!=y) and hf0(x,y) and (self.is_valid_move_knight(src, x, y, None)!=''))] # merge
         return ret
 
-    def get_all_available_move(self):
-        ret = [y for x in range(64) for y in self._get_all_available_move_i(ChessPosition(x))]
+    def get_all_available_move(self, as_move:bool=False):
+        # same as the concatenation of _get_all_available_move_i() over all squares, see movegen.py
+        # as_move: return ChessMove (with kind) instead of the command string
+        from .movegen import get_all_available_move_bitboard, QChessMoveCache
+        if self._move_cache is None:
+            self._move_cache = QChessMoveCache()
+        ret = get_all_available_move_bitboard(self, as_move=as_move, cache=self._move_cache)
+        return ret
+
+    def iter_available_move(self, order=('capture', 'promotion', 'move', 'split', 'merge'), as_move:bool=False):
+        # lazy get_all_available_move() in priority order, see movegen.iter_available_move_bitboard()
+        from .movegen import iter_available_move_bitboard
+        return iter_available_move_bitboard(self, order, as_move)
+
+    def is_valid_move_batch(self, move_list):
+        # is_valid_move_*() for a list of moves in one pass, see movegen.validate_move_batch()
+        from .movegen import validate_move_batch, QChessMoveCache
+        if self._move_cache is None:
+            self._move_cache = QChessMoveCache()
+        ret = validate_move_batch(self, move_list, cache=self._move_cache)
         return ret
 
     def add_piece(self, pos, tag, reset=False):
@@ -1233,17 +2103,36 @@ class QChessGame:
     def remove_all_piece(self):
         self.sim.remove_all_piece()
 
+    def run_edit_cmd(self, cmd:str):
+        # board edit of the GUI history: 'empty', 'remove,a1', 'add,P,a1', one undo snapshot each like run_short_cmd()
+        # return False if cmd is not an edit (a move for run_short_cmd()), the game is not changed
+        args = cmd.strip().split(',')
+        if args[0] not in {'empty','remove','add'}:
+            return False
+        self.push_undo()
+        if args[0]=='empty':
+            self.add_piece('a1', 'R', reset=True)
+            self.sim.remove_piece(0)
+        elif args[0]=='remove':
+            self.remove_piece(args[1])
+        else:
+            self.add_piece(args[2], args[1])
+        return True
+
     def random_move(self, split_probability_weight, all_move=None, seed=None):
         rng = self.rng if (seed is None) else get_rng(seed)
         if all_move is None:
-            all_move = self.get_all_available_move()
-        assert len(all_move)>0, 'something must be wrong, no move available'
-        prob = np.array([(split_probability_weight if (len(x.split(',',1)[1])==4) else 1) for x in all_move])
-        cmd = rng.choices(all_move, prob/prob.sum())[0]
+            # same move as rng.choices() below, without building all the moves
+            from .movegen import sample_available_move_bitboard
+            cmd = sample_available_move_bitboard(self, rng.random(), split_probability_weight)
+        else:
+            assert len(all_move)>0, 'something must be wrong, no move available'
+            prob = np.array([(split_probability_weight if (len(x.split(',',1)[1])==4) else 1) for x in all_move])
+            cmd = rng.choices(all_move, prob/prob.sum())[0]
         self.run_short_cmd(cmd, tag_print=False)
 
     @staticmethod
-    def rand_qchess(step:int=100, split_probability_weight:float=0.2, seed=None, debug:bool=True):
+    def rand_qchess(step:int=100, split_probability_weight:float=0.2, seed=None, debug:bool=True, backend:str='str'):
         # 20240730 sometimes fail (bug not fixed)
         assert step>=0
         rng = get_rng(seed)
@@ -1251,7 +2140,7 @@ class QChessGame:
             seed = rng.randint(0, 2**32)
             if debug:
                 print(f'seed={seed}') #with seed, the result can be reproduced
-            game = QChessGame(seed=seed)
+            game = QChessGame(seed=seed, backend=backend)
             for _ in range(step):
                 game.random_move(split_probability_weight)
                 if game.is_finish_or_not()!='continue':
@@ -1261,40 +2150,6 @@ class QChessGame:
         return game
 
 
-def _parse_cmd(cmd:str):
-    ret = {
-        'prefix_measure': None, #0,1,None
-        'src': None, #None,str
-        'dst': None, #None,str
-        'src1': None, #None,str
-        'dst1': None, #None,str
-        'promotion': None, #None,str
-    }
-    args = cmd.strip().split(',') #a2b2,c3  a2,b2  e1h1,g1f1  a2,a3,0
-    if len(args)==3:
-        if not args[2] in '01':
-            raise QChessInvalidCommand(f'invalid command="{cmd}"')
-        ret['prefix_measure'] = int(args[2])
-        args = args[:2]
-    if (len(args)!=2) or ((len(args[0]),len(args[1])) not in {(2,2),(2,3),(2,4),(4,2),(4,4)}):
-        raise QChessInvalidCommand(f'invalid command="{cmd}"')
-    ret['src'] = args[0][:2]
-    ret['dst'] = args[1][:2]
-    if len(args[0])==4:
-        ret['src1'] = args[0][2:]
-    if len(args[1])==4:
-        ret['dst1'] = args[1][2:]
-    elif len(args[1])==3:
-        tmp0 = args[1][2]
-        if tmp0.isupper():
-            print('API-change-WARNING: promotion must be lower case')
-            tmp0 = tmp0.lower()
-        if tmp0 not in 'qrbn':
-            raise QChessInvalidCommand(f'invalid command="{cmd}"')
-        ret['promotion'] = tmp0
-    return ret
-
-
 _short_help_message = 'hint: ":quit", ":help", ":random", ":undo", '
 _long_help_message = '''
 :quit     quit
@@ -1366,7 +2221,7 @@ def _run_QChessGame_player(game, config, split_probability_weight):
             except QChessInvalidCommand:
                 print('invalid command')
                 continue
-            if cmd not in game._get_all_available_move_i(src):
+            if cmd not in game.get_all_available_move():
                 print('invalid command')
                 continue
             game.run_short_cmd(cmd, tag_print=False)
@@ -1380,6 +2235,7 @@ def _run_QChessGame_player(game, config, split_probability_weight):
 
 def run_QChessGame(game, mode, split_probability_weight, ai_delay, max_cvc_step):
     game._reset()
+    game.set_undo_buffer()
     print(game)
     config = {'prefix_M':None, 'quit':False, 'mode':mode, 'ai-delay':ai_delay, 'max_cvc_step':max_cvc_step}
     while True:
@@ -68,6 +68,7 @@ class PygameGUI:
         self.font_M = pygame.font.SysFont('consolas', self.FONT_SIZE)
 
         self.game = QChessGame()
+        self.game.set_undo_buffer()
         self.piece_names = ['PAWN', 'ROOK', 'KNIGHT', 'BISHOP', 'QUEEN', 'KING']
         self.pieces = self.game.sim.get_print_board()
         self.candidates = [[(name, is_white, 1.0) for name in self.piece_names] for is_white in [True, False]]
@@ -457,6 +458,7 @@ class PygameGUI:
 
     def restart(self,):
         self.game = QChessGame()
+        self.game.set_undo_buffer()
         self.history = []
         self.pieces = self.game.sim.get_print_board()
         self.selected['src'], self.selected['tag'] = [], []
@@ -484,7 +486,6 @@ class PygameGUI:
 
     def undo(self,):
         if len(self.history) > 0:
-            self.game = QChessGame()
             self.selected['src'], self.selected['tag'] = [], []
 
             if (int(self.black_is_ai) + int(self.white_is_ai)) % 2 == 0:
@@ -497,6 +498,15 @@ class PygameGUI:
             self.append_unicolor_line(' '*37, to_bottum=False)
             text = '-'*8 + (' Undo - Back to Last Step').rjust(7,'-') + '-'*8
             self.append_unicolor_line(text, to_bottum=False)
+            if self.game.undo(len(self.history) - history_len):
+                # served by the snapshot ring buffer, no replay
+                self.pieces = self.game.sim.get_print_board()
+                self.append_whole_board()
+                self.history = self.history[:history_len]
+                return False
+
+            self.game = QChessGame()
+            self.game.set_undo_buffer()
             new_history = []
 
             for idx in range(history_len):
@@ -507,17 +517,13 @@ class PygameGUI:
                     if idx == (history_len - 1):
                         self.pieces = self.game.sim.get_print_board()
                         self.append_unicolor_line('Empty the board', to_bottum=False)
-                    self.game.add_piece('a1','R',reset=True)
-                    self.game.sim.remove_piece(0)
+                    self.game.run_edit_cmd(mov)
                 elif 'remove' in mov:
                     pos_str = mov.split(',')[1]
-                    col = ord(pos_str[0]) - 97
-                    row = int(pos_str[1]) - 1
-                    pos = (col) + 8*(row)
                     if idx == (history_len - 1):
                         self.pieces = self.game.sim.get_print_board()
                         self.append_unicolor_line('Remove a piece from '+pos_str, to_bottum=False)
-                    self.game.sim.remove_piece(pos)
+                    self.game.run_edit_cmd(mov)
                 elif 'add' in mov:
                     alist = mov.split(',')
                     piece = alist[1]
@@ -525,7 +531,7 @@ class PygameGUI:
                     if idx == (history_len - 1):
                         self.pieces = self.game.sim.get_print_board()
                         self.append_unicolor_line('Add a piece '+piece+' to '+pos_str, to_bottum=False)
-                    self.game.add_piece(pos_str, piece)
+                    self.game.run_edit_cmd(mov)
                 else:
                     if idx == (history_len - 1):
                         self.pieces = self.game.sim.get_print_board()
@@ -547,9 +553,8 @@ class PygameGUI:
             self.append_unicolor_line(' '*37, to_bottum=False)
             self.append_next_step_num()
             for (row, col) in self.selected['src']:
-                pos = (col) + 8*(row)
-                self.game.sim.remove_piece(pos)
                 pos_str = chr(col+97) + str(row+1)
+                self.game.run_edit_cmd('remove,'+pos_str)
                 print("Remove "+pos_str)
                 self.history.append('remove,'+pos_str)
                 self.append_unicolor_line('Remove a piece from '+pos_str, to_bottum=False)
@@ -561,9 +566,7 @@ class PygameGUI:
         return False
 
     def empty(self,):
-        self.game = QChessGame()
-        self.game.add_piece('a1','R',reset=True)
-        self.game.sim.remove_piece(0)
+        self.game.run_edit_cmd('empty')
         self.history.append('empty')
         self.append_unicolor_line(' '*37, to_bottum=False)
         self.append_next_step_num()
@@ -582,7 +585,7 @@ class PygameGUI:
                 piece = col_to_piece[col]
                 if row == 1:
                     piece = piece.lower()
-                self.game.add_piece(pos_str, piece)
+                self.game.run_edit_cmd('add,'+piece+','+pos_str)
                 self.history.append('add,'+piece+','+pos_str)
                 self.append_unicolor_line(' '*37, to_bottum=False)
                 self.append_next_step_num()
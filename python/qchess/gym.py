@@ -4,29 +4,18 @@ import gymnasium as gym
 import collections.abc
 
 from .chess_utils import QChessGame
+from .utils import ChessMove
 from .ai import get_greedy_move
 
 _tuple9int = tuple[int,int,int,int,int,int,int,int,int]
 
-def command_to_vector(cmd:str)->_tuple9int:
-    args = cmd.split(',')
-    assert len(args)==2
-    s0:str = args[0]
-    s1:str = args[1]
-    _map = {'a':1, 'b':2, 'c':3, 'd':4, 'e':5, 'f':6, 'g':7, 'h':8}
-    if (len(s0)==2) and (len(s1)==2): #move
-        ret = _map[s0[0]], int(s0[1]), 0, 0, _map[s1[0]], int(s1[1]), 0, 0, 0
-    elif (len(s0)==4) and (len(s1)==2): #merge
-        ret = _map[s0[0]], int(s0[1]), _map[s0[2]], int(s0[3]), _map[s1[0]], int(s1[1]), 0, 0, 0
-    elif (len(s0)==2) and (len(s1)==4): #split
-        ret = _map[s0[0]], int(s0[1]), 0, 0, _map[s1[0]], int(s1[1]), _map[s1[2]], int(s1[3]), 0
-    elif (len(s0)==4) and (len(s1)==4): #castling
-        ret = _map[s0[0]], int(s0[1]), _map[s0[2]], int(s0[3]), _map[s1[0]], int(s1[1]), _map[s1[2]], int(s1[3]), 0
-    elif (len(s0)==2) and (len(s1)==3): #promotion
-        tmp0 = {'r':1, 'n':2, 'b':3, 'q':4}
-        ret = _map[s0[0]], int(s0[1]), 0, 0, _map[s1[0]], int(s1[1]), 0, 0, tmp0[s1[2]]
-    else:
-        raise ValueError('Invalid command')
+def command_to_vector(cmd:str|ChessMove)->_tuple9int:
+    # (src, src1, dst, dst1) as (file+1, rank+1), 0 if not used, promotion rnbq -> 1234
+    if not isinstance(cmd, ChessMove):
+        cmd = ChessMove.from_str(cmd)
+    hf0 = lambda x: (0,0) if (x is None) else (x%8+1, x//8+1)
+    tmp0 = {None:0, 'r':1, 'n':2, 'b':3, 'q':4}
+    ret = hf0(cmd.src) + hf0(cmd.src1) + hf0(cmd.dst) + hf0(cmd.dst1) + (tmp0[cmd.promotion],)
     return ret
 
 def vector_to_command(vec:_tuple9int)->str:
@@ -51,11 +40,7 @@ def vector_to_command(vec:_tuple9int)->str:
 
 
 def game_to_observable(game:QChessGame):
-    correlation = np.zeros((64,64), dtype=np.float64)
-    for k,v in game.sim.coeff.items():
-        tmp0 = np.array([x=='1' for x in k[:64]], dtype=np.bool_)
-        correlation += (abs(v)**2)*(tmp0.reshape(-1,1)*tmp0)
-    correlation = correlation.reshape(8,8,8,8) #(123) (abc) (123) (abc)
+    correlation = game.sim.get_correlation().reshape(8,8,8,8) #(123) (abc) (123) (abc)
     # 0: empty or white, 1: black
     tmp0 = [0 if ((x is None) or x.isupper()) else 1 for x in game.sim.pos2tag[:64]]
     tag_white = np.array(tmp0, dtype=np.int64).reshape(8,8)
@@ -81,6 +66,7 @@ class QChessGameEnv(gym.Env):
         self.observation_space = gym.spaces.Dict({"correlation":tmp0, "tag_white":tmp1, "piece_kind":tmp2})
         self.action_space = gym.spaces.Box(np.zeros(9, dtype=np.int64), np.array([8]*8+[4], dtype=np.int64), shape=(9,), dtype=int)
         self._valid_action_str = None
+        self._valid_action_move = None
 
     def _get_obs(self):
         tmp0 = game_to_observable(self.game)
@@ -89,12 +75,13 @@ class QChessGameEnv(gym.Env):
 
     def get_valid_action(self, kind:str='str'):
         if self._valid_action_str is None:
-            self._valid_action_str = self.game.get_all_available_move()
+            self._valid_action_move = self.game.get_all_available_move(as_move=True)
+            self._valid_action_str = [str(x) for x in self._valid_action_move]
         assert kind in {'str','int'}
         if kind=='str':
             ret = self._valid_action_str
         else:
-            ret = [command_to_vector(x) for x in self._valid_action_str]
+            ret = [command_to_vector(x) for x in self._valid_action_move]
         return ret
 
     def _get_info(self, obs):
@@ -120,12 +107,14 @@ class QChessGameEnv(gym.Env):
         assert cmd in self.get_valid_action('str')
         self.game.run_short_cmd(cmd, tag_print=False)
         self._valid_action_str = None
+        self._valid_action_move = None
 
     def reset(self, seed:(int|None)=None, options:(dict|None)=None):
         super().reset(seed=seed)
         self.game.rng = random.Random(seed)
         self.game._reset()
         self._valid_action_str = None
+        self._valid_action_move = None
         if self.mode=='cvp':
             cmd = self.computer(self.game)
             self._chess_step(cmd)
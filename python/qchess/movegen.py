@@ -0,0 +1,362 @@
+from .utils import SQUARE_STR, KNIGHT_ATTACK, KING_ATTACK, ROOK_RAY, BISHOP_RAY, BETWEEN, hf_bit_list, ChessMove
+from .chess_utils import _ZERO_EPS
+
+# same command strings (and order) as QChessGame._get_all_available_move_i(), but on bitboards (python int, bit i is square i)
+# occupied: possibly occupied, full: certainly occupied, see get_game_bitboard()
+
+_hf_move = lambda x: tuple.__new__(ChessMove, x) #skip the NamedTuple argument handling
+_CASTLING_LIST = [(4,0,2,3), (4,7,6,5), (60,56,58,59), (60,63,62,61)] #e1a1,c1d1 e1h1,g1f1 e8a8,c8d8 e8h8,g8f8
+_SQUARE_INDEX = {y:x for x,y in enumerate(SQUARE_STR)}
+_RAY_FUNCTION = {
+    'n': lambda x: KNIGHT_ATTACK[x],
+    'k': lambda x: KING_ATTACK[x],
+    'r': lambda x: ROOK_RAY[x],
+    'b': lambda x: BISHOP_RAY[x],
+    'q': lambda x: ROOK_RAY[x] | BISHOP_RAY[x],
+}
+
+
+def get_game_bitboard(game):
+    tag_list,prob_list = game.sim.get_marginal_probability()
+    tag_list = [(None if x is None else x[0]) for x in tag_list]
+    occupied = 0
+    full = 0 #probability > 1-eps, blocks a slide
+    full_ge = 0 #probability >= 1-eps, can not be the target of a blocked move
+    tag_square = dict() #tag -> squares with the tag
+    for x,y in enumerate(tag_list):
+        if y is not None:
+            occupied |= 1<<x
+            tag_square[y] = tag_square.get(y, 0) | (1<<x)
+            if prob_list[x]>1-_ZERO_EPS:
+                full |= 1<<x
+            if prob_list[x]>=1-_ZERO_EPS:
+                full_ge |= 1<<x
+    ret = dict(tag=tag_list, prob=prob_list, occupied=occupied, full=full, full_ge=full_ge, tag_square=tag_square)
+    return ret
+
+
+class QChessMoveCache:
+    # per-square move list, reused until a square it depends on changes (tag, full or full_ge)
+    # piece: its rays and the rays of the pieces with the same tag (merge), and any change of a square with the same tag
+    # pawn: the squares ahead and beside it, the en-passant pawn squares are marked as changed when they change
+    # castling is not cached, it also depends on the castling flags
+    # the cache only depends on the board, so it can be shared by copies of a game (see QChessGame.copy())
+    def __init__(self):
+        self.tag = [None]*64 #board when last synced
+        self.full = 0
+        self.full_ge = 0
+        self.en_passant = 0
+        self.tag_mask = dict() #tag -> rays of all the pieces with the tag, see sync()
+        self.move = dict() #src -> [ChessMove list, command string list or None, dependency mask, tag or None]
+        self.num_hit = 0
+        self.num_miss = 0
+
+    def sync(self, game, bitboard):
+        tag_list = bitboard['tag']
+        tmp0 = game.current_step - 1
+        en_passant = 0
+        for x,y in game.pawn_last_twostep.items():
+            if y==tmp0:
+                en_passant |= 1<<_SQUARE_INDEX[x]
+        changed = (en_passant ^ self.en_passant) | (bitboard['full'] ^ self.full) | (bitboard['full_ge'] ^ self.full_ge)
+        tag_changed = set()
+        if tag_list!=self.tag:
+            for x,(y0,y1) in enumerate(zip(tag_list, self.tag)):
+                if y0!=y1:
+                    changed |= 1<<x
+                    tag_changed.add(y0)
+                    tag_changed.add(y1)
+            tag_changed.discard(None) #pawn entry
+            self.tag = list(tag_list)
+            tmp1 = {x:0 for x in tag_changed if x not in 'Pp'}
+            for x,y in enumerate(tag_list):
+                if y in tmp1:
+                    tmp1[y] |= _RAY_FUNCTION[y.lower()](x) | (1<<x)
+            self.tag_mask.update(tmp1)
+        self.full = bitboard['full']
+        self.full_ge = bitboard['full_ge']
+        self.en_passant = en_passant
+        if changed:
+            self.move = {k:v for k,v in self.move.items() if not ((v[2] & changed) or (v[3] in tag_changed))}
+
+    def get(self, game, bitboard, src:int, as_move=True):
+        entry = self.move.get(src, None)
+        if entry is not None:
+            self.num_hit += 1
+        else:
+            self.num_miss += 1
+            tag_list = bitboard['tag']
+            tag = tag_list[src]
+            if tag in 'Pp':
+                mask = KING_ATTACK[src] | (1<<src)
+                if (src//8)==(1 if tag=='P' else 6):
+                    mask |= 1<<(src+(16 if tag=='P' else -16))
+                entry = [_get_pawn_move(game, bitboard, src), None, mask, None]
+            else:
+                entry = [_get_piece_move(game, bitboard, src), None, self.tag_mask[tag], tag]
+            self.move[src] = entry
+        if as_move:
+            ret = entry[0]
+        else:
+            if entry[1] is None:
+                entry[1] = [str(x) for x in entry[0]]
+            ret = entry[1]
+        return ret
+
+
+def _get_piece_target(bitboard, src:int):
+    # (move/capture/blocked moves, non-capturing targets, their mask)
+    tag_list = bitboard['tag']
+    tag = tag_list[src]
+    full = bitboard['full']
+    hf_ray = _RAY_FUNCTION[tag.lower()]
+    # BETWEEN is 0 for the jump (adjacent or not aligned)
+    dst_list = [x for x in hf_bit_list(hf_ray(src)) if (BETWEEN[src][x] & full)==0]
+    ret = []
+    split_list = []
+    split_mask = 0
+    for x in dst_list:
+        tag_dst = tag_list[x]
+        if (tag_dst is None) or (tag_dst==tag):
+            ret.append(_hf_move((src, None, x, None, None, 'move', None)))
+            split_list.append(x)
+            split_mask |= 1<<x
+        elif tag_dst.islower()!=tag.islower():
+            ret.append(_hf_move((src, None, x, None, None, 'capture', None)))
+        elif not ((bitboard['full_ge']>>x)&1):
+            ret.append(_hf_move((src, None, x, None, None, 'blocked', None)))
+    return ret, split_list, split_mask
+
+
+def _get_split_move(src:int, split_list):
+    # pairs of the non-capturing targets
+    ret = [_hf_move((src, None, x, y, None, 'split', None)) for x in split_list for y in split_list if x!=y]
+    return ret
+
+
+def _get_merge_move(bitboard, src:int, split_mask:int):
+    # the non-capturing targets reachable from another square with the same tag
+    tag = bitboard['tag'][src]
+    full = bitboard['full']
+    hf_ray = _RAY_FUNCTION[tag.lower()]
+    ret = []
+    for x in hf_bit_list(bitboard['tag_square'][tag] & ~(1<<src)):
+        ret += [_hf_move((src, x, y, None, None, 'merge', None)) for y in hf_bit_list(split_mask & hf_ray(x))
+                if (BETWEEN[x][y] & full)==0]
+    return ret
+
+
+def _count_merge_move(bitboard, src:int, split_mask:int):
+    # len(_get_merge_move()) without building the moves
+    tag = bitboard['tag'][src]
+    full = bitboard['full']
+    hf_ray = _RAY_FUNCTION[tag.lower()]
+    ret = 0
+    for x in hf_bit_list(bitboard['tag_square'][tag] & ~(1<<src)):
+        tmp0 = split_mask & hf_ray(x)
+        if tag in 'KkNn': #jump, BETWEEN is 0
+            ret += bin(tmp0).count('1')
+        else:
+            ret += sum(1 for y in hf_bit_list(tmp0) if (BETWEEN[x][y] & full)==0)
+    return ret
+
+
+def _get_piece_move(game, bitboard, src:int):
+    ret,split_list,split_mask = _get_piece_target(bitboard, src)
+    ret += _get_split_move(src, split_list)
+    ret += _get_merge_move(bitboard, src, split_mask)
+    return ret
+
+
+def _get_castling_move(game, src:int):
+    ret = [_hf_move((a, b, c, d, None, 'castling', None)) for a,b,c,d in _CASTLING_LIST
+            if (a==src) and game.is_valid_castling(SQUARE_STR[a], SQUARE_STR[b], SQUARE_STR[c], SQUARE_STR[d])!='']
+    return ret
+
+
+def _get_pawn_move(game, bitboard, src:int):
+    tag_list = bitboard['tag']
+    prob_list = bitboard['prob']
+    is_white = tag_list[src]=='P'
+    file,rank = src%8, src//8
+    assert rank!=(7 if is_white else 0)
+    step = 1 if is_white else -1
+    ret = []
+    tmp0 = [(x, rank+step) for x in range(max(0,file-1), min(7,file+1)+1)]
+    if rank==(1 if is_white else 6):
+        tmp0.append((file, rank+2*step))
+    for x,y in tmp0:
+        dst = x + 8*y
+        tag_dst = tag_list[dst]
+        if x==file:
+            if y==rank+step: #one-step, blocked if not empty
+                kind = 'move' if (tag_dst is None) else 'blocked'
+                is_valid = (tag_dst is None) or (prob_list[dst]<=1-_ZERO_EPS)
+            else: #two-step
+                kind = 'move' if ((tag_dst is None) or (tag_dst==tag_list[src])) else 'blocked'
+                tmp1 = src + 8*step
+                is_valid = (((tag_list[tmp1] is None) or (prob_list[tmp1]<=1-_ZERO_EPS))
+                        and ((tag_dst is None) or (prob_list[dst]<=1-_ZERO_EPS)))
+        elif tag_dst is not None:
+            kind = 'capture'
+            is_valid = tag_dst.islower()==is_white
+        else:
+            kind = 'en-passant'
+            tmp1 = x + 8*rank
+            is_valid = ((tag_list[tmp1]==('p' if is_white else 'P'))
+                    and (game.pawn_last_twostep.get(SQUARE_STR[tmp1])==(game.current_step-1)))
+        if is_valid:
+            if y==(7 if is_white else 0):
+                ret += [_hf_move((src, None, dst, None, z, kind, None)) for z in 'qrbn']
+            else:
+                ret.append(_hf_move((src, None, dst, None, None, kind, None)))
+    return ret
+
+
+def get_all_available_move_bitboard(game, src_list=None, as_move=False, cache=None):
+    # as_move: return ChessMove instead of the command string
+    # cache: QChessMoveCache, None to generate every piece from scratch
+    bitboard = get_game_bitboard(game)
+    tag_list = bitboard['tag']
+    is_white = game.is_white
+    if cache is not None:
+        cache.sync(game, bitboard)
+    ret = []
+    for x in (range(64) if (src_list is None) else src_list):
+        tag = tag_list[x]
+        if (tag is None) or (tag.isupper()!=is_white):
+            continue
+        if cache is not None:
+            ret += cache.get(game, bitboard, x, as_move)
+            if (tag in 'Kk') and (x in (4,60)):
+                tmp0 = _get_castling_move(game, x)
+                ret += tmp0 if as_move else [str(y) for y in tmp0]
+            continue
+        if tag in 'Pp':
+            ret += _get_pawn_move(game, bitboard, x)
+        else:
+            ret += _get_piece_move(game, bitboard, x)
+        if (tag in 'Kk') and (x in (4,60)):
+            ret += _get_castling_move(game, x)
+    if (not as_move) and (cache is None):
+        ret = [str(x) for x in ret]
+    return ret
+
+
+MOVE_ORDER = ('capture', 'promotion', 'move', 'split', 'merge')
+
+
+def _get_move_phase(move, rank:dict):
+    # the first phase in the order the move belongs to, None if it is not requested
+    tmp0 = []
+    if move.promotion is not None:
+        tmp0.append('promotion')
+    if move.kind in ('capture', 'en-passant'):
+        tmp0.append('capture')
+    elif move.kind in ('move', 'blocked', 'castling'):
+        tmp0.append('move')
+    tmp0 = [x for x in tmp0 if x in rank]
+    ret = min(tmp0, key=rank.get) if tmp0 else None
+    return ret
+
+
+def iter_available_move_bitboard(game, order=MOVE_ORDER, as_move=False):
+    # yield the moves phase by phase, a phase is generated only when it is reached
+    # order: subset of MOVE_ORDER, castling is a 'move', a capturing promotion goes to whichever comes first
+    # in each phase the moves are in the same relative order as get_all_available_move_bitboard()
+    # the game must not change between two steps (push_move() and pop_move() around each move is fine)
+    assert all(x in MOVE_ORDER for x in order)
+    bitboard = get_game_bitboard(game)
+    tag_list = bitboard['tag']
+    is_white = game.is_white
+    src_list = [x for x,y in enumerate(tag_list) if (y is not None) and (y.isupper()==is_white)]
+    rank = {x:i for i,x in enumerate(order)}
+    hf0 = (lambda x: x) if as_move else str
+    target = dict() #src -> ([(move, phase)], non-capturing targets, their mask), see _get_piece_target()
+    def hf_target(x):
+        if x not in target:
+            if tag_list[x] in 'Pp':
+                tmp0 = _get_pawn_move(game, bitboard, x), [], 0
+            else:
+                tmp0 = _get_piece_target(bitboard, x)
+            if (tag_list[x] in 'Kk') and (x in (4,60)):
+                tmp0[0].extend(_get_castling_move(game, x))
+            target[x] = [(y, _get_move_phase(y, rank)) for y in tmp0[0]], tmp0[1], tmp0[2]
+        return target[x]
+    for phase in order:
+        for x in src_list:
+            if phase in ('capture', 'promotion', 'move'):
+                for y,z in hf_target(x)[0]:
+                    if z==phase:
+                        yield hf0(y)
+            elif tag_list[x] not in 'Pp':
+                _,split_list,split_mask = hf_target(x)
+                tmp0 = _get_split_move(x, split_list) if (phase=='split') else _get_merge_move(bitboard, x, split_mask)
+                for y in tmp0:
+                    yield hf0(y)
+
+
+def sample_available_move_bitboard(game, u:float, split_weight:float=1.0, as_move=False):
+    # the move rng.choices(all_move, weight) picks with rng.random()==u, without building all_move
+    # weight: split_weight for split and castling (two target squares), 1 for the others
+    # each piece only counts its split and merge moves, only the picked one is built
+    bitboard = get_game_bitboard(game)
+    tag_list = bitboard['tag']
+    is_white = game.is_white
+    group_list = [] #(number of moves, weight of each, hf_build(index)) in the order of get_all_available_move_bitboard()
+    for x,tag in enumerate(tag_list):
+        if (tag is None) or (tag.isupper()!=is_white):
+            continue
+        if tag in 'Pp':
+            tmp0 = _get_pawn_move(game, bitboard, x)
+            group_list.append((len(tmp0), 1, tmp0.__getitem__))
+        else:
+            base,split_list,split_mask = _get_piece_target(bitboard, x)
+            group_list.append((len(base), 1, base.__getitem__))
+            tmp0 = len(split_list)
+            hf0 = lambda i,x=x,y=split_list,n=tmp0-1: _hf_move((x, None, y[i//n], y[i%n+(i%n>=i//n)], None, 'split', None))
+            group_list.append((tmp0*(tmp0-1), split_weight, hf0))
+            hf1 = lambda i,x=x,y=split_mask: _get_merge_move(bitboard, x, y)[i]
+            group_list.append((_count_merge_move(bitboard, x, split_mask), 1, hf1))
+        if (tag in 'Kk') and (x in (4,60)):
+            tmp0 = _get_castling_move(game, x)
+            group_list.append((len(tmp0), split_weight, tmp0.__getitem__))
+    group_list = [x for x in group_list if (x[0]>0) and (x[1]>0)]
+    assert len(group_list)>0, 'something must be wrong, no move available'
+    target = u*sum(x[0]*x[1] for x in group_list)
+    for num,weight,hf_build in group_list:
+        if target<num*weight:
+            break
+        target -= num*weight
+    ret = hf_build(min(int(target/weight), num-1)) #the last group for the rounding at the upper end
+    if not as_move:
+        ret = str(ret)
+    return ret
+
+
+def _get_validator_kind(tag:str, move):
+    # ChessMove.kind -> the kind returned by QChessGame.is_valid_move_*()
+    kind = move.kind
+    if kind in ('move', 'blocked'):
+        if tag in 'Pp':
+            tmp0 = 'one-step' if abs(move.dst-move.src)==8 else 'two-step'
+            ret = tmp0 + ('-move' if (kind=='move') else '-blocked-move')
+        else:
+            ret = ('normal-' if (kind=='move') else 'blocked-') + ('jump' if (tag in 'KkNn') else 'slide')
+    else:
+        ret = kind
+    return ret
+
+
+def validate_move_batch(game, move_list, cache=None):
+    # same kind as QChessGame.is_valid_move_*() for each move ('' if invalid), all checked on one board snapshot
+    # move_list: command string or ChessMove, prefix_measure is ignored
+    tmp0 = {x[:5]:x for x in get_all_available_move_bitboard(game, as_move=True, cache=cache)}
+    pos2tag = game.sim.pos2tag
+    ret = []
+    for x in move_list:
+        if not isinstance(x, ChessMove):
+            x = ChessMove.from_str(x)
+        x = tmp0.get(x[:5], None)
+        ret.append('' if (x is None) else _get_validator_kind(pos2tag[x.src], x))
+    return ret
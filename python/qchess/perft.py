@@ -0,0 +1,146 @@
+import time
+
+from .utils import ChessPosition, QChessInvalidCommand
+from .chess_utils import QChessGame, _ZERO_EPS
+from .movegen import get_all_available_move_bitboard
+
+# perft: number of leaf nodes of the legal move tree, for regression check and move generation throughput
+# a measured move is followed by its more likely outcome, or by both outcomes (prefix measure ,0 ,1) if measure_branch
+# finished games (king captured) are leaves with no move
+
+PERFT_GENERATOR = {
+    'cache': lambda game: game.get_all_available_move(),
+    'bitboard': lambda game: get_all_available_move_bitboard(game),
+    'iter': lambda game: list(game.iter_available_move()),
+    'reference': lambda game: [y for x in range(64) for y in game._get_all_available_move_i(ChessPosition(x))],
+}
+
+
+def _get_rng_state(game):
+    # pop_move() does not rewind the random number generator which push_move() samples the measurement with
+    ret = [(game.rng, game.rng.getstate())]
+    if game.sim.rng is not game.rng:
+        ret.append((game.sim.rng, game.sim.rng.getstate()))
+    return ret
+
+
+def _set_rng_state(rng_state):
+    for rng,state in rng_state:
+        rng.setstate(state)
+
+
+def _perft_move(game, cmd:str, depth:int, measure_branch:bool, hf_move, stats:dict):
+    # leaf nodes below cmd, depth counts cmd itself, game (including its rng) is restored after every pop_move()
+    rng_state = _get_rng_state(game)
+    try:
+        game.push_move(cmd)
+    except QChessInvalidCommand:
+        _set_rng_state(rng_state)
+        stats['invalid'].append(' '.join(game.history + [cmd]))
+        return 0
+    prob1 = game.sim.last_measure1_prob
+    if (game.sim.last_measure is None) or (prob1<_ZERO_EPS) or (prob1>1-_ZERO_EPS):
+        outcome_list = []
+    elif measure_branch:
+        outcome_list = [0, 1]
+    else:
+        outcome_list = [int(prob1>=0.5)]
+    if (len(outcome_list)==0) or (outcome_list==[game.sim.last_measure]):
+        ret = _perft(game, depth-1, measure_branch, hf_move, stats)
+        game.pop_move()
+        _set_rng_state(rng_state)
+        return ret
+    game.pop_move()
+    _set_rng_state(rng_state)
+    ret = 0
+    for x in outcome_list:
+        game.push_move(f'{cmd},{x}')
+        ret += _perft(game, depth-1, measure_branch, hf_move, stats)
+        game.pop_move()
+        _set_rng_state(rng_state)
+    return ret
+
+
+def _perft(game, depth:int, measure_branch:bool, hf_move, stats:dict):
+    if depth==0:
+        return 1
+    if game.is_finish_or_not()!='continue':
+        return 0
+    move_list = hf_move(game)
+    stats['generate'] += 1
+    if (depth==1) and (not measure_branch): #bulk counting
+        return len(move_list)
+    ret = sum(_perft_move(game, x, depth, measure_branch, hf_move, stats) for x in move_list)
+    return ret
+
+
+def perft(game, depth:int, measure_branch:bool=False, generator:str='cache', stats:dict|None=None):
+    # dict[root move -> number of leaf nodes] (perft divide), game is not changed (the rng state included)
+    # stats: filled with 'generate' (number of move generation calls), 'invalid' (generated moves which fail to run)
+    assert depth>=1
+    hf_move = PERFT_GENERATOR[generator]
+    if stats is None:
+        stats = dict()
+    stats['generate'] = 0
+    stats['invalid'] = []
+    ret = dict()
+    if game.is_finish_or_not()=='continue':
+        for x in hf_move(game):
+            ret[x] = _perft_move(game, x, depth, measure_branch, hf_move, stats)
+        stats['generate'] += 1
+    return ret
+
+
+def diff_perft(ret0:dict, ret1:dict):
+    # root moves whose counts differ: [(move, count0, count1)], None if the move is missing
+    ret = [(x, ret0.get(x), ret1.get(x)) for x in sorted(set(ret0)|set(ret1)) if ret0.get(x)!=ret1.get(x)]
+    return ret
+
+
+def _run_perft(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='qchess perft', description='count the legal move tree (perft) and report nodes/sec')
+    parser.add_argument('--depth', type=int, default=3, help='depth of the move tree')
+    parser.add_argument('--history', type=str, action='append', default=[], help='history file of the position, can be repeated')
+    parser.add_argument('--moves', type=str, action='append', default=[], help='space separated commands of the position, can be repeated')
+    parser.add_argument('--measure-branch', action='store_true', help='follow both measurement outcomes instead of the more likely one')
+    parser.add_argument('--generator', type=str, default='cache', choices=list(PERFT_GENERATOR.keys()))
+    parser.add_argument('--diff', type=str, default=None, choices=list(PERFT_GENERATOR.keys()), help='compare the counts with another generator')
+    parser.add_argument('--backend', type=str, default='str', choices=['str', 'int', 'numpy', 'factor'])
+    parser.add_argument('--divide', action='store_true', help='print the count of each root move')
+    args = parser.parse_args(argv)
+
+    position_list = []
+    for x in args.history:
+        with open(x, 'r') as fid:
+            position_list.append((x, [y.strip() for y in fid.readlines() if y.strip()]))
+    position_list += [(x, x.split()) for x in args.moves]
+    if len(position_list)==0:
+        position_list.append(('start', []))
+    is_same = True
+    for name,history in position_list:
+        game = QChessGame(seed=0, backend=args.backend)
+        for x in history:
+            game.run_short_cmd(x, tag_print=False, tag_undo=False)
+        generator_list = [args.generator] + ([args.diff] if (args.diff is not None) else [])
+        ret = []
+        for generator in generator_list:
+            stats = dict()
+            t0 = time.time()
+            ret.append(perft(game, args.depth, args.measure_branch, generator, stats))
+            t0 = time.time() - t0
+            num_node = sum(ret[-1].values())
+            print(f'[{name}] generator={generator} depth={args.depth} nodes={num_node} time={t0:.3f}s'
+                    f' nodes/sec={num_node/max(t0,1e-9):.0f} generate/sec={stats["generate"]/max(t0,1e-9):.0f}')
+            for x in stats['invalid']:
+                print(f'  invalid move: {x}')
+            if args.divide:
+                for x,y in ret[-1].items():
+                    print(f'  {x}: {y}')
+        if len(ret)==2:
+            tmp0 = diff_perft(ret[0], ret[1])
+            for x,y,z in tmp0:
+                print(f'  diff {x}: {args.generator}={y} {args.diff}={z}')
+            print(f'[{name}] diff {args.generator} vs {args.diff}: {"OK" if (len(tmp0)==0) else "FAIL"}')
+            is_same = is_same and (len(tmp0)==0)
+    return 0 if is_same else 1
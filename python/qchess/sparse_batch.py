@@ -0,0 +1,841 @@
+import numpy as np
+
+from .utils import (QChessInvalidCommand, ChessMove, get_rng, SQUARE_STR, KNIGHT_ATTACK, KING_ATTACK, ROOK_RAY, BISHOP_RAY, BETWEEN)
+from .chess_utils import QChessGame, QChessSparseSimulator, QChessUndoBuffer, _ZERO_EPS
+from .sparse_numpy import QChessSparseSimulatorNumpy, hf_uint64_to_bitarray, _U64_ONE, _U64_ZERO, _MAX_QUBIT
+from .movegen import _CASTLING_LIST
+
+# tag code of QChessSparseSimulatorBatch.pos2tag, piece type (code-1)%6+1: 1 pawn, 2 knight, 3 bishop, 4 rook, 5 queen, 6 king
+_TAG_LIST = (None, 'P', 'N', 'B', 'R', 'Q', 'K', 'p', 'n', 'b', 'r', 'q', 'k')
+_TAG_CODE = {x:i for i,x in enumerate(_TAG_LIST)}
+
+
+def hf_merge_duplicate_key_game(game, basis, basis_anc, amplitude):
+    # hf_merge_duplicate_key() with the game index as the leading key, the result is sorted by game
+    if game.shape[0]==0:
+        return game, basis, basis_anc, amplitude
+    ind0 = np.lexsort((basis, basis_anc, game))
+    game = game[ind0]
+    basis = basis[ind0]
+    basis_anc = basis_anc[ind0]
+    amplitude = amplitude[ind0]
+    tmp0 = np.ones(basis.shape[0], dtype=np.bool_)
+    tmp0[1:] = (game[1:]!=game[:-1]) | (basis[1:]!=basis[:-1]) | (basis_anc[1:]!=basis_anc[:-1])
+    ind1 = np.nonzero(tmp0)[0]
+    game = game[ind1]
+    basis = basis[ind1]
+    basis_anc = basis_anc[ind1]
+    amplitude = np.add.reduceat(amplitude, ind1)
+    tmp1 = (amplitude.real*amplitude.real + amplitude.imag*amplitude.imag) >= _ZERO_EPS
+    return game[tmp1], basis[tmp1], basis_anc[tmp1], amplitude[tmp1]
+
+
+def hf_position_mask(pos_list):
+    # squares -> uint64 bit mask, for the control (path) argument
+    ret = 0
+    for x in pos_list:
+        ret |= 1<<int(x)
+    return ret
+
+
+class QChessSparseSimulatorBatch:
+    # num_game independent QChessSparseSimulatorNumpy states in shared arrays, one row per (game, basis key), rows sorted by game
+    # game(int64), basis(uint64): qubit 0-63, basis_anc(uint64): ancilla qubit 64-127, amplitude(complex128)
+    # pos2tag: (num_game,128) int8 tag code, 0 for None, see _TAG_LIST
+    # every gate takes per-game arguments of shape (num_game,) and an active mask, the other games are not changed
+    # control/negate_control: per-game bit mask, (num_game,) uint64 of the squares or (num_game,2) uint64 of (squares, ancilla)
+    # the argument checks of QChessSparseSimulator are left to the caller (see QChessGameBatch), truncation is not supported
+    def __init__(self, num_game:int, state0:int=0xFFFF00000000FFFF, tag_list='RNBQKBNRPPPPPPPPpppppppprnbqkbnr', seed=None):
+        assert num_game>=1
+        sim0 = QChessSparseSimulator(state0, tag_list)
+        self.num_game = num_game
+        self.game = np.arange(num_game, dtype=np.int64)
+        self.basis = np.full(num_game, state0, dtype=np.uint64)
+        self.basis_anc = np.zeros(num_game, dtype=np.uint64)
+        self.amplitude = np.ones(num_game, dtype=np.complex128)
+        self.pos2tag = np.zeros((num_game, _MAX_QUBIT), dtype=np.int8)
+        self.pos2tag[:,:64] = [_TAG_CODE[x] for x in sim0.pos2tag]
+        self.num_qubit = np.full(num_game, 64, dtype=np.int64)
+        self.rng = get_rng(seed)
+        self.np_rng = np.random.default_rng(self.rng.getrandbits(64)) #measurement of all the games in one call
+        self.last_measure = np.full(num_game, -1, dtype=np.int64) #-1 for None
+        self.last_measure1_prob = np.full(num_game, np.nan)
+
+    @classmethod
+    def from_sim_list(cls, sim_list, seed=None):
+        assert all(isinstance(x, QChessSparseSimulatorNumpy) for x in sim_list)
+        ret = cls(len(sim_list), seed=seed)
+        ret.game = np.concatenate([np.full(x.basis.shape[0], i, dtype=np.int64) for i,x in enumerate(sim_list)])
+        ret.basis = np.concatenate([x.basis for x in sim_list])
+        ret.basis_anc = np.concatenate([x.basis_anc for x in sim_list])
+        ret.amplitude = np.concatenate([x.amplitude for x in sim_list])
+        ret.pos2tag[:] = 0
+        for i,x in enumerate(sim_list):
+            ret.pos2tag[i,:len(x.pos2tag)] = [_TAG_CODE[y] for y in x.pos2tag]
+            ret.num_qubit[i] = len(x.pos2tag)
+        return ret
+
+    def get_sim(self, index:int):
+        # copy of one game as QChessSparseSimulatorNumpy
+        ret = QChessSparseSimulatorNumpy(seed=self.rng.randint(0, 2**32))
+        tmp0 = self.game==index
+        ret.basis = self.basis[tmp0]
+        ret.basis_anc = self.basis_anc[tmp0]
+        ret.amplitude = self.amplitude[tmp0]
+        ret.pos2tag = [_TAG_LIST[x] for x in self.pos2tag[index,:self.num_qubit[index]]]
+        ret._probability = ret._compute_probability_all()
+        return ret
+
+    def get_num_amplitude(self):
+        # (num_game,) number of basis keys of each game
+        ret = np.bincount(self.game, minlength=self.num_game)
+        return ret
+
+    @staticmethod
+    def _hf_abs2(amplitude):
+        return amplitude.real*amplitude.real + amplitude.imag*amplitude.imag
+
+    def _hf_active(self, active):
+        if active is None:
+            return np.ones(self.num_game, dtype=np.bool_)
+        return np.asarray(active, dtype=np.bool_)
+
+    def _get_offset(self):
+        # every game has at least one row
+        return np.searchsorted(self.game, np.arange(self.num_game))
+
+    def _bit(self, index):
+        # (num_game,) qubit index -> (num_row,) bool
+        index = np.asarray(index, dtype=np.int64)[self.game]
+        tmp0 = np.where(index<64, self.basis, self.basis_anc)
+        ret = ((tmp0 >> (index & 63).astype(np.uint64)) & _U64_ONE).astype(np.bool_)
+        return ret
+
+    def _hf_control(self, mask):
+        # (num_game,) or (num_game,2) uint64 mask -> (num_row,) bool, any bit of the mask is 1
+        mask = np.asarray(mask, dtype=np.uint64)
+        if mask.ndim==1:
+            ret = (self.basis & mask[self.game]) != _U64_ZERO
+        else:
+            tmp0 = mask[self.game]
+            ret = ((self.basis & tmp0[:,0]) | (self.basis_anc & tmp0[:,1])) != _U64_ZERO
+        return ret
+
+    def _reduce_game(self, x):
+        return np.add.reduceat(x, self._get_offset())
+
+    def _get_probability_i(self, index):
+        # (num_game,) probability of qubit index[i] in game i
+        prob = self._hf_abs2(self.amplitude)
+        ret = np.clip(self._reduce_game(np.where(self._bit(index), prob, 0)), 0, 1)
+        return ret
+
+    def _is_occupied_i(self, index):
+        return np.logical_or.reduceat(self._bit(index), self._get_offset())
+
+    def _get_occupied(self):
+        # (num_game,128) bool, the qubit is 1 in at least one basis key
+        offset = self._get_offset()
+        tmp0 = hf_uint64_to_bitarray(np.bitwise_or.reduceat(self.basis, offset), 64)
+        tmp1 = hf_uint64_to_bitarray(np.bitwise_or.reduceat(self.basis_anc, offset), 64)
+        ret = np.concatenate([tmp0, tmp1], axis=1).astype(np.bool_)
+        return ret
+
+    def _hf_marginal(self, basis):
+        # (num_game,64) marginal probability of the 64 qubits in basis (self.basis or self.basis_anc)
+        prob = self._hf_abs2(self.amplitude)
+        ret = np.add.reduceat(hf_uint64_to_bitarray(basis, 64)*prob[:,np.newaxis], self._get_offset(), axis=0)
+        return ret
+
+    def get_marginal_probability(self):
+        # (num_game,128) marginal probability, 0 beyond num_qubit
+        ret = np.concatenate([self._hf_marginal(self.basis), self._hf_marginal(self.basis_anc)], axis=1)
+        return ret
+
+    def get_square_probability(self):
+        # (num_game,64) marginal probability of the squares, get_marginal_probability()[:,:64] without the ancilla qubits
+        return self._hf_marginal(self.basis)
+
+    def _get_active_row(self, src, dst, control, negate_control, active):
+        ret = active[self.game] & (self._bit(src) ^ self._bit(dst))
+        if control is not None:
+            ret &= ~self._hf_control(control)
+        if negate_control is not None:
+            ret &= self._hf_control(negate_control)
+        return ret
+
+    def _get_swap_mask(self, src, dst):
+        # per-game xor mask on (basis,basis_anc) to flip both src and dst
+        hf0 = lambda x,y: np.where(y, _U64_ONE << (x & 63).astype(np.uint64), _U64_ZERO)
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        mask0 = hf0(src, src<64) | hf0(dst, dst<64)
+        mask1 = hf0(src, src>=64) | hf0(dst, dst>=64)
+        return mask0, mask1
+
+    def _get_tag_src_dst(self, src, dst):
+        ind0 = np.arange(self.num_game)
+        tmp0 = self.pos2tag[ind0, src]
+        ret = np.where(tmp0!=0, tmp0, self.pos2tag[ind0, dst])
+        return ret
+
+    def _update_pos2tag_src_dst(self, src, dst, tag, active):
+        ind0 = np.nonzero(active)[0]
+        for x in [src, dst]:
+            tmp0 = self._is_occupied_i(x)[ind0]
+            self.pos2tag[ind0, np.asarray(x)[ind0]] = np.where(tmp0, tag[ind0], 0)
+
+    def apply_iswap(self, src, dst, control=None, negate_control=None, tag_inverse=False, active=None):
+        active = self._hf_active(active)
+        tag = self._get_tag_src_dst(src, dst)
+        row = self._get_active_row(src, dst, control, negate_control, active)
+        mask0,mask1 = self._get_swap_mask(src, dst)
+        self.basis = np.where(row, self.basis ^ mask0[self.game], self.basis)
+        self.basis_anc = np.where(row, self.basis_anc ^ mask1[self.game], self.basis_anc)
+        self.amplitude = np.where(row, self.amplitude*(-1j if tag_inverse else 1j), self.amplitude)
+        self._update_pos2tag_src_dst(src, dst, tag, active)
+
+    def apply_sqrtiswap(self, src, dst, control=None, negate_control=None, tag_inverse=False, active=None):
+        active = self._hf_active(active)
+        tag = self._get_tag_src_dst(src, dst)
+        row = self._get_active_row(src, dst, control, negate_control, active)
+        mask0,mask1 = self._get_swap_mask(src, dst)
+        s12 = 1/np.sqrt(2)
+        phase = (-1j*s12) if tag_inverse else (1j*s12)
+        # only the active keys of the same game can collide with each other
+        game0 = self.game[row]
+        basis0 = self.basis[row]
+        basis_anc0 = self.basis_anc[row]
+        amplitude0 = self.amplitude[row]
+        tmp0 = np.concatenate([game0, game0])
+        tmp1 = np.concatenate([basis0, basis0 ^ mask0[game0]])
+        tmp2 = np.concatenate([basis_anc0, basis_anc0 ^ mask1[game0]])
+        tmp3 = np.concatenate([amplitude0*s12, amplitude0*phase])
+        tmp0,tmp1,tmp2,tmp3 = hf_merge_duplicate_key_game(tmp0, tmp1, tmp2, tmp3)
+        inactive = ~row
+        game = np.concatenate([self.game[inactive], tmp0])
+        ind0 = np.argsort(game, kind='stable')
+        self.game = game[ind0]
+        self.basis = np.concatenate([self.basis[inactive], tmp1])[ind0]
+        self.basis_anc = np.concatenate([self.basis_anc[inactive], tmp2])[ind0]
+        self.amplitude = np.concatenate([self.amplitude[inactive], tmp3])[ind0]
+        self._update_pos2tag_src_dst(src, dst, tag, active)
+
+    def change_tag(self, index, label, active=None):
+        # label: (num_game,) tag code
+        active = self._hf_active(active)
+        ind0 = np.nonzero(active)[0]
+        assert np.all(self.pos2tag[ind0, np.asarray(index)[ind0]]!=0)
+        self.pos2tag[ind0, np.asarray(index)[ind0]] = np.asarray(label)[ind0]
+
+    def _drop_row(self, drop, active):
+        # QChessSparseSimulatorNumpy.drop_coeff() for the active games
+        keep = ~drop
+        assert np.bincount(self.game[keep], minlength=self.num_game).min()>0, 'zero probability'
+        self.game = self.game[keep]
+        self.basis = self.basis[keep]
+        self.basis_anc = self.basis_anc[keep]
+        amplitude = self.amplitude[keep]
+        tmp0 = np.sqrt(np.add.reduceat(self._hf_abs2(amplitude), self._get_offset()))
+        self.amplitude = amplitude / tmp0[self.game]
+        tmp1 = active[:,np.newaxis] & ~self._get_occupied()
+        self.pos2tag[tmp1] = 0
+
+    def add_ancilla(self, active=None):
+        # (num_game,) index of the new ancilla qubit (in state 0) of the active games
+        active = self._hf_active(active)
+        ret = np.minimum(self.num_qubit, _MAX_QUBIT-1) #any valid index for the other games
+        assert (self.num_qubit[active].max(initial=0)+1) <= _MAX_QUBIT, 'too many ancilla qubits'
+        self.pos2tag[active, ret[active]] = 0
+        self.num_qubit[active] += 1
+        return ret
+
+    def drop_ancilla(self, index, active=None):
+        # (num_game,) ancilla index, must be in a definite state
+        active = self._hf_active(active)
+        index = np.asarray(index, dtype=np.int64)
+        assert np.all(index[active]>=64)
+        row = active[self.game]
+        x = (index[self.game] - 64).astype(np.uint64)
+        low = self.basis_anc & ((_U64_ONE << x) - _U64_ONE)
+        high = np.where(x<63, (self.basis_anc >> np.minimum(x+_U64_ONE, np.uint64(63))) << x, _U64_ZERO)
+        self.basis_anc = np.where(row, low | high, self.basis_anc)
+        for i in np.nonzero(active)[0]:
+            self.pos2tag[i, index[i]:-1] = self.pos2tag[i, (index[i]+1):]
+            self.pos2tag[i, -1] = 0
+        self.num_qubit[active] -= 1
+
+    def get_free_ancilla(self, active=None):
+        # (num_game,) ancilla index of the active games, a free ancilla (pos2tag is None) is reused before add_ancilla()
+        active = self._hf_active(active)
+        tmp0 = (self.pos2tag[:,64:]==0) & (np.arange(64, _MAX_QUBIT) < self.num_qubit[:,np.newaxis])
+        is_free = tmp0.any(axis=1)
+        ret = self.add_ancilla(active & ~is_free)
+        ret = np.where(is_free, 64+tmp0.argmax(axis=1), ret)
+        return ret
+
+    def release_ancilla(self, index, active=None):
+        # (num_game,) ancilla index in a definite state, reset to 0 without shifting the keys, see get_free_ancilla()
+        active = self._hf_active(active)
+        index = np.asarray(index, dtype=np.int64)
+        assert np.all(index[active]>=64)
+        prob = self._get_probability_i(index)
+        tmp0 = active & (prob>0.5)
+        tmp1 = _U64_ONE << (index[self.game] & 63).astype(np.uint64)
+        self.basis_anc = np.where(tmp0[self.game], self.basis_anc ^ tmp1, self.basis_anc)
+        tmp2 = active & ~tmp0 & self._is_occupied_i(index)
+        if tmp2.any():
+            self._drop_row(tmp2[self.game] & self._bit(index), tmp2)
+        self.pos2tag[np.nonzero(active)[0], index[active]] = 0
+
+    def _release_definite_ancilla(self, active):
+        # an ancilla in use with the same value in every key goes back to the pool, then the free ones at the end are removed
+        tmp0 = active & (self.num_qubit>64)
+        if not tmp0.any():
+            return
+        offset = self._get_offset()
+        key_or = hf_uint64_to_bitarray(np.bitwise_or.reduceat(self.basis_anc, offset), 64)
+        key_and = hf_uint64_to_bitarray(np.bitwise_and.reduceat(self.basis_anc, offset), 64)
+        tmp1 = tmp0[:,np.newaxis] & (key_or==key_and) & (self.pos2tag[:,64:]!=0)
+        for x in range(64, _MAX_QUBIT):
+            if tmp1[:,x-64].any():
+                self.release_ancilla(np.full(self.num_game, x), tmp1[:,x-64])
+        tmp2 = self.pos2tag[:,64:]!=0
+        num_qubit = np.where(tmp2.any(axis=1), _MAX_QUBIT - tmp2[:,::-1].argmax(axis=1), 64)
+        self.num_qubit = np.where(tmp0, num_qubit, self.num_qubit)
+
+    def _is_definite_one_i(self, index):
+        # (num_game,) the qubit is 1 in every key
+        return np.logical_and.reduceat(self._bit(index), self._get_offset())
+
+    def _clear_definite_qubit(self, index, phase, active):
+        # (num_game,) square which is 1 in every key of the active games, set it to 0 and multiply the phase
+        index = np.asarray(index, dtype=np.int64)
+        row = active[self.game]
+        self.basis = np.where(row, self.basis ^ (_U64_ONE << index.astype(np.uint64))[self.game], self.basis)
+        self.amplitude = np.where(row, self.amplitude*phase, self.amplitude)
+        self.pos2tag[np.nonzero(active)[0], index[active]] = 0
+
+    def _hf_measure_result(self, prob, fix, active, is_definite):
+        fix = np.full(self.num_game, -1) if (fix is None) else np.asarray(fix)
+        ret = np.where(fix>=0, fix, (self.np_rng.random(self.num_game)<prob).astype(np.int64))
+        if is_definite:
+            tmp0 = np.nonzero(active & (prob<_ZERO_EPS) & (fix==1))[0]
+            if len(tmp0):
+                raise QChessInvalidCommand(f'game={tmp0[0]}, zero probability but required fix=1')
+            tmp0 = np.nonzero(active & (prob>(1-_ZERO_EPS)) & (fix==0))[0]
+            if len(tmp0):
+                raise QChessInvalidCommand(f'game={tmp0[0]}, 100% probability to be 1 but required fix=0')
+            ret = np.where(prob<_ZERO_EPS, 0, np.where(prob>(1-_ZERO_EPS), 1, ret))
+        return ret
+
+    def measure(self, index, fix=None, active=None):
+        # fix: (num_game,) 0/1, -1 for random
+        active = self._hf_active(active)
+        prob = self._get_probability_i(index)
+        result = self._hf_measure_result(prob, fix, active, is_definite=True)
+        self._drop_row(active[self.game] & (self._bit(index) != result[self.game].astype(np.bool_)), active)
+        self._release_definite_ancilla(active)
+        self.last_measure[active] = result[active]
+        self.last_measure1_prob[active] = prob[active]
+
+    def _capture_slide_measure(self, src, dst, path, fix=None, active=None):
+        # return the games measured, prob1=0 is a meaningless move (not measured)
+        active = self._hf_active(active)
+        bs = self._bit(src)
+        bt = self._bit(dst)
+        bp = self._hf_control(path)
+        M0 = np.where(bp, bt, ~bs)
+        prob1 = self._reduce_game(np.where(M0, 0, self._hf_abs2(self.amplitude)))
+        ret = active & (prob1>=_ZERO_EPS)
+        result = self._hf_measure_result(prob1, fix, ret, is_definite=False)
+        self._drop_row(ret[self.game] & np.where(result[self.game]==1, M0, ~M0), ret)
+        self._release_definite_ancilla(ret)
+        self.last_measure[ret] = result[ret]
+        self.last_measure1_prob[ret] = prob1[ret]
+        return ret
+
+    def normal_slide(self, src, dst, path, active=None):
+        self.apply_iswap(src, dst, path, active=active)
+
+    def split_slide(self, src, dst1, dst2, path1, path2, active=None):
+        # the gates on two empty squares do nothing, so no occupancy check as in QChessSparseSimulator.split_slide()
+        path = np.asarray(path1, dtype=np.uint64) | np.asarray(path2, dtype=np.uint64)
+        self.apply_sqrtiswap(src, dst1, path, active=active)
+        self.apply_iswap(src, dst2, path, active=active)
+        self.apply_iswap(src, dst1, control=path1, negate_control=path2, active=active)
+        self.apply_iswap(src, dst2, control=path2, negate_control=path1, active=active)
+
+    def merge_slide(self, src1, src2, dst, path1, path2, active=None):
+        path = np.asarray(path1, dtype=np.uint64) | np.asarray(path2, dtype=np.uint64)
+        self.apply_iswap(dst, src2, control=path2, negate_control=path1, tag_inverse=True, active=active)
+        self.apply_iswap(dst, src1, control=path1, negate_control=path2, tag_inverse=True, active=active)
+        self.apply_iswap(dst, src2, path, tag_inverse=True, active=active)
+        self.apply_sqrtiswap(dst, src1, path, tag_inverse=True, active=active)
+
+    def blocked_slide(self, src, dst, path, measure_fix=None, active=None):
+        active = self._hf_active(active)
+        self.measure(dst, measure_fix, active)
+        self.apply_iswap(src, dst, path, active=active & (self.last_measure==0))
+
+    def capture_slide(self, src, dst, path, measure_fix=None, is_pawn=None, active=None):
+        # capture_jump() for the games with empty path
+        active = self._hf_active(active)
+        path = np.asarray(path, dtype=np.uint64)
+        is_pawn = np.zeros(self.num_game, dtype=np.bool_) if (is_pawn is None) else np.asarray(is_pawn, dtype=np.bool_)
+        jump = active & (path==0)
+        self.measure(src, measure_fix, jump)
+        tmp0 = self._capture_slide_measure(src, dst, path, measure_fix, active & ~jump)
+        measured = (jump | tmp0) & (self.last_measure==1)
+        is_capture = measured & self._is_occupied_i(dst)
+        # the ancilla would be 1 in every key, see QChessSparseSimulator.capture_jump()
+        definite = is_capture & self._is_definite_one_i(dst)
+        self._clear_definite_qubit(dst, 1j, definite)
+        has_ancilla = is_capture & ~definite
+        ancilla = self.get_free_ancilla(has_ancilla)
+        self.apply_iswap(dst, ancilla, path, active=has_ancilla)
+        tmp1 = np.stack([np.zeros(self.num_game, dtype=np.uint64), _U64_ONE << (ancilla & 63).astype(np.uint64)], axis=1)
+        self.apply_iswap(src, dst, path, negate_control=tmp1, active=has_ancilla & is_pawn)
+        self.apply_iswap(src, dst, path, active=measured & (definite | ~is_pawn))
+
+
+def hf_bool_to_mask(x):
+    # (...,64) bool -> (...,) uint64 bit mask of the squares
+    ret = np.bitwise_or.reduce(np.where(x, _SQUARE_BIT, _U64_ZERO), axis=-1)
+    return ret
+
+
+def hf_kth_true(x, k):
+    # (n,m) bool, (n,) int -> (n,) column of the k-th (from 0) True in each row
+    ret = np.argmax(np.cumsum(x, axis=1) > np.asarray(k)[:,np.newaxis], axis=1)
+    return ret
+
+
+def _build_batch_move_table():
+    hf0 = lambda x: np.array([[(y>>z)&1 for z in range(64)] for y in x], dtype=np.bool_)
+    ray = np.zeros((7,64,64), dtype=np.bool_) #piece type, src, dst
+    ray[2] = hf0(KNIGHT_ATTACK)
+    ray[3] = hf0(BISHOP_RAY)
+    ray[4] = hf0(ROOK_RAY)
+    ray[5] = hf0([x|y for x,y in zip(ROOK_RAY, BISHOP_RAY)])
+    ray[6] = hf0(KING_ATTACK)
+    square_bit = np.left_shift(_U64_ONE, np.arange(64, dtype=np.uint64))
+    between = np.array(BETWEEN, dtype=np.uint64)
+    return ray, square_bit, between
+
+# _PIECE_RAY[type,src]: squares reachable without blockers, _BETWEEN_ARRAY: movegen BETWEEN as uint64 array
+_PIECE_RAY, _SQUARE_BIT, _BETWEEN_ARRAY = _build_batch_move_table()
+_CASTLING_ARRAY = np.array(_CASTLING_LIST, dtype=np.int64) #(srcK,srcR,dstK,dstR), same order as QChessGameBatch.castling
+_PROMOTION = (None, 'q', 'r', 'b', 'n')
+_MOVE_KIND = ('move', 'blocked', 'capture', 'split', 'merge', 'en-passant', 'castling') #ChessMove.kind
+_KIND_CODE = {x:i for i,x in enumerate(_MOVE_KIND)}
+
+
+def get_move_table_batch(tag, prob, is_white, active, castling, pawn_twostep, current_step):
+    # the available moves of all the active games, same as movegen.get_all_available_move_bitboard() on (num_game,64) arrays
+    # tag: (num_game,64) tag code, prob: marginal probability, castling/pawn_twostep: see QChessGameBatch
+    # piece row (game, src): target mask of the base moves (move/capture/blocked) and of the split targets
+    # merge row: a pair of piece rows with the same tag, pawn row: 4 candidate moves (one-step, two-step, two diagonals)
+    num_game = tag.shape[0]
+    ptype = np.where(tag==0, 0, (tag-1)%6 + 1)
+    color = np.where(tag==0, -1, (tag>6).astype(np.int64)) #0 white, 1 black
+    side = (~is_white).astype(np.int64)
+    own = active[:,np.newaxis] & (color==side[:,np.newaxis])
+    full_ge = prob>=1-_ZERO_EPS
+    full = hf_bool_to_mask(prob>1-_ZERO_EPS)
+    occupied = hf_bool_to_mask(tag!=0)
+    ret = dict(occupied=occupied, ptype=ptype)
+
+    # knight, bishop, rook, queen, king
+    game,src = np.nonzero(own & (ptype>1))
+    code = tag[game,src]
+    reach = _PIECE_RAY[ptype[game,src], src] & ((_BETWEEN_ARRAY[src] & full[game,np.newaxis])==_U64_ZERO)
+    tag_dst = tag[game]
+    split = reach & ((tag_dst==0) | (tag_dst==code[:,np.newaxis]))
+    capture = reach & (color[game]==(1-side[game])[:,np.newaxis])
+    blocked = reach & ~split & ~capture & ~full_ge[game]
+    piece_row = np.full((num_game,64), -1, dtype=np.int64)
+    piece_row[game,src] = np.arange(game.shape[0])
+    ret.update(piece_game=game, piece_src=src, piece_row=piece_row, reach=reach, split=split, capture=capture, base=(split|capture|blocked))
+
+    # merge: ordered pairs of the piece rows with the same game and tag
+    key = game*16 + code
+    ind0 = np.argsort(key, kind='stable')
+    tmp0 = np.ones(key.shape[0], dtype=np.bool_)
+    tmp0[1:] = key[ind0][1:]!=key[ind0][:-1]
+    start = np.nonzero(tmp0)[0]
+    group = np.cumsum(tmp0) - 1
+    size = np.diff(np.append(start, key.shape[0]))[group]
+    rank = np.arange(key.shape[0]) - start[group]
+    merge_p = [np.zeros(0, dtype=np.int64)]
+    merge_q = [np.zeros(0, dtype=np.int64)]
+    for x in range(1, size.max(initial=1)):
+        tmp1 = np.nonzero(size>x)[0]
+        merge_p.append(ind0[tmp1])
+        merge_q.append(ind0[start[group[tmp1]] + (rank[tmp1]+x)%size[tmp1]])
+    merge_p = np.concatenate(merge_p)
+    merge_q = np.concatenate(merge_q)
+    ret.update(merge_p=merge_p, merge_q=merge_q, merge=(split[merge_p] & reach[merge_q]))
+
+    # pawn, same rules as movegen._get_pawn_move()
+    game,src = np.nonzero(own & (ptype==1))
+    white = side[game]==0
+    step = np.where(white, 8, -8)
+    file = src%8
+    dst = np.stack([src+step, src+2*step, src+step-1, src+step+1], axis=1)
+    exist = np.stack([np.ones_like(white), (src//8)==np.where(white,1,6), file>0, file<7], axis=1)
+    dst = np.where(exist, dst, src[:,np.newaxis]) #any valid square
+    g2 = game[:,np.newaxis]
+    tag_dst = tag[g2,dst]
+    not_full = prob[g2,dst]<=1-_ZERO_EPS
+    tmp0 = (tag[game,src+step]==0) | (prob[game,src+step]<=1-_ZERO_EPS) #two-step path
+    kind = np.empty(dst.shape, dtype=np.int64)
+    valid = np.empty(dst.shape, dtype=np.bool_)
+    kind[:,0] = np.where(tag_dst[:,0]==0, _KIND_CODE['move'], _KIND_CODE['blocked'])
+    # blocked by a pawn of the same tag is a valid move in movegen, but QChessSparseSimulator.blocked_slide() raises on it
+    valid[:,0] = (tag_dst[:,0]==0) | (not_full[:,0] & (tag_dst[:,0]!=tag[game,src]))
+    kind[:,1] = np.where((tag_dst[:,1]==0) | (tag_dst[:,1]==tag[game,src]), _KIND_CODE['move'], _KIND_CODE['blocked'])
+    valid[:,1] = exist[:,1] & tmp0 & ((tag_dst[:,1]==0) | not_full[:,1])
+    beside = dst[:,2:] - step[:,np.newaxis]
+    tmp1 = ((tag[g2,beside]==np.where(white, _TAG_CODE['p'], _TAG_CODE['P'])[:,np.newaxis])
+            & (pawn_twostep[g2,beside]>=0) & (pawn_twostep[g2,beside]==(current_step[game]-1)[:,np.newaxis]))
+    kind[:,2:] = np.where(tag_dst[:,2:]!=0, _KIND_CODE['capture'], _KIND_CODE['en-passant'])
+    valid[:,2:] = exist[:,2:] & np.where(tag_dst[:,2:]!=0, color[g2,dst[:,2:]]==(1-side[game])[:,np.newaxis], tmp1)
+    promotion = (dst//8)==np.where(white, 7, 0)[:,np.newaxis]
+    pawn_row = np.full((num_game,64), -1, dtype=np.int64)
+    pawn_row[game,src] = np.arange(game.shape[0])
+    ret.update(pawn_game=game, pawn_src=src, pawn_row=pawn_row, pawn_dst=dst, pawn_kind=kind, pawn_valid=valid, pawn_promotion=promotion)
+
+    # castling, see QChessGame.is_valid_castling()
+    tmp0 = side[:,np.newaxis]*2 + np.arange(2)
+    srcK,srcR = _CASTLING_ARRAY[tmp0,0], _CASTLING_ARRAY[tmp0,1]
+    g2 = np.arange(num_game)[:,np.newaxis]
+    tmp1 = (side*6)[:,np.newaxis]
+    ret['castling'] = (active[:,np.newaxis] & castling[g2,tmp0]
+            & (tag[g2,srcK]==(tmp1+_TAG_CODE['K'])) & (prob[g2,srcK]>1-_ZERO_EPS)
+            & (tag[g2,srcR]==(tmp1+_TAG_CODE['R'])) & (prob[g2,srcR]>1-_ZERO_EPS)
+            & ((_BETWEEN_ARRAY[srcK,srcR] & occupied[:,np.newaxis])==_U64_ZERO))
+    ret['castling_index'] = tmp0
+    return ret
+
+
+def _hf_empty_move(num_game:int):
+    # (num_game,) arrays of a move, -1 for None (src1, dst1, kind, fix), promotion: index of _PROMOTION
+    hf0 = lambda: np.full(num_game, -1, dtype=np.int64)
+    ret = dict(src=np.zeros(num_game, dtype=np.int64), src1=hf0(), dst=np.zeros(num_game, dtype=np.int64), dst1=hf0(),
+            promotion=np.zeros(num_game, dtype=np.int64), kind=hf0(), fix=hf0())
+    return ret
+
+
+def sample_move_batch(table, u, split_weight:float):
+    # one move per active game, the move rng.choices(all_move, weight) picks with rng.random()==u, see movegen.sample_available_move_bitboard()
+    # weight: split_weight for split and castling, 1 for the others
+    # the moves are counted per group (piece, split, merge, pawn candidate, castling) and only the picked one is built
+    num_game = table['castling'].shape[0]
+    piece_game = table['piece_game']
+    pawn_game = table['pawn_game']
+    num_split = table['split'].sum(axis=1)
+    tmp0 = table['pawn_valid'] * np.where(table['pawn_promotion'], len(_PROMOTION)-1, 1)
+    group = [
+        (piece_game, table['base'].sum(axis=1), 1, np.arange(piece_game.shape[0])),
+        (piece_game, num_split*(num_split-1), split_weight, np.arange(piece_game.shape[0])),
+        (piece_game[table['merge_p']], table['merge'].sum(axis=1), 1, np.arange(table['merge_p'].shape[0])),
+        (np.repeat(pawn_game, 4), tmp0.reshape(-1), 1, np.arange(tmp0.size)),
+        (np.repeat(np.arange(num_game), 2), table['castling'].reshape(-1), split_weight, np.arange(2*num_game)),
+    ]
+    game = np.concatenate([x[0] for x in group])
+    count = np.concatenate([x[1] for x in group]).astype(np.int64)
+    weight = np.concatenate([np.full(x[0].shape[0], x[2], dtype=np.float64) for x in group])
+    kind = np.concatenate([np.full(x[0].shape[0], i, dtype=np.int64) for i,x in enumerate(group)])
+    row = np.concatenate([x[3] for x in group])
+    tmp0 = (count>0) & (weight>0)
+    ind0 = np.argsort(game[tmp0], kind='stable')
+    game,count,weight,kind,row = [x[tmp0][ind0] for x in (game,count,weight,kind,row)]
+    ret = _hf_empty_move(num_game)
+    if game.shape[0]==0:
+        assert not table['active'].any(), 'something must be wrong, no move available'
+        return ret
+    total = count*weight
+    cumsum = np.cumsum(total)
+    start = np.searchsorted(game, np.arange(num_game))
+    end = np.searchsorted(game, np.arange(num_game), side='right')
+    has_move = end>start
+    assert np.all(has_move | ~table['active']), 'something must be wrong, no move available'
+    tmp1 = np.where(start>0, cumsum[np.maximum(start-1,0)], 0)
+    target = tmp1 + u*(np.where(has_move, cumsum[np.maximum(end-1,0)], 0) - tmp1)
+    ind1 = np.minimum(np.searchsorted(cumsum, target, side='right'), end-1) #the last group for the rounding at the upper end
+    ind1 = np.where(has_move, ind1, 0)
+    k = np.clip(((target - (cumsum[ind1]-total[ind1]))/weight[ind1]).astype(np.int64), 0, count[ind1]-1)
+    kind = np.where(has_move, kind[ind1], -1)
+    row = row[ind1]
+    piece_src = table['piece_src']
+    # base move, kind from the target square
+    i = np.nonzero(kind==0)[0]
+    if len(i):
+        p = row[i]
+        dst = hf_kth_true(table['base'][p], k[i])
+        ret['src'][i] = piece_src[p]
+        ret['dst'][i] = dst
+        ret['kind'][i] = np.where(table['split'][p,dst], _KIND_CODE['move'],
+                np.where(table['capture'][p,dst], _KIND_CODE['capture'], _KIND_CODE['blocked']))
+    # split, k -> (k//(m-1), k%(m-1)) of the m split targets, skipping the same target
+    i = np.nonzero(kind==1)[0]
+    if len(i):
+        p = row[i]
+        n = num_split[p] - 1
+        tmp0 = k[i]%n
+        ret['src'][i] = piece_src[p]
+        ret['dst'][i] = hf_kth_true(table['split'][p], k[i]//n)
+        ret['dst1'][i] = hf_kth_true(table['split'][p], tmp0 + (tmp0>=(k[i]//n)))
+        ret['kind'][i] = _KIND_CODE['split']
+    i = np.nonzero(kind==2)[0]
+    if len(i):
+        ret['src'][i] = piece_src[table['merge_p'][row[i]]]
+        ret['src1'][i] = piece_src[table['merge_q'][row[i]]]
+        ret['dst'][i] = hf_kth_true(table['merge'][row[i]], k[i])
+        ret['kind'][i] = _KIND_CODE['merge']
+    i = np.nonzero(kind==3)[0]
+    if len(i):
+        p,c = row[i]//4, row[i]%4
+        ret['src'][i] = table['pawn_src'][p]
+        ret['dst'][i] = table['pawn_dst'][p,c]
+        ret['kind'][i] = table['pawn_kind'][p,c]
+        ret['promotion'][i] = np.where(table['pawn_promotion'][p,c], k[i]+1, 0)
+    i = np.nonzero(kind==4)[0]
+    if len(i):
+        tmp0 = _CASTLING_ARRAY[table['castling_index'][i, row[i]%2]]
+        ret['src'][i],ret['src1'][i],ret['dst'][i],ret['dst1'][i] = tmp0.T
+        ret['kind'][i] = _KIND_CODE['castling']
+    return ret
+
+
+def hf_table_row(x, index):
+    # x[index] of a table array, zero row for index -1 (no such piece) and for the empty table
+    if x.shape[0]==0:
+        return np.zeros(index.shape+x.shape[1:], dtype=x.dtype)
+    ret = x[np.maximum(index,0)]
+    ret[index<0] = 0
+    return ret
+
+
+def find_move_batch(table, move):
+    # kind of the given moves (move arrays, see _hf_empty_move()), -1 if the move is not available, see movegen.validate_move_batch()
+    src,src1,dst,dst1,promotion = [move[x] for x in ('src','src1','dst','dst1','promotion')]
+    num_game = src.shape[0]
+    game = np.arange(num_game)
+    hf0 = hf_table_row
+    p = table['piece_row'][game,src]
+    q = table['piece_row'][game,np.maximum(src1,0)]
+    split_p,capture_p = hf0(table['split'], p),hf0(table['capture'], p)
+    tmp0 = (p>=0) & (promotion==0)
+    tmp1 = np.maximum(dst1, 0)
+    ret = np.full(num_game, -1, dtype=np.int64)
+    tmp2 = tmp0 & (src1<0) & (dst1<0) & hf0(table['base'], p)[game,dst]
+    ret = np.where(tmp2, np.where(split_p[game,dst], _KIND_CODE['move'],
+            np.where(capture_p[game,dst], _KIND_CODE['capture'], _KIND_CODE['blocked'])), ret)
+    tmp2 = tmp0 & (src1<0) & (dst1>=0) & (dst!=dst1) & split_p[game,dst] & split_p[game,tmp1]
+    ret = np.where(tmp2, _KIND_CODE['split'], ret)
+    tmp2 = (tmp0 & (q>=0) & (src1!=src) & (dst1<0) & split_p[game,dst] & hf0(table['reach'], q)[game,dst]
+            & (table['tag'][game,src]==table['tag'][game,np.maximum(src1,0)]))
+    ret = np.where(tmp2, _KIND_CODE['merge'], ret)
+    # pawn
+    r = table['pawn_row'][game,src]
+    tmp2 = hf0(table['pawn_valid'], r) & (hf0(table['pawn_dst'], r)==dst[:,np.newaxis])
+    c = tmp2.argmax(axis=1)
+    tmp3 = (r>=0) & (src1<0) & (dst1<0) & tmp2.any(axis=1) & (hf0(table['pawn_promotion'], r)[game,c]==(promotion>0))
+    ret = np.where(tmp3, hf0(table['pawn_kind'], r)[game,c], ret)
+    # castling
+    tmp4 = _CASTLING_ARRAY[table['castling_index']] #(num_game,2,4)
+    tmp5 = (tmp4==np.stack([src,src1,dst,dst1], axis=1)[:,np.newaxis]).all(axis=2) & table['castling']
+    ret = np.where(tmp5.any(axis=1) & (promotion==0), _KIND_CODE['castling'], ret)
+    return ret
+
+
+class QChessGameBatch:
+    # num_game games in lockstep on one QChessSparseSimulatorBatch, e.g. for self-play data generation
+    # the game state is kept in (num_game,) arrays, the move generation, the rules and the bookkeeping are vectorized over the games
+    # castling: (num_game,4) bool, tag_wcastling + tag_bcastling of QChessGame
+    # pawn_twostep: (num_game,64) step of the last two-step move of the pawn on the square, -1 for None
+    # pawn_key: (num_game,64) bool, the square is a key of QChessGame.pawn_last_twostep
+    # to_game() gives a standalone QChessGame of one game, e.g. for the AI and the gym environment
+    def __init__(self, num_game:int, seed=None):
+        self.rng = get_rng(seed)
+        self.np_rng = np.random.default_rng(self.rng.getrandbits(64))
+        self.sim = QChessSparseSimulatorBatch(num_game, seed=self.rng)
+        self.current_step = np.zeros(num_game, dtype=np.int64)
+        self.castling = np.ones((num_game,4), dtype=np.bool_)
+        self.pawn_twostep = np.full((num_game,64), -1, dtype=np.int64)
+        self.pawn_key = np.zeros((num_game,64), dtype=np.bool_)
+        self.pawn_key[:,8:16] = True
+        self.pawn_key[:,48:56] = True
+        self._move_log = [] #(active, move arrays, last_measure) of each step, see get_history()
+        self._prob = self.sim.get_square_probability()
+
+    @property
+    def num_game(self):
+        return self.sim.num_game
+
+    @property
+    def is_white(self):
+        return (self.current_step%2)==0
+
+    def _get_finish(self):
+        # (num_game,) index of ('draw', 'black', 'white', 'continue')
+        tag = self.sim.pos2tag[:,:64]
+        ret = 2*(tag==_TAG_CODE['K']).any(axis=1) + (tag==_TAG_CODE['k']).any(axis=1)
+        return ret
+
+    def is_finish_or_not(self):
+        tmp0 = ('draw', 'black', 'white', 'continue')
+        return [tmp0[x] for x in self._get_finish()]
+
+    def get_move_table(self, active=None):
+        # see get_move_table_batch()
+        active = np.ones(self.num_game, dtype=np.bool_) if (active is None) else np.asarray(active, dtype=np.bool_)
+        tag = self.sim.pos2tag[:,:64]
+        ret = get_move_table_batch(tag, self._prob, self.is_white, active, self.castling, self.pawn_twostep, self.current_step)
+        ret['tag'] = tag
+        ret['active'] = active
+        return ret
+
+    def get_history(self, index:int):
+        # command strings of one game, same as QChessGame.history
+        ret = []
+        for active,move,last_measure in self._move_log:
+            if active[index]:
+                tmp0 = [int(move[x][index]) for x in ('src','src1','dst','dst1','promotion','fix')]
+                tmp0 = [(None if (y<0) else y) for y in tmp0]
+                cmd = str(ChessMove(tmp0[0], tmp0[1], tmp0[2], tmp0[3], _PROMOTION[tmp0[4] or 0], None, tmp0[5]))
+                if (tmp0[5] is None) and (last_measure[index]>=0):
+                    cmd += f',{last_measure[index]}'
+                ret.append(cmd)
+        return ret
+
+    def to_game(self, index:int):
+        # standalone QChessGame (numpy backend) of one game
+        sim = self.sim.get_sim(index)
+        ret = QChessGame.__new__(QChessGame)
+        ret.rng = sim.rng
+        ret.backend = 'numpy'
+        ret.truncation = (None, None)
+        ret.undo_buffer = QChessUndoBuffer(depth=0)
+        ret._reset()
+        ret.sim = sim
+        ret.current_step = int(self.current_step[index])
+        ret.pawn_last_twostep = {SQUARE_STR[x]:(None if (self.pawn_twostep[index,x]<0) else int(self.pawn_twostep[index,x]))
+                for x in np.nonzero(self.pawn_key[index])[0]}
+        ret.tag_wcastling = self.castling[index,:2].tolist()
+        ret.tag_bcastling = self.castling[index,2:].tolist()
+        ret.history = self.get_history(index)
+        ret.truncation_loss = [0]*len(ret.history)
+        return ret
+
+    def _run_move(self, table, move):
+        # the gates of QChessGame._plan_piece_move() for the moves in the move arrays, then the bookkeeping of QChessGame._finish_move()
+        # games with the same primitive share one vectorized call, a game without move (kind=-1) is not changed
+        sim = self.sim
+        game = np.arange(self.num_game)
+        src,src1,dst,dst1,kind,fix = [move[x] for x in ('src','src1','dst','dst1','kind','fix')]
+        src1 = np.maximum(src1, 0)
+        dst1 = np.maximum(dst1, 0)
+        active = kind>=0
+        is_white = self.is_white
+        piece = table['ptype'][game,src]
+        hf0 = lambda x: kind==_KIND_CODE[x]
+        hf1 = lambda x: _SQUARE_BIT[x]
+        occupied = table['occupied']
+        path = _BETWEEN_ARRAY[src,dst] & occupied
+        castling = hf0('castling')
+        en_passant = hf0('en-passant')
+        beside = dst - np.where(is_white, 8, -8)
+        tmp0 = active & ~castling #see is_measured_wrapper()
+        sim.last_measure[tmp0] = -1
+        sim.last_measure1_prob[tmp0] = np.nan
+        zero = np.zeros(self.num_game, dtype=np.uint64)
+        tmp1 = hf0('move') | castling
+        if tmp1.any():
+            sim.normal_slide(src, dst, np.where(castling, zero, path), active=tmp1)
+        if hf0('blocked').any():
+            sim.blocked_slide(src, dst, path, fix, active=hf0('blocked'))
+        tmp1 = hf0('capture') | en_passant
+        if tmp1.any():
+            sim.capture_slide(src, np.where(en_passant, beside, dst), path, fix, piece==1, active=tmp1)
+        if hf0('split').any():
+            tmp2 = path & ~hf1(dst1)
+            tmp3 = _BETWEEN_ARRAY[src,dst1] & occupied & ~hf1(dst)
+            sim.split_slide(src, dst, dst1, tmp2, tmp3, active=hf0('split'))
+        if hf0('merge').any():
+            tmp2 = path & ~hf1(src1)
+            tmp3 = _BETWEEN_ARRAY[src1,dst] & occupied & ~hf1(src)
+            sim.merge_slide(src, src1, dst, tmp2, tmp3, active=hf0('merge'))
+        tmp1 = castling | en_passant
+        if tmp1.any():
+            sim.normal_slide(np.where(en_passant, beside, src1), np.where(en_passant, dst, dst1), zero, active=tmp1)
+        tmp1 = active & (move['promotion']>0)
+        if tmp1.any():
+            label = np.array([_TAG_CODE[x.upper()] if x else 0 for x in _PROMOTION])[move['promotion']] + np.where(is_white, 0, 6)
+            sim.change_tag(dst, label, active=tmp1)
+        self._prob = sim.get_square_probability()
+
+        # castling rights
+        tag = sim.pos2tag[:,:64]
+        side = np.where(is_white, 0, 2)
+        tmp0 = active & ~castling & ~((tag[game,src]!=0) & (self._prob[game,src]>1-_ZERO_EPS)) #src is empty or not certain
+        tmp1 = np.nonzero(castling | (tmp0 & (piece==6) & ((src==4) | (src==60))))[0]
+        self.castling[tmp1, side[tmp1]] = False
+        self.castling[tmp1, side[tmp1]+1] = False
+        for x,y in [(0,1), (7,0), (56,2), (63,3)]: #same flags as QChessGame._finish_move()
+            self.castling[tmp0 & (piece==4) & (src==x), y] = False
+        # pawn, the value moves with the pawn
+        last_measure0 = sim.last_measure==0
+        pawn = active & ~castling & (piece==1)
+        two = np.abs(dst-src)==16
+        tmp0 = pawn & ((hf0('move') & ~two) | hf0('capture') | en_passant | (hf0('blocked') & ~two & last_measure0))
+        i = np.nonzero(tmp0)[0]
+        value = self.pawn_twostep[i,src[i]]
+        self.pawn_key[i,src[i]] = False
+        self.pawn_twostep[i,src[i]] = -1
+        self.pawn_key[i,dst[i]] = True
+        self.pawn_twostep[i,dst[i]] = value
+        tmp1 = hf0('capture')[i] & (tag[i,src[i]]!=0) #partially captured
+        self.pawn_key[i[tmp1],src[i[tmp1]]] = True
+        self.pawn_twostep[i[tmp1],src[i[tmp1]]] = value[tmp1]
+        i = np.nonzero(pawn & two & (hf0('move') | (hf0('blocked') & last_measure0)))[0]
+        self.pawn_key[i,dst[i]] = True
+        self.pawn_twostep[i,dst[i]] = self.current_step[i]
+        i = i[path[i]==_U64_ZERO]
+        self.pawn_key[i,src[i]] = False
+        self.pawn_twostep[i,src[i]] = -1
+
+        self.current_step[active] += 1
+        self._move_log.append((active, move, sim.last_measure.copy()))
+
+    def step(self, move_list):
+        # one move (ChessMove, command string, or None to skip the game) for each game
+        # all the moves are checked before any gate, QChessInvalidCommand if one is invalid
+        assert len(move_list)==self.num_game
+        move = _hf_empty_move(self.num_game)
+        active = np.zeros(self.num_game, dtype=np.bool_)
+        for i,x in enumerate(move_list):
+            if x is not None:
+                if not isinstance(x, ChessMove):
+                    x = ChessMove.from_str(x)
+                active[i] = True
+                tmp0 = [(-1 if (y is None) else y) for y in (x.src, x.src1, x.dst, x.dst1, x.prefix_measure)]
+                move['src'][i],move['src1'][i],move['dst'][i],move['dst1'][i],move['fix'][i] = tmp0
+                move['promotion'][i] = _PROMOTION.index(x.promotion)
+        table = self.get_move_table(active)
+        move['kind'] = np.where(active, find_move_batch(table, move), -1)
+        tmp0 = np.nonzero(active & (move['kind']<0))[0]
+        if len(tmp0):
+            raise QChessInvalidCommand(f'game={tmp0[0]}, invalid move="{move_list[tmp0[0]]}"')
+        self._run_move(table, move)
+
+    def random_move(self, split_probability_weight:float):
+        # one random move for each unfinished game, same distribution as QChessGame.random_move()
+        # return (num_game,) bool, the games which made a move
+        active = self._get_finish()==3
+        table = self.get_move_table(active)
+        move = sample_move_batch(table, self.np_rng.random(self.num_game), split_probability_weight)
+        self._run_move(table, move)
+        return active
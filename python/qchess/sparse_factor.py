@@ -0,0 +1,398 @@
+import numpy as np
+
+from .utils import hf_convert_pos_to_int, hf_bit_list
+from .chess_utils import _ZERO_EPS, _ZOBRIST_NUM_PROBE, hf_zobrist_amplitude
+from .sparse_int import QChessSparseSimulatorInt, hf_int_key_to_bitarray
+
+
+class QChessSparseSimulatorFactor(QChessSparseSimulatorInt):
+    # same as QChessSparseSimulatorInt, but the state is a tensor product of independent components
+    # component: qubits which have shared a gate, merged only when a gate spans two components
+    # a qubit in a definite state (0 or 1) is always split out as a single-qubit component
+    # coeff is the joint state (product of all components), except inside a gate where it is the active component
+    _active = None
+    _journal_by_snapshot = True
+    _hash_incremental = True #cached until a component changes, see _compute_hash_accumulator()
+
+    @property
+    def coeff(self):
+        if self._active is not None:
+            return self.component[self._active]
+        ret = {0:1}
+        for comp in self.component.values():
+            ret = {(k0|k1):(v0*v1) for k0,v0 in ret.items() for k1,v1 in comp.items()}
+        return ret
+
+    @coeff.setter
+    def coeff(self, value:dict):
+        self._hash_amplitude = None
+        if self._active is not None:
+            self.component[self._active] = value
+            return
+        value = {(int(k) if isinstance(k,(int,np.integer)) else int(k[::-1],2)):v for k,v in value.items()}
+        self.component = {0:value}
+        self.component_mask = {0:(1<<len(self.pos2tag))-1}
+        self.qubit2component = [0]*len(self.pos2tag)
+        self._next_component = 1
+        self._component_shared = set()
+        self._split_deterministic(0)
+
+    def _clone_from_sim(self, sim1):
+        # not via sim1.coeff, which is the joint state
+        self.pos2tag = list(sim1.pos2tag)
+        self.rng.setstate(sim1.rng.getstate())
+        self.last_measure = sim1.last_measure
+        self.last_measure1_prob = sim1.last_measure1_prob
+        self._probability = list(sim1._probability)
+        self.truncate_threshold = sim1.truncate_threshold
+        self.truncate_max_branch = sim1.truncate_max_branch
+        self.last_truncation_loss = sim1.last_truncation_loss
+        self.component = {k:dict(v) for k,v in sim1.component.items()}
+        self.component_mask = dict(sim1.component_mask)
+        self.qubit2component = list(sim1.qubit2component)
+        self._next_component = sim1._next_component
+        self._component_shared = set()
+        self._hash_amplitude = None
+
+    def copy(self):
+        # copy-on-write per component
+        ret = super().copy()
+        ret.component = dict(self.component)
+        ret.component_mask = dict(self.component_mask)
+        ret.qubit2component = list(self.qubit2component)
+        self._component_shared = set(self.component.keys())
+        ret._component_shared = set(self.component.keys())
+        return ret
+
+    def get_num_amplitude(self):
+        # not the size of the joint state
+        return sum(len(x) for x in self.component.values())
+
+    def _own_coeff(self):
+        # see _own_component()
+        pass
+
+    def _on_coeff_delta(self, coeff_old:dict, key_new, src:int, dst:int):
+        # gate on the active component, the hash is not updated incrementally
+        self._hash_amplitude = None
+
+    def _compute_hash_accumulator(self):
+        # the accumulator of the joint state is the product of the component accumulators, the joint state is not built
+        # the single-key components are merged into one key first
+        ret = [1]*_ZOBRIST_NUM_PROBE
+        key_hash = 0
+        phase = 1
+        for comp in self.component.values():
+            if len(comp)==1:
+                for k,v in comp.items():
+                    key_hash += self._key_hash(k)
+                    phase *= v
+                continue
+            tmp0 = [0]*_ZOBRIST_NUM_PROBE
+            for k,v in comp.items():
+                for x,y in enumerate(hf_zobrist_amplitude(self._key_hash(k), v)):
+                    tmp0[x] += y
+            ret = [x*y for x,y in zip(ret,tmp0)]
+        ret = tuple(x*y for x,y in zip(ret, hf_zobrist_amplitude(key_hash, phase)))
+        return ret
+
+    def _own_component(self, cid:int):
+        # called before changing the component in place
+        if cid in self._component_shared:
+            self.component[cid] = dict(self.component[cid])
+            self._component_shared.discard(cid)
+
+    def enable_square_index(self, enable:bool=True):
+        # components are small, square index is not used
+        pass
+
+    def _new_component(self, comp:dict, mask:int):
+        cid = self._next_component
+        self._next_component += 1
+        self._hash_amplitude = None
+        self.component[cid] = comp
+        self.component_mask[cid] = mask
+        for x in hf_bit_list(mask):
+            self.qubit2component[x] = cid
+        return cid
+
+    def is_classical(self):
+        # every qubit is a single-qubit component
+        return (len(self.component)==len(self.pos2tag)) and all(x is None for x in self.pos2tag[64:])
+
+    def _classical_move_key(self, src:int, dst:int, phase:complex):
+        self._hash_amplitude = None
+        self._set_definite(src, 0)
+        self._set_definite(dst, 1)
+        cid = self.qubit2component[src]
+        self.component[cid] = {k:v*phase for k,v in self.component[cid].items()}
+
+    def _is_definite(self, index:int):
+        return len(self.component[self.qubit2component[index]])==1
+
+    def _split_deterministic(self, cid:int):
+        # move the qubits with the same value in every key of the component to single-qubit components
+        comp = self.component[cid]
+        mask = self.component_mask[cid]
+        if (len(comp)==1) and ((mask & (mask-1))==0):
+            return
+        key_or = 0
+        key_and = mask
+        for k in comp.keys():
+            key_or |= k
+            key_and &= k
+        fixed = mask & ~(key_or ^ key_and)
+        if fixed==0:
+            return
+        self._hash_amplitude = None
+        if fixed==mask:
+            # one key left, keep its phase on the first qubit
+            phase = next(iter(comp.values()))
+            self.component.pop(cid)
+            self.component_mask.pop(cid)
+        else:
+            phase = 1
+            self.component[cid] = {(k & ~fixed):v for k,v in comp.items()}
+            self.component_mask[cid] = mask & ~fixed
+        for x in hf_bit_list(fixed):
+            self._new_component({(key_and & (1<<x)):phase}, 1<<x)
+            phase = 1
+
+    def _merge_component(self, index_list):
+        cid_list = sorted({self.qubit2component[x] for x in index_list})
+        cid = cid_list[0]
+        if len(cid_list)>1:
+            self._hash_amplitude = None
+        for x in cid_list[1:]:
+            comp = self.component.pop(x)
+            mask = self.component_mask.pop(x)
+            self.component[cid] = {(k0|k1):(v0*v1) for k0,v0 in self.component[cid].items() for k1,v1 in comp.items()}
+            self.component_mask[cid] |= mask
+            self._component_shared.discard(cid)
+            for y in hf_bit_list(mask):
+                self.qubit2component[y] = cid
+        return cid
+
+    def _update_component_probability(self, cid:int):
+        mask = self.component_mask[cid]
+        prob = {x:0 for x in hf_bit_list(mask)}
+        occupied = 0
+        for k,v in self.component[cid].items():
+            tmp0 = v.real*v.real + v.imag*v.imag
+            occupied |= k
+            for x in hf_bit_list(k):
+                prob[x] += tmp0
+        for x,y in prob.items():
+            self._probability[x] = y
+            if not ((occupied>>x)&1):
+                self.pos2tag[x] = None
+
+    def _compute_probability_i(self, index:int):
+        comp = self.component[self.qubit2component[index]]
+        ret = sum(v.real*v.real+v.imag*v.imag for k,v in comp.items() if (k>>index)&1)
+        return ret
+
+    def _hf_definite_control(self, control, negate_control):
+        # remove the control qubit in definite state, return None if the gate does nothing
+        if control is not None:
+            if not hasattr(control, '__len__'):
+                control = [int(control)]
+            if any(self._is_definite(x) and (self._probability[x]>0.5) for x in control):
+                return None
+            control = [x for x in control if not self._is_definite(x)]
+        if negate_control is not None:
+            if not hasattr(negate_control, '__len__'):
+                negate_control = [int(negate_control)]
+            if any(self._is_definite(x) and (self._probability[x]>0.5) for x in negate_control):
+                negate_control = None
+            else:
+                negate_control = [x for x in negate_control if not self._is_definite(x)]
+                if len(negate_control)==0:
+                    return None
+        return control, negate_control
+
+    def _apply_gate(self, hf_gate, src:int, dst:int, control, negate_control, tag_inverse):
+        tmp0 = self._hf_definite_control(control, negate_control)
+        if tmp0 is None:
+            return
+        control,negate_control = tmp0
+        cid = self._merge_component([src,dst] + list(control or []) + list(negate_control or []))
+        self._own_component(cid)
+        self._active = cid
+        hf_gate(self, src, dst, control, negate_control, tag_inverse)
+        self._active = None
+        self._split_deterministic(cid)
+
+    def apply_sqrtiswap(self, src:int, dst:int, control=None, negate_control=None, tag_inverse=False):
+        self._apply_gate(QChessSparseSimulatorInt.apply_sqrtiswap, src, dst, control, negate_control, tag_inverse)
+
+    def apply_iswap(self, src:int, dst:int, control=None, negate_control=None, tag_inverse=False):
+        self._apply_gate(QChessSparseSimulatorInt.apply_iswap, src, dst, control, negate_control, tag_inverse)
+
+    def _apply_fused_slide(self, index_list, path1, path2, table):
+        # path qubits in definite 0 never control, definite 1 are merged and split out again
+        path1 = [x for x in path1 if not (self._is_definite(x) and (self._probability[x]<0.5))]
+        path2 = [x for x in path2 if not (self._is_definite(x) and (self._probability[x]<0.5))]
+        cid = self._merge_component(list(index_list) + path1 + path2)
+        self._own_component(cid)
+        self._active = cid
+        super()._apply_fused_slide(index_list, path1, path2, table)
+        self._active = None
+        self._split_deterministic(cid)
+
+    def _drop_coeff_by(self, hf_drop, release_ancilla:bool=False):
+        self.drop_coeff([k for k in self.coeff.keys() if hf_drop(k)])
+        if release_ancilla:
+            self._release_definite_ancilla()
+
+    def drop_coeff(self, key_list):
+        # key in the active component
+        cid = self._active
+        if isinstance(key_list, int):
+            key_list = [key_list]
+        if len(key_list):
+            self._hash_amplitude = None
+            self._own_component(cid)
+            comp = self.component[cid]
+            for x in key_list:
+                comp.pop(x)
+            tmp1 = np.sqrt(sum(x.real*x.real+x.imag*x.imag for x in comp.values()))
+            assert tmp1 > _ZERO_EPS, 'zero probability'
+            tmp1 = 1/tmp1
+            self.component[cid] = {k:v*tmp1 for k,v in comp.items()}
+            self._update_component_probability(cid)
+            self._split_deterministic(cid)
+            if self.check_probability:
+                self._check_probability()
+
+    def measure(self, index, fix=None, seed=None):
+        index = hf_convert_pos_to_int(index)
+        self._active = self.qubit2component[index]
+        try:
+            super().measure(index, fix, seed)
+        finally:
+            self._active = None
+
+    def get_capture_slide_measure_prob(self, src, dst, path):
+        index_list = [hf_convert_pos_to_int(x) for x in [src,dst]+list(path)]
+        self._active = self._merge_component(index_list)
+        ret = super().get_capture_slide_measure_prob(src, dst, path)
+        self._active = None
+        return ret
+
+    def _capture_slide_measure(self, src, dst, path, measure_fix=None, seed=None):
+        index_list = [hf_convert_pos_to_int(x) for x in [src,dst]+list(path)]
+        cid = self._merge_component(index_list)
+        self._active = cid
+        try:
+            ret = super()._capture_slide_measure(src, dst, path, measure_fix, seed)
+        finally:
+            self._active = None
+        if cid in self.component:
+            self._split_deterministic(cid)
+        return ret
+
+    def truncate(self):
+        # truncate each component, the fidelity is the product of the kept probability
+        ret = 0
+        if (self.truncate_threshold is not None) or (self.truncate_max_branch is not None):
+            fidelity = 1
+            for cid in [x for x,y in self.component.items() if len(y)>1]:
+                self._active = cid
+                key_list,loss = self._get_truncate_key()
+                self.drop_coeff(key_list)
+                self._active = None
+                fidelity *= 1 - loss
+            ret = 1 - fidelity
+        self.last_truncation_loss = ret
+        return ret
+
+    def drop_ancilla(self, index:int|list):
+        if not hasattr(index,'__len__'):
+            index = [index]
+        index = sorted({int(x) for x in index})
+        assert all(x>=64 for x in index)
+        assert all(self._is_definite(x) for x in index)
+        self._hash_amplitude = None
+        for x in index[::-1]:
+            tmp0 = self.qubit2component.pop(x)
+            phase = next(iter(self.component.pop(tmp0).values()))
+            self.component_mask.pop(tmp0)
+            low = (1<<x) - 1
+            for cid,mask in list(self.component_mask.items()):
+                if mask>>x:
+                    self.component[cid] = {((k&low) | ((k>>(x+1))<<x)):v for k,v in self.component[cid].items()}
+                    self.component_mask[cid] = (mask&low) | ((mask>>(x+1))<<x)
+            if phase!=1:
+                cid = self.qubit2component[0]
+                self.component[cid] = {k:v*phase for k,v in self.component[cid].items()}
+            self.pos2tag.pop(x)
+            self._probability.pop(x)
+
+    def add_ancilla(self):
+        self.qubit2component.append(None)
+        super().add_ancilla()
+        self._new_component({0:1}, 1<<(len(self.pos2tag)-1))
+
+    def _release_definite_ancilla(self):
+        # an ancilla in a definite state is a single-qubit component, the free ones at the end are dropped
+        if len(self.pos2tag)==64:
+            return
+        for x in range(64, len(self.pos2tag)):
+            if (self.pos2tag[x] is not None) and self._is_definite(x):
+                self._set_definite(x, 0)
+                self.pos2tag[x] = None
+                self._probability[x] = 0
+        num_qubit = max((x for x in range(64, len(self.pos2tag)) if self.pos2tag[x] is not None), default=63) + 1
+        if num_qubit<len(self.pos2tag):
+            self.drop_ancilla(list(range(num_qubit, len(self.pos2tag))))
+
+    def _is_definite_one(self, index:int):
+        return self._is_definite(index) and (self._probability[index]>0.5)
+
+    def _clear_definite_qubit(self, index:int, phase:complex):
+        self._set_definite(index, 0)
+        cid = self.qubit2component[index]
+        self.component[cid] = {k:v*phase for k,v in self.component[cid].items()}
+        self.pos2tag[index] = None
+        self._probability[index] = 0
+
+    def get_correlation(self):
+        prob = np.array(self._probability[:64], dtype=np.float64)
+        ret = prob.reshape(-1,1) * prob
+        np.fill_diagonal(ret, prob)
+        for cid,comp in self.component.items():
+            index = [x for x in hf_bit_list(self.component_mask[cid]) if x<64]
+            if (len(comp)>1) and (len(index)>1):
+                key_list = list(comp.keys())
+                tmp0 = np.array([abs(comp[x])**2 for x in key_list], dtype=np.float64)
+                tmp1 = hf_int_key_to_bitarray(key_list, 64)[:,index].astype(np.float64)
+                ret[np.ix_(index,index)] = (tmp1.T * tmp0) @ tmp1
+        return ret
+
+    def _set_definite(self, pos:int, value:int):
+        cid = self.qubit2component[pos]
+        assert self.component_mask[cid]==(1<<pos)
+        self._hash_amplitude = None
+        phase = next(iter(self.component[cid].values()))
+        self.component[cid] = {(value<<pos):phase}
+
+    def add_piece(self, pos:int, tag:str):
+        assert (0<=pos<len(self.pos2tag)) and (self.pos2tag[pos] is None)
+        if tag not in self.tag_to_print_tag:
+            hf0 = lambda x: (x if x.isupper() else f'\033[94m{x.upper()}\033[0m')
+            self.tag_to_print_tag[tag] = hf0(tag)
+        self.pos2tag[pos] = tag
+        self._set_definite(pos, 1)
+        self._probability[pos] = 1
+
+    def remove_piece(self, pos:int):
+        assert (0<=pos<len(self.pos2tag)) and (self._get_probability_i(pos)>1-_ZERO_EPS)
+        self.pos2tag[pos] = None
+        self._set_definite(pos, 0)
+        self._probability[pos] = 0
+
+    def remove_all_piece(self):
+        self.pos2tag = [None]*64
+        self._probability = [0]*64
+        self.coeff = {0:1}
@@ -0,0 +1,305 @@
+import numpy as np
+
+from .utils import hf_int_to_bitstr, hf_convert_pos_to_int, QChessInvalidCommand
+from .chess_utils import QChessSparseSimulator, _ZERO_EPS
+
+_MASK64 = (1<<64) - 1
+
+
+def hf_control_to_mask(control, src:int, dst:int):
+    # None -> None, [3,5] -> 0b101000
+    if control is None:
+        return None
+    if not hasattr(control, '__len__'):
+        control = [int(control)]
+    tmp0 = {int(x) for x in control}
+    assert (len(tmp0)==len(control)) and (src not in tmp0) and (dst not in tmp0)
+    ret = 0
+    for x in tmp0:
+        ret |= (1<<x)
+    return ret
+
+
+def hf_int_key_to_bitarray(key_list, n:int=64):
+    # [key0, key1, ...] -> (N,n) uint8, only the lowest 64 bits are supported
+    assert n<=64
+    tmp0 = np.array([(x & _MASK64) for x in key_list], dtype=np.uint64).reshape(-1)
+    tmp1 = np.unpackbits(tmp0.view(np.uint8).reshape(-1,8), axis=1, bitorder='little')
+    ret = tmp1[:,:n]
+    return ret
+
+
+class QChessSparseSimulatorInt(QChessSparseSimulator):
+    # same as QChessSparseSimulator, but basis key is python int (bit i is qubit i, ancilla qubit i>=64)
+    def __init__(self, state0:int=0xFFFF00000000FFFF, tag_list='RNBQKBNRPPPPPPPPpppppppprnbqkbnr', seed=None):
+        super().__init__(state0, tag_list, seed)
+        self.coeff = {int(state0):1}
+        # coeff dict[int, complex]
+
+    def _key_to_str(self, key)->str:
+        return hf_int_to_bitstr(key, len(self.pos2tag))
+
+    def _select_key(self, index:int, value:int):
+        if self._square_index is not None:
+            return self._select_key_index(index, value)
+        if value:
+            ret = [x for x in self.coeff.keys() if (x>>index)&1]
+        else:
+            ret = [x for x in self.coeff.keys() if not ((x>>index)&1)]
+        return ret
+
+    @staticmethod
+    def _key_mask(key):
+        return key
+
+    @staticmethod
+    def _key_ancilla_mask(key):
+        return key >> 64
+
+    @staticmethod
+    def _hf_release_key(index_list, num_qubit:int):
+        mask = (1<<num_qubit) - 1
+        for x in index_list:
+            mask &= ~(1<<x)
+        return lambda k: k & mask
+
+    def _hf_key_bit(self, index:int):
+        return lambda k: (k>>index)&1
+
+    @staticmethod
+    def _key_one_list(key):
+        ret = []
+        while key:
+            tmp0 = key & (-key)
+            ret.append(tmp0.bit_length()-1)
+            key ^= tmp0
+        return ret
+
+    def _get_key_with_one(self, index_list):
+        if self._square_index is None:
+            mask = 0
+            for x in index_list:
+                mask |= (1<<x)
+            ret = {k for k in self.coeff.keys() if k&mask}
+        else:
+            ret = self._square_index.get_key(index_list)
+        return ret
+
+    def _swap_key(self, key, src:int, dst:int):
+        return key ^ ((1<<src) | (1<<dst))
+
+    def _flip_key(self, key, index:int):
+        return key ^ (1<<index)
+
+    def _hf_fused_key(self, index_list, path1, path2):
+        mask = sum(1<<x for x in index_list)
+        mask1 = sum(1<<x for x in path1)
+        mask2 = sum(1<<x for x in path2)
+        state2key = [sum(((y>>i)&1)<<x for i,x in enumerate(index_list)) for y in range(1<<len(index_list))]
+        if len(index_list)==3:
+            x0,x1,x2 = index_list
+            hf_state = lambda k: ((k>>x0)&1) | (((k>>x1)&1)<<1) | (((k>>x2)&1)<<2)
+        else:
+            hf_state = lambda k: sum(((k>>x)&1)<<i for i,x in enumerate(index_list))
+        hf_cond = lambda k: 2*bool(k&mask1) + bool(k&mask2)
+        hf_set = lambda k,y: (k & ~mask) | state2key[y]
+        return hf_state, hf_cond, hf_set
+
+    def _compute_probability_i(self, index:int):
+        ret = sum(v.real*v.real+v.imag*v.imag for k,v in self.coeff.items() if (k>>index)&1)
+        return ret
+
+    def _accumulate_probability(self, coeff_iter):
+        ret = [0]*len(self.pos2tag)
+        for k,v in coeff_iter:
+            tmp0 = v.real*v.real + v.imag*v.imag
+            while k:
+                tmp1 = k & (-k)
+                ret[tmp1.bit_length()-1] += tmp0
+                k ^= tmp1
+        return ret
+
+    def _pop_affected_coeff(self, src:int, dst:int):
+        self._own_coeff()
+        coeff_old = {k:self.coeff.pop(k) for k in self._get_key_with_one([src,dst])}
+        return coeff_old
+
+    def apply_sqrtiswap(self, src:int, dst:int, control=None, negate_control=None, tag_inverse=False):
+        assert src!=dst
+        cmask = hf_control_to_mask(control, src, dst)
+        nmask = hf_control_to_mask(negate_control, src, dst)
+        x0 = self.pos2tag[src]
+        x2 = self.pos2tag[dst]
+        assert ((x0 is None) and (x2 is not None)) or ((x0 is not None) and (x2 is None)) or ((x0==x2) and (x0 is not None))
+        tag = x0 if (x0 is not None) else x2
+        bs = 1<<src
+        bsd = bs | (1<<dst)
+        cmask = 0 if (cmask is None) else cmask
+        coeff_old = self._pop_affected_coeff(src, dst)
+        has_src = False
+        has_dst = False
+        coeff_new = dict()
+        s12 = 1/np.sqrt(2)
+        phase = (-1j*s12) if tag_inverse else (1j*s12)
+        prob_src = 0 #change of the marginal probability
+        prob_dst = 0
+        for k0,v0 in coeff_old.items():
+            if ((k0&bsd)==bsd) or (k0&cmask) or ((nmask is not None) and not (k0&nmask)):
+                self.coeff[k0] = v0 # nothing change
+                if k0&bs:
+                    has_src = True
+                if (k0&bsd)!=bs:
+                    has_dst = True
+                continue
+            if k0&bs:
+                prob_src -= v0.real*v0.real + v0.imag*v0.imag
+            else:
+                prob_dst -= v0.real*v0.real + v0.imag*v0.imag
+            coeff_new[k0] = coeff_new.get(k0, 0) + v0*s12
+            k2 = k0 ^ bsd
+            coeff_new[k2] = coeff_new.get(k2, 0) + v0*phase
+        for k,v in coeff_new.items():
+            tmp0 = v.real*v.real + v.imag*v.imag
+            if tmp0 < _ZERO_EPS:
+                continue
+            self.coeff[k] = v
+            if k&bs:
+                has_src = True
+                prob_src += tmp0
+            else:
+                has_dst = True
+                prob_dst += tmp0
+        self.pos2tag[src] = tag if has_src else None
+        self.pos2tag[dst] = tag if has_dst else None
+        self._update_probability_src_dst(src, dst, prob_src, prob_dst)
+        self._update_square_index(coeff_old.keys(), coeff_new.keys(), src, dst)
+        self._on_coeff_delta(coeff_old, coeff_new.keys(), src, dst)
+
+    def apply_iswap(self, src:int, dst:int, control=None, negate_control=None, tag_inverse=False):
+        # when control all zero, apply iswap
+        assert src!=dst
+        cmask = hf_control_to_mask(control, src, dst)
+        nmask = hf_control_to_mask(negate_control, src, dst)
+        x0 = self.pos2tag[src]
+        x2 = self.pos2tag[dst]
+        assert ((x0 is None) and (x2 is not None)) or ((x0 is not None) and (x2 is None)) or ((x0==x2) and (x0 is not None)), f'src={src}, dst={dst}, x0={x0}, x2={x2}'
+        tag = x0 if (x0 is not None) else x2
+        bs = 1<<src
+        bsd = bs | (1<<dst)
+        cmask = 0 if (cmask is None) else cmask
+        coeff_old = self._pop_affected_coeff(src, dst)
+        phase = -1j if tag_inverse else 1j
+        has_src = False
+        has_dst = False
+        prob_src_to_dst = 0
+        prob_dst_to_src = 0
+        key_new = []
+        for k0,v0 in coeff_old.items():
+            if ((k0&bsd)==bsd) or (k0&cmask) or ((nmask is not None) and not (k0&nmask)):
+                self.coeff[k0] = v0 # nothing change
+                if k0&bs:
+                    has_src = True
+                if (k0&bsd)!=bs:
+                    has_dst = True
+                continue
+            self.coeff[k0 ^ bsd] = v0*phase
+            key_new.append(k0 ^ bsd)
+            if k0&bs:
+                has_dst = True
+                prob_src_to_dst += v0.real*v0.real + v0.imag*v0.imag
+            else:
+                has_src = True
+                prob_dst_to_src += v0.real*v0.real + v0.imag*v0.imag
+        self.pos2tag[src] = tag if has_src else None
+        self.pos2tag[dst] = tag if has_dst else None
+        tmp0 = prob_dst_to_src - prob_src_to_dst
+        self._update_probability_src_dst(src, dst, tmp0, -tmp0)
+        self._update_square_index(coeff_old.keys(), key_new, src, dst)
+        self._on_coeff_delta(coeff_old, key_new, src, dst)
+
+    def drop_ancilla(self, index:int|list):
+        if not hasattr(index,'__len__'):
+            index = [index]
+        index = sorted({int(x) for x in index})
+        assert all(x>=64 for x in index)
+        tmp0 = (self._get_probability_i(x) for x in index)
+        assert all((x<_ZERO_EPS) or (x>1-_ZERO_EPS) for x in tmp0)
+        self._on_coeff_replace()
+        for x in index[::-1]:
+            low = (1<<x) - 1
+            self.coeff = {((k&low) | ((k>>(x+1))<<x)):v for k,v in self.coeff.items()}
+            self.pos2tag.pop(x)
+            self._probability.pop(x)
+        self._rebuild_square_index()
+
+    def add_ancilla(self):
+        # new qubit is |0>, no need to touch the basis key
+        self._on_coeff_replace()
+        self.pos2tag.append(None)
+        self._probability.append(0)
+        if self._square_index is not None:
+            self._square_index.square.append(set())
+
+    def get_correlation(self):
+        key_list = list(self.coeff.keys())
+        prob = np.array([abs(self.coeff[x])**2 for x in key_list], dtype=np.float64)
+        tmp0 = hf_int_key_to_bitarray(key_list, 64).astype(np.float64)
+        ret = (tmp0.T * prob) @ tmp0
+        return ret
+
+    def _get_capture_slide_measure_M0_m1_key(self, src, dst, path):
+        src:int = hf_convert_pos_to_int(src)
+        dst:int = hf_convert_pos_to_int(dst)
+        path = [hf_convert_pos_to_int(x) for x in path]
+        tmp0 = set(path)
+        if ((src==dst) or (not (0<=src<64)) or (not (0<=dst<64)) or (len(tmp0)<len(path)) or (len(path)==0)
+                or (src in tmp0) or (dst in tmp0) or any(not (0<=x<64) for x in path)):
+            raise QChessInvalidCommand(f'invalid src="{src}", dst="{dst}", path="{path}"')
+        if self._square_index is not None:
+            return self._get_capture_slide_measure_M0_m1_key_index(src, dst, path)
+        bs = 1<<src
+        bt = 1<<dst
+        bp = 0
+        for x in path:
+            bp |= (1<<x)
+        M0_list = []
+        M1_list = []
+        for key in self.coeff.keys():
+            # (bp,bt,bs) in {(F,F,F),(T,T,T),(T,T,F),(F,T,F)} -> M0
+            if key&bp:
+                tmp0 = bool(key&bt)
+            else:
+                tmp0 = not (key&bs)
+            if tmp0:
+                M0_list.append(key)
+            else:
+                M1_list.append(key)
+        return M0_list,M1_list
+
+    def add_piece(self, pos:int, tag:str):
+        assert (0<=pos<len(self.pos2tag)) and (self.pos2tag[pos] is None)
+        if tag not in self.tag_to_print_tag:
+            hf0 = lambda x: (x if x.isupper() else f'\033[94m{x.upper()}\033[0m')
+            self.tag_to_print_tag[tag] = hf0(tag)
+        self._on_coeff_replace()
+        self.pos2tag[pos] = tag
+        tmp0 = 1<<pos
+        self.coeff = {(k^tmp0):v for k,v in self.coeff.items()}
+        self._probability[pos] = 1
+        self._rebuild_square_index()
+
+    def remove_piece(self, pos:int):
+        assert (0<=pos<len(self.pos2tag)) and (self._get_probability_i(pos)>1-_ZERO_EPS)
+        self._on_coeff_replace()
+        self.pos2tag[pos] = None
+        tmp0 = 1<<pos
+        self.coeff = {(k^tmp0):v for k,v in self.coeff.items()}
+        self._probability[pos] = 0
+        self._rebuild_square_index()
+
+    def remove_all_piece(self):
+        self._on_coeff_replace()
+        self.coeff = {0:1}
+        self.pos2tag = [None]*64
+        self._probability = [0]*64
+        self._rebuild_square_index()
@@ -0,0 +1,444 @@
+import numpy as np
+
+from .utils import hf_int_to_bitstr, hf_convert_pos_to_int, QChessInvalidCommand, get_rng
+from .chess_utils import QChessSparseSimulator, _ZERO_EPS, _ZOBRIST_ANGLE, hf_zobrist_digest
+
+_U64_ONE = np.uint64(1)
+_U64_ZERO = np.uint64(0)
+_MASK64 = (1<<64) - 1
+_MAX_QUBIT = 128 #64 squares + 64 ancilla qubits
+
+
+def hf_uint64_to_bitarray(x:np.ndarray, n:int=64):
+    # (N,) uint64 -> (N,n) uint8, little endian
+    tmp0 = np.ascontiguousarray(x, dtype=np.uint64).reshape(-1)
+    ret = np.unpackbits(tmp0.view(np.uint8).reshape(-1,8), axis=1, bitorder='little')[:,:n]
+    return ret
+
+
+def hf_merge_duplicate_key(basis, basis_anc, amplitude):
+    # sum the amplitude of the same (basis,basis_anc) key, drop the zero amplitude
+    if basis.shape[0]==0:
+        return basis, basis_anc, amplitude
+    ind0 = np.lexsort((basis, basis_anc))
+    basis = basis[ind0]
+    basis_anc = basis_anc[ind0]
+    amplitude = amplitude[ind0]
+    tmp0 = np.ones(basis.shape[0], dtype=np.bool_)
+    tmp0[1:] = (basis[1:]!=basis[:-1]) | (basis_anc[1:]!=basis_anc[:-1])
+    ind1 = np.nonzero(tmp0)[0]
+    basis = basis[ind1]
+    basis_anc = basis_anc[ind1]
+    amplitude = np.add.reduceat(amplitude, ind1)
+    tmp1 = (amplitude.real*amplitude.real + amplitude.imag*amplitude.imag) >= _ZERO_EPS
+    return basis[tmp1], basis_anc[tmp1], amplitude[tmp1]
+
+
+_FUSED_TABLE_ARRAY = dict()
+
+def hf_fused_table_array(table):
+    # see hf_fused_slide_table(), ([state0,state1], [factor0,factor1], is_split)
+    # state_i/factor_i (4,8): local state and factor of the i-th output, the second output of a one-output row is unused
+    if id(table) not in _FUSED_TABLE_ARRAY:
+        shape = (len(table), len(table[0]))
+        state_new = [np.zeros(shape, dtype=np.int64) for _ in range(2)]
+        factor = [np.zeros(shape, dtype=np.complex128) for _ in range(2)]
+        is_split = np.zeros(shape, dtype=np.bool_)
+        for cond,tmp0 in enumerate(table):
+            for state,tmp1 in enumerate(tmp0):
+                is_split[cond,state] = len(tmp1)>1
+                for i,(state1,x) in enumerate(tmp1):
+                    state_new[i][cond,state] = state1
+                    factor[i][cond,state] = x
+        _FUSED_TABLE_ARRAY[id(table)] = state_new, factor, is_split
+    return _FUSED_TABLE_ARRAY[id(table)]
+
+
+class QChessSparseSimulatorNumpy(QChessSparseSimulator):
+    # same as QChessSparseSimulator, but the superposition is kept in parallel numpy arrays
+    # basis(uint64): qubit 0-63, basis_anc(uint64): ancilla qubit 64-127, amplitude(complex128)
+    # coeff is a read-only view dict[int, complex] with the same key as QChessSparseSimulatorInt
+    _journal_by_snapshot = True
+    _hash_incremental = False #vectorized full scan, see _compute_hash_amplitude()
+    def __init__(self, state0:int=0xFFFF00000000FFFF, tag_list='RNBQKBNRPPPPPPPPpppppppprnbqkbnr', seed=None):
+        super().__init__(state0, tag_list, seed)
+        self.basis = np.array([state0], dtype=np.uint64)
+        self.basis_anc = np.zeros(1, dtype=np.uint64)
+        self.amplitude = np.ones(1, dtype=np.complex128)
+
+    @property
+    def coeff(self):
+        tmp0 = zip(self.basis.tolist(), self.basis_anc.tolist(), self.amplitude.tolist())
+        ret = {(x | (y<<64)):z for x,y,z in tmp0}
+        return ret
+
+    @coeff.setter
+    def coeff(self, value:dict):
+        key_list = [(int(x) if isinstance(x,(int,np.integer)) else int(x[::-1],2)) for x in value.keys()]
+        self.basis = np.array([(x & _MASK64) for x in key_list], dtype=np.uint64)
+        self.basis_anc = np.array([(x>>64) for x in key_list], dtype=np.uint64)
+        self.amplitude = np.array(list(value.values()), dtype=np.complex128)
+
+    def _clone_from_sim(self, sim1):
+        self.pos2tag = list(sim1.pos2tag)
+        self.rng.setstate(sim1.rng.getstate())
+        self.basis = sim1.basis.copy()
+        self.basis_anc = sim1.basis_anc.copy()
+        self.amplitude = sim1.amplitude.copy()
+        self.last_measure = sim1.last_measure
+        self.last_measure1_prob = sim1.last_measure1_prob
+        self._probability = list(sim1._probability)
+
+    def enable_square_index(self, enable:bool=True):
+        # gates are vectorized over all the keys, square index is not used
+        pass
+
+    def get_num_amplitude(self):
+        return self.amplitude.shape[0]
+
+    def _own_coeff(self):
+        # numpy arrays are never changed in place, nothing to do for copy-on-write
+        pass
+
+    def _compute_hash_accumulator(self):
+        # same as hf_zobrist_amplitude(), the angle in uint64 arithmetic (mod 2**64)
+        bit_list = [self._bit(x) for x in range(len(self.pos2tag))]
+        ret = []
+        for angle_list in _ZOBRIST_ANGLE:
+            angle = np.zeros(self.amplitude.shape[0], dtype=np.uint64)
+            for x,y in zip(bit_list, angle_list):
+                angle += np.where(x, np.uint64(y), _U64_ZERO)
+            ret.append(complex(np.sum(self.amplitude * np.exp(2j*np.pi*(angle.astype(np.float64)/2**64)))))
+        return tuple(ret)
+
+    def _compute_hash_amplitude(self):
+        return hf_zobrist_digest(self._compute_hash_accumulator())
+
+    def _key_to_str(self, key)->str:
+        return hf_int_to_bitstr(key, len(self.pos2tag))
+
+    def _bit(self, index:int):
+        if index<64:
+            ret = ((self.basis >> np.uint64(index)) & _U64_ONE).astype(np.bool_)
+        else:
+            ret = ((self.basis_anc >> np.uint64(index-64)) & _U64_ONE).astype(np.bool_)
+        return ret
+
+    def _hf_control(self, control, src:int, dst:int, is_negate:bool):
+        # control: any control qubit is 1 -> nothing change
+        # negate_control: all negate_control qubit is 0 -> nothing change
+        if control is None:
+            return None
+        if not hasattr(control, '__len__'):
+            control = [int(control)]
+        tmp0 = {int(x) for x in control}
+        assert (len(tmp0)==len(control)) and (src not in tmp0) and (dst not in tmp0)
+        ret = np.zeros(self.basis.shape[0], dtype=np.bool_)
+        for x in tmp0:
+            ret |= self._bit(x)
+        if is_negate:
+            ret = ~ret
+        return ret
+
+    def _get_active_mask(self, src, dst, control, negate_control):
+        bit_src = self._bit(src)
+        bit_dst = self._bit(dst)
+        ret = bit_src ^ bit_dst
+        tmp0 = self._hf_control(control, src, dst, False)
+        if tmp0 is not None:
+            ret &= ~tmp0
+        tmp0 = self._hf_control(negate_control, src, dst, True)
+        if tmp0 is not None:
+            ret &= ~tmp0
+        return ret
+
+    def _get_swap_mask(self, src:int, dst:int):
+        # xor mask on (basis,basis_anc) to flip both src and dst
+        tmp0 = [0, 0]
+        tmp0[src//64] |= 1<<(src%64)
+        tmp0[dst//64] |= 1<<(dst%64)
+        return np.uint64(tmp0[0]), np.uint64(tmp0[1])
+
+    def _update_pos2tag_src_dst(self, src, dst, tag):
+        self.pos2tag[src] = tag if self._bit(src).any() else None
+        self.pos2tag[dst] = tag if self._bit(dst).any() else None
+
+    def apply_iswap(self, src:int, dst:int, control=None, negate_control=None, tag_inverse=False):
+        assert src!=dst
+        x0 = self.pos2tag[src]
+        x2 = self.pos2tag[dst]
+        assert ((x0 is None) and (x2 is not None)) or ((x0 is not None) and (x2 is None)) or ((x0==x2) and (x0 is not None)), f'src={src}, dst={dst}, x0={x0}, x2={x2}'
+        tag = x0 if (x0 is not None) else x2
+        active = self._get_active_mask(src, dst, control, negate_control)
+        mask0,mask1 = self._get_swap_mask(src, dst)
+        tmp0 = self._bit(src)[active]
+        prob = self._hf_abs2(self.amplitude[active])
+        prob_src_to_dst = float(prob[tmp0].sum())
+        prob_dst_to_src = float(prob.sum()) - prob_src_to_dst
+        self.basis = np.where(active, self.basis ^ mask0, self.basis)
+        if mask1:
+            self.basis_anc = np.where(active, self.basis_anc ^ mask1, self.basis_anc)
+        self.amplitude = np.where(active, self.amplitude*(-1j if tag_inverse else 1j), self.amplitude)
+        self._update_pos2tag_src_dst(src, dst, tag)
+        tmp0 = prob_dst_to_src - prob_src_to_dst
+        self._update_probability_src_dst(src, dst, tmp0, -tmp0)
+
+    def apply_sqrtiswap(self, src:int, dst:int, control=None, negate_control=None, tag_inverse=False):
+        assert src!=dst
+        x0 = self.pos2tag[src]
+        x2 = self.pos2tag[dst]
+        assert ((x0 is None) and (x2 is not None)) or ((x0 is not None) and (x2 is None)) or ((x0==x2) and (x0 is not None))
+        tag = x0 if (x0 is not None) else x2
+        active = self._get_active_mask(src, dst, control, negate_control)
+        mask0,mask1 = self._get_swap_mask(src, dst)
+        s12 = 1/np.sqrt(2)
+        phase = (-1j*s12) if tag_inverse else (1j*s12)
+        # only the active keys can collide with each other
+        basis0 = self.basis[active]
+        basis_anc0 = self.basis_anc[active]
+        amplitude0 = self.amplitude[active]
+        prob_src,prob_dst = self._hf_prob_src_dst(basis0, basis_anc0, amplitude0, src)
+        tmp0 = np.concatenate([basis0, basis0 ^ mask0])
+        tmp1 = np.concatenate([basis_anc0, basis_anc0 ^ mask1])
+        tmp2 = np.concatenate([amplitude0*s12, amplitude0*phase])
+        tmp0,tmp1,tmp2 = hf_merge_duplicate_key(tmp0, tmp1, tmp2)
+        inactive = ~active
+        self.basis = np.concatenate([self.basis[inactive], tmp0])
+        self.basis_anc = np.concatenate([self.basis_anc[inactive], tmp1])
+        self.amplitude = np.concatenate([self.amplitude[inactive], tmp2])
+        self._update_pos2tag_src_dst(src, dst, tag)
+        tmp3,tmp4 = self._hf_prob_src_dst(tmp0, tmp1, tmp2, src)
+        self._update_probability_src_dst(src, dst, tmp3-prob_src, tmp4-prob_dst)
+
+    def _apply_fused_slide(self, index_list, path1, path2, table):
+        # rows with one output are moved in place, only the rows through the sqrtiswap can collide with each other
+        assert all(x<64 for x in list(index_list)+list(path1)+list(path2))
+        tag = next(self.pos2tag[x] for x in index_list if self.pos2tag[x] is not None)
+        state_new,factor,is_split = hf_fused_table_array(table)
+        state2mask = np.array([sum(((y>>i)&1)<<x for i,x in enumerate(index_list)) for y in range(1<<len(index_list))], dtype=np.uint64)
+        state = np.zeros(self.basis.shape[0], dtype=np.int64)
+        for i,x in enumerate(index_list):
+            state |= self._bit(x).astype(np.int64) << i
+        cond = np.zeros(self.basis.shape[0], dtype=np.int64)
+        for x in path1:
+            cond |= self._bit(x).astype(np.int64) << 1
+        for x in path2:
+            cond |= self._bit(x).astype(np.int64)
+        basis0 = self.basis & ~state2mask[-1]
+        split = is_split[cond,state]
+        single = ~split
+        tmp0 = basis0[single] | state2mask[state_new[0][cond[single],state[single]]]
+        tmp1 = self.amplitude[single] * factor[0][cond[single],state[single]]
+        tmp2,tmp3,tmp4 = hf_merge_duplicate_key(
+            np.concatenate([basis0[split] | state2mask[state_new[i][cond[split],state[split]]] for i in range(2)]),
+            np.concatenate([self.basis_anc[split]]*2),
+            np.concatenate([self.amplitude[split] * factor[i][cond[split],state[split]] for i in range(2)]))
+        self.basis = np.concatenate([tmp0, tmp2])
+        self.basis_anc = np.concatenate([self.basis_anc[single], tmp3])
+        self.amplitude = np.concatenate([tmp1, tmp4])
+        for x in index_list:
+            self.pos2tag[x] = tag if self._bit(x).any() else None
+            self._probability[x] = self._compute_probability_i(x)
+        if self.check_probability:
+            self._check_probability()
+
+    @staticmethod
+    def _hf_abs2(amplitude):
+        return amplitude.real*amplitude.real + amplitude.imag*amplitude.imag
+
+    def _hf_prob_src_dst(self, basis, basis_anc, amplitude, src:int):
+        # amplitude only has 01/10 on (src,dst) -> (probability of src, probability of dst)
+        tmp0 = basis if (src<64) else basis_anc
+        tmp1 = ((tmp0 >> np.uint64(src%64)) & _U64_ONE).astype(np.bool_)
+        prob = self._hf_abs2(amplitude)
+        ret0 = float(prob[tmp1].sum())
+        return ret0, float(prob.sum())-ret0
+
+    def _compute_probability_i(self, index:int):
+        tmp0 = self.amplitude[self._bit(index)]
+        ret = float(np.dot(tmp0.real, tmp0.real) + np.dot(tmp0.imag, tmp0.imag))
+        return ret
+
+    def _compute_probability_all(self):
+        prob = self._hf_abs2(self.amplitude)
+        n = len(self.pos2tag)
+        ret = (prob @ hf_uint64_to_bitarray(self.basis, 64)).tolist()
+        if n>64:
+            ret += (prob @ hf_uint64_to_bitarray(self.basis_anc, n-64)).tolist()
+        return ret
+
+    def get_correlation(self):
+        prob = self.amplitude.real**2 + self.amplitude.imag**2
+        tmp0 = hf_uint64_to_bitarray(self.basis, 64).astype(np.float64)
+        ret = (tmp0.T * prob) @ tmp0
+        return ret
+
+    def _select_key(self, index:int, value:int):
+        # boolean mask instead of key list, consumed by drop_coeff()
+        ret = self._bit(index)
+        if not value:
+            ret = ~ret
+        return ret
+
+    def _key_list_to_mask(self, key_list):
+        tmp0 = {int(x) for x in key_list}
+        key_all = zip(self.basis.tolist(), self.basis_anc.tolist())
+        ret = np.array([((x | (y<<64)) in tmp0) for x,y in key_all], dtype=np.bool_)
+        return ret
+
+    def _drop_coeff_where(self, index:int, value:int, release_ancilla:bool=False):
+        self.drop_coeff(self._select_key(index, value))
+        if release_ancilla:
+            self._release_definite_ancilla()
+
+    def drop_coeff(self, key_list):
+        if isinstance(key_list, np.ndarray) and (key_list.dtype==np.bool_):
+            drop = key_list
+        else:
+            if isinstance(key_list, (int,np.integer)):
+                key_list = [key_list]
+            drop = self._key_list_to_mask(key_list)
+        if drop.any():
+            keep = ~drop
+            amplitude = self.amplitude[keep]
+            tmp1 = np.sqrt(np.dot(amplitude.real, amplitude.real) + np.dot(amplitude.imag, amplitude.imag))
+            assert tmp1 > _ZERO_EPS, 'zero probability'
+            self.basis = self.basis[keep]
+            self.basis_anc = self.basis_anc[keep]
+            self.amplitude = amplitude / tmp1
+            occupied = np.bitwise_or.reduce(self.basis) if self.basis.shape[0] else _U64_ZERO
+            occupied_anc = np.bitwise_or.reduce(self.basis_anc) if self.basis.shape[0] else _U64_ZERO
+            occupied = int(occupied) | (int(occupied_anc)<<64)
+            self.pos2tag = [(x1 if ((occupied>>x0)&1) else None) for x0,x1 in enumerate(self.pos2tag)]
+            self._probability = self._compute_probability_all()
+            if self.check_probability:
+                self._check_probability()
+
+    def _get_truncate_key(self):
+        prob = self._hf_abs2(self.amplitude)
+        ind0 = np.argsort(-prob, kind='stable')
+        num_keep = prob.shape[0]
+        if self.truncate_max_branch is not None:
+            num_keep = min(num_keep, self.truncate_max_branch)
+        if self.truncate_threshold is not None:
+            num_keep = max(1, min(num_keep, int((prob>=self.truncate_threshold).sum())))
+        drop = np.zeros(prob.shape[0], dtype=np.bool_)
+        drop[ind0[num_keep:]] = True
+        loss = float(prob[drop].sum())
+        return drop, loss
+
+    def drop_ancilla(self, index:int|list):
+        if not hasattr(index,'__len__'):
+            index = [index]
+        index = sorted({int(x) for x in index})
+        assert all(x>=64 for x in index)
+        tmp0 = (self._get_probability_i(x) for x in index)
+        assert all((x<_ZERO_EPS) or (x>1-_ZERO_EPS) for x in tmp0)
+        for x in index[::-1]:
+            x = x - 64
+            low = self.basis_anc & np.uint64((1<<x) - 1)
+            if x<63:
+                low = low | ((self.basis_anc >> np.uint64(x+1)) << np.uint64(x))
+            self.basis_anc = low
+            self.pos2tag.pop(x+64)
+            self._probability.pop(x+64)
+
+    def add_ancilla(self):
+        assert len(self.pos2tag) < _MAX_QUBIT, 'too many ancilla qubits'
+        self.pos2tag.append(None)
+        self._probability.append(0)
+
+    def _release_definite_ancilla(self):
+        # see QChessSparseSimulator._drop_coeff_by(), the free ancilla qubits at the end have no bit set in basis_anc
+        if len(self.pos2tag)==64:
+            return
+        release,num_qubit = self._get_release_ancilla(int(np.bitwise_or.reduce(self.basis_anc)), int(np.bitwise_and.reduce(self.basis_anc)))
+        mask = (1<<(num_qubit-64)) - 1
+        for x in release:
+            mask &= ~(1<<(x-64))
+            self.pos2tag[x] = None
+            self._probability[x] = 0
+        self.basis_anc = self.basis_anc & np.uint64(mask)
+        del self.pos2tag[num_qubit:]
+        del self._probability[num_qubit:]
+
+    def _is_definite_one(self, index:int):
+        return bool(self._bit(index).all())
+
+    def _clear_definite_qubit(self, index:int, phase:complex):
+        self._flip_bit(index)
+        self.amplitude = self.amplitude * phase
+        self.pos2tag[index] = None
+        self._probability[index] = 0
+
+    def _get_capture_slide_measure_M0_m1_key(self, src, dst, path):
+        src:int = hf_convert_pos_to_int(src)
+        dst:int = hf_convert_pos_to_int(dst)
+        path = [hf_convert_pos_to_int(x) for x in path]
+        tmp0 = set(path)
+        if ((src==dst) or (not (0<=src<64)) or (not (0<=dst<64)) or (len(tmp0)<len(path)) or (len(path)==0)
+                or (src in tmp0) or (dst in tmp0) or any(not (0<=x<64) for x in path)):
+            raise QChessInvalidCommand(f'invalid src="{src}", dst="{dst}", path="{path}"')
+        bs = self._bit(src)
+        bt = self._bit(dst)
+        bp = self._hf_control(path, src, dst, False)
+        # (bp,bt,bs) in {(F,F,F),(T,T,T),(T,T,F),(F,T,F)} -> M0
+        M0 = np.where(bp, bt, ~bs)
+        return M0, ~M0
+
+    def get_capture_slide_measure_prob(self, src, dst, path):
+        _,M1 = self._get_capture_slide_measure_M0_m1_key(src, dst, path)
+        tmp0 = self.amplitude[M1]
+        prob1 = float(np.dot(tmp0.real, tmp0.real) + np.dot(tmp0.imag, tmp0.imag))
+        return prob1
+
+    def _capture_slide_measure(self, src, dst, path, measure_fix=None, seed=None):
+        M0,M1 = self._get_capture_slide_measure_M0_m1_key(src, dst, path)
+        tmp0 = self.amplitude[M1]
+        prob1 = float(np.dot(tmp0.real, tmp0.real) + np.dot(tmp0.imag, tmp0.imag))
+        if prob1<_ZERO_EPS:
+            return 'meaningless move'
+        self._check_peek(prob1)
+        if measure_fix is not None:
+            assert measure_fix in {0,1}
+            result = measure_fix
+        else:
+            rng = get_rng(seed, self.rng)
+            result = int(rng.uniform(0,1)<prob1)
+        self.last_measure = result
+        self.last_measure1_prob = prob1
+        self.drop_coeff(M1 if result==0 else M0)
+        self._release_definite_ancilla()
+
+    def _classical_move_key(self, src:int, dst:int, phase:complex):
+        tmp0 = (1<<src) if (self.pos2tag[dst] is not None) else ((1<<src) | (1<<dst))
+        self.basis = self.basis ^ np.uint64(tmp0)
+        self.amplitude = self.amplitude * phase
+
+    def _flip_bit(self, pos:int):
+        if pos<64:
+            self.basis = self.basis ^ np.uint64(1<<pos)
+        else:
+            self.basis_anc = self.basis_anc ^ np.uint64(1<<(pos-64))
+
+    def add_piece(self, pos:int, tag:str):
+        assert (0<=pos<len(self.pos2tag)) and (self.pos2tag[pos] is None)
+        if tag not in self.tag_to_print_tag:
+            hf0 = lambda x: (x if x.isupper() else f'\033[94m{x.upper()}\033[0m')
+            self.tag_to_print_tag[tag] = hf0(tag)
+        self.pos2tag[pos] = tag
+        self._flip_bit(pos)
+        self._probability[pos] = 1
+
+    def remove_piece(self, pos:int):
+        assert (0<=pos<len(self.pos2tag)) and (self._get_probability_i(pos)>1-_ZERO_EPS)
+        self.pos2tag[pos] = None
+        self._flip_bit(pos)
+        self._probability[pos] = 0
+
+    def remove_all_piece(self):
+        self.basis = np.zeros(1, dtype=np.uint64)
+        self.basis_anc = np.zeros(1, dtype=np.uint64)
+        self.amplitude = np.ones(1, dtype=np.complex128)
+        self.pos2tag = [None]*64
+        self._probability = [0]*64
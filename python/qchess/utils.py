@@ -1,4 +1,5 @@
 import random
+import typing
 import numpy as np
 
 
@@ -74,12 +75,10 @@ def hf_convert_pos_to_int(x):
             raise QChessInvalidCommand(f'invalid pos="{x}"')
         return x
     elif isinstance(x, str):
-        if len(x)!=2:
+        tmp0 = _POSITION_STR.get(x)
+        if tmp0 is None:
             raise QChessInvalidCommand(f'invalid pos="{x}"')
-        x0,x1 = x
-        if (x0 not in 'abcdefgh') or (x1 not in '12345678'):
-            raise QChessInvalidCommand(f'invalid pos="{x}"')
-        return (int(x1)-1)*8 + 'abcdefgh'.index(x0)
+        return tmp0.pos
     else:
         raise QChessInvalidCommand(f'invalid pos="{x}"')
 
@@ -90,75 +89,183 @@ def hf_convert_pos_to_file_rank(x:str)->(int,int):
 
 
 class ChessPosition:
-    def __init__(self, *args):
-        if (len(args)==1) and isinstance(args[0], str): #a8
-            x0,x1 = args[0]
-            if (x0 not in 'abcdefgh') or (x1 not in '12345678'):
-                raise QChessInvalidCommand(f'invalid pos="{args[0]}"')
-            file = 'abcdefgh'.index(x0)
-            rank = int(x1)-1
-            pos = file + rank*8
-            str_ = args[0]
+    # flyweight: the 64 squares are created once and shared, ChessPosition('a1') is ChessPosition(0)
+    # ancilla qubit (pos>=64) is not interned
+    __slots__ = ('pos', 'file', 'rank', 'str_')
+
+    def __new__(cls, *args):
+        if len(args)==1:
+            x = args[0]
+            if isinstance(x, str): #a8
+                ret = _POSITION_STR.get(x)
+                if ret is None:
+                    raise QChessInvalidCommand(f'invalid pos="{x}"')
+                return ret
+            if isinstance(x, int):
+                if x<0:
+                    raise QChessInvalidCommand(f'invalid pos="{x}"')
+                if x<64:
+                    return _POSITION_LIST[x]
+                return cls._new(x) #ancilla qubit can be larger than 64
         elif (len(args)==2) and isinstance(args[0], int) and isinstance(args[1], int): #0,0
-            file = int(args[0])
-            rank = int(args[1])
-            pos = file + rank*8
+            file,rank = args
             if (not (0<=file<8)) or (not (0<=rank<8)):
                 raise QChessInvalidCommand(f'invalid pos="{args}"')
-            str_ = 'abcdefgh'[file] + str(rank+1)
-        elif (len(args)==1) and isinstance(args[0], int):
-            if args[0]<0:
-                raise QChessInvalidCommand(f'invalid pos="{args[0]}"')
-            pos = args[0]
-            if args[0]<64:
-                file = args[0]%8
-                rank = args[0]//8
-                str_ = 'abcdefgh'[file] + str(rank+1)
-            else: #ancilla qubit can be larger than 64
-                file = None
-                rank = None
-                str_ = None
+            return _POSITION_LIST[file + rank*8]
+        raise QChessInvalidCommand(f'invalid pos="{args}"')
+
+    @classmethod
+    def _new(cls, pos:int):
+        ret = object.__new__(cls)
+        ret.pos:int = pos
+        if pos<64:
+            ret.file:int = pos%8
+            ret.rank:int = pos//8
+            ret.str_:str = 'abcdefgh'[pos%8] + str(pos//8+1)
         else:
-            raise QChessInvalidCommand(f'invalid pos="{args}"')
-        self.pos:int = pos
-        self.file:int = file
-        self.rank:int = rank
-        self.str_:str = str_
+            ret.file = None
+            ret.rank = None
+            ret.str_ = None
+        return ret
+
+    def __reduce__(self):
+        return ChessPosition, (self.pos,)
 
     def __eq__(self, other):
-        return self.pos==other.pos
+        return isinstance(other, ChessPosition) and (self.pos==other.pos)
+
+    def __hash__(self):
+        return self.pos
 
     def __str__(self):
         return self.str_
 
     __repr__ = __str__
 
+_POSITION_LIST = [ChessPosition._new(x) for x in range(64)]
+_POSITION_STR = {x.str_:x for x in _POSITION_LIST}
+
+
+SQUARE_STR = ['abcdefgh'[x%8] + str(x//8+1) for x in range(64)]
+
+
+class ChessMove(typing.NamedTuple):
+    # structured move, str(move) is the command string and ChessMove.from_str() parses it back
+    # src/src1/dst/dst1: square index, src1 for merge and castling (rook), dst1 for split and castling (rook)
+    # kind: 'move', 'blocked', 'capture', 'en-passant', 'split', 'merge', 'castling', None if unknown (parsed from string)
+    # prefix_measure: 0/1 to fix the measurement result, None to sample it
+    src: int
+    src1: int|None
+    dst: int
+    dst1: int|None = None
+    promotion: str|None = None
+    kind: str|None = None
+    prefix_measure: int|None = None
+
+    def __str__(self):
+        src,src1,dst,dst1,promotion,_,prefix_measure = self
+        if (src1 is None) and (dst1 is None) and (promotion is None) and (prefix_measure is None):
+            return SQUARE_STR[src] + ',' + SQUARE_STR[dst] #most common
+        ret = SQUARE_STR[src] + ('' if (src1 is None) else SQUARE_STR[src1]) + ',' + SQUARE_STR[dst]
+        ret += ('' if (dst1 is None) else SQUARE_STR[dst1]) + ('' if (promotion is None) else promotion)
+        if prefix_measure is not None:
+            ret += f',{prefix_measure}'
+        return ret
+
+    @staticmethod
+    def from_str(cmd:str, kind:str|None=None):
+        args = cmd.strip().split(',') #a2b2,c3  a2,b2  e1h1,g1f1  a2,a3,0  a7,a8q
+        prefix_measure = None
+        if len(args)==3:
+            if not args[2] in ('0','1'):
+                raise QChessInvalidCommand(f'invalid command="{cmd}"')
+            prefix_measure = int(args[2])
+            args = args[:2]
+        if (len(args)!=2) or ((len(args[0]),len(args[1])) not in {(2,2),(2,3),(2,4),(4,2),(4,4)}):
+            raise QChessInvalidCommand(f'invalid command="{cmd}"')
+        src = hf_convert_pos_to_int(args[0][:2])
+        dst = hf_convert_pos_to_int(args[1][:2])
+        src1 = hf_convert_pos_to_int(args[0][2:]) if (len(args[0])==4) else None
+        dst1 = hf_convert_pos_to_int(args[1][2:]) if (len(args[1])==4) else None
+        promotion = None
+        if len(args[1])==3:
+            promotion = args[1][2]
+            if promotion.isupper():
+                print('API-change-WARNING: promotion must be lower case')
+                promotion = promotion.lower()
+            if promotion not in 'qrbn':
+                raise QChessInvalidCommand(f'invalid command="{cmd}"')
+        ret = ChessMove(src, src1, dst, dst1, promotion, kind, prefix_measure)
+        return ret
+
+
+DIRECTION = [(x,y) for x in (-1,0,1) for y in (-1,0,1) if (x,y)!=(0,0)] #(file,rank) step
+
+
+def _build_move_table():
+    # bitboard (python int, bit i is square i) of the squares attacked/on the same line, precomputed once
+    hf0 = lambda x,y: [(x+dx, y+dy) for dx,dy in x_delta if (0<=x+dx<8) and (0<=y+dy<8)]
+    hf1 = lambda z: sum(1<<(x+8*y) for x,y in z)
+    x_delta = [(1,2),(2,1),(-1,2),(-2,1),(1,-2),(2,-1),(-1,-2),(-2,-1)]
+    knight = [hf1(hf0(x%8, x//8)) for x in range(64)]
+    x_delta = DIRECTION
+    king = [hf1(hf0(x%8, x//8)) for x in range(64)]
+    rook = [0]*64
+    bishop = [0]*64
+    ray = [[() for _ in DIRECTION] for _ in range(64)]
+    between = [[0]*64 for _ in range(64)]
+    between_list = [[() for _ in range(64)] for _ in range(64)]
+    for x in range(64):
+        for ind0,(dx,dy) in enumerate(DIRECTION):
+            x0,y0 = x%8+dx, x//8+dy
+            path = []
+            while (0<=x0<8) and (0<=y0<8):
+                y = x0 + 8*y0
+                if (dx==0) or (dy==0):
+                    rook[x] |= 1<<y
+                    between_list[x][y] = tuple(sorted(path)) #same order as get_two_point_path()
+                else:
+                    bishop[x] |= 1<<y
+                    between_list[x][y] = tuple(path)
+                between[x][y] = sum(1<<z for z in path)
+                path.append(y)
+                x0,y0 = x0+dx, y0+dy
+            ray[x][ind0] = tuple(path)
+    return knight, king, rook, bishop, ray, between, between_list
+
+# KNIGHT_ATTACK[x], KING_ATTACK[x]: squares reachable in one jump
+# ROOK_RAY[x], BISHOP_RAY[x]: squares on the same file/rank and diagonal (x excluded)
+# RAY[x][i]: squares from x (excluded) to the edge along DIRECTION[i]
+# BETWEEN[x][y], BETWEEN_LIST[x][y]: squares strictly between two aligned squares, 0/() if not aligned or adjacent
+KNIGHT_ATTACK, KING_ATTACK, ROOK_RAY, BISHOP_RAY, RAY, BETWEEN, BETWEEN_LIST = _build_move_table()
+
+
+def hf_bit_list(mask:int):
+    # 0b101000 -> [3,5]
+    ret = []
+    while mask:
+        tmp0 = mask & (-mask)
+        ret.append(tmp0.bit_length()-1)
+        mask ^= tmp0
+    return ret
+
 
 def hf_str_none_to_position(*args):
+    # str/int/ChessPosition/None -> ChessPosition/None
     ret = []
     for x in args:
-        if x is None:
-            ret.append(None)
-        elif isinstance(x, str):
-            ret.append(ChessPosition(x))
-        else:
-            assert isinstance(x, ChessPosition)
+        if (x is None) or isinstance(x, ChessPosition):
             ret.append(x)
+        else:
+            ret.append(ChessPosition(x))
     return ret
 
 def get_two_point_path(file0, rank0, file1, rank1):
     assert all(isinstance(x,int) for x in [file0, rank0, file1, rank1])
-    if (file0==file1) and (rank0==rank1):
-        ret = []
-    elif file0==file1:
-        ret = [(file0, x) for x in range(min(rank0,rank1)+1, max(rank0,rank1))]
-    elif rank0==rank1:
-        ret = [(x, rank0) for x in range(min(file0,file1)+1, max(file0,file1))]
-    elif abs(file0-file1)==abs(rank0-rank1):
-        tmp0 = range(file0+1,file1) if (file0<file1) else range(file0-1,file1,-1)
-        tmp1 = range(rank0+1,rank1) if (rank0<rank1) else range(rank0-1,rank1,-1)
-        ret = list(zip(tmp0,tmp1))
-    else:
+    assert all((0<=x<8) for x in [file0, rank0, file1, rank1])
+    src = file0 + 8*rank0
+    dst = file1 + 8*rank1
+    if (src!=dst) and not (((ROOK_RAY[src] | BISHOP_RAY[src])>>dst) & 1):
         raise QChessInvalidCommand(f'invalid path file0="{file0}", rank0="{rank0}", file1="{file1}", rank1="{rank1}"')
-    ret = [ChessPosition(x,y) for x,y in ret]
+    ret = [ChessPosition(x) for x in BETWEEN_LIST[src][dst]]
     return ret
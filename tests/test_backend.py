@@ -0,0 +1,423 @@
+import random
+import numpy as np
+
+import qchess
+
+_ZERO_EPS = qchess.chess_utils._ZERO_EPS
+
+
+def hf_coeff_to_str(sim):
+    n = len(sim.pos2tag)
+    ret = {sim._key_to_str(k):v for k,v in sim.coeff.items()}
+    assert all(len(x)==n for x in ret)
+    return ret
+
+
+def hf_assert_same_sim(sim0, sim1):
+    assert list(sim0.pos2tag)==list(sim1.pos2tag)
+    ret0 = hf_coeff_to_str(sim0)
+    ret1 = hf_coeff_to_str(sim1)
+    assert (len(ret0)==len(ret1)) and all(abs(ret0[x]-y)<1e-10 for x,y in ret1.items())
+
+
+def hf_random_history(num_step, seed=None):
+    rng = random.Random(seed)
+    z0 = qchess.QChessGame(rng)
+    for _ in range(num_step):
+        if z0.is_finish_or_not()!='continue':
+            break
+        z0.random_move(0.5)
+    return z0
+
+
+def test_backend_simulator():
+    for backend in ['int','numpy']:
+        hf0 = qchess.chess_utils.get_simulator_class(backend)
+        z0 = qchess.QChessSparseSimulator.from_board('d3R c4r')
+        z1 = hf0.from_board('d3R c4r')
+        for z in [z0, z1]:
+            z.split_jump('c4', 'c3', 'd4')
+            z.split_slide('d3', 'd5', 'b3', ['d4'], ['c3'])
+            z.merge_slide('d5', 'b3', 'b5', [], [])
+        hf_assert_same_sim(z0, z1)
+        assert np.abs(z0.get_correlation() - z1.get_correlation()).max() < 1e-10
+        for z in [z0, z1]:
+            z.capture_jump('b5', 'd4', measure_fix=1)
+        hf_assert_same_sim(z0, z1)
+
+
+def test_backend_replay():
+    for seed in range(2):
+        z0 = hf_random_history(40, seed=seed)
+        for backend in ['int','numpy','factor']:
+            z1 = qchess.QChessGame(backend=backend)
+            for x in z0.history:
+                z1.run_short_cmd(x, tag_print=False)
+            hf_assert_same_sim(z0.sim, z1.sim)
+            assert sorted(z0.get_all_available_move())==sorted(z1.get_all_available_move())
+
+
+def test_numpy_backend_heavy_case():
+    hf0 = lambda x: qchess.ChessPosition(x).pos
+    pos_list = ' '.join([f'{x}{y}R' for x in 'abcd' for y in range(1,8+1)])
+    z0 = qchess.QChessSparseSimulator.from_board(pos_list)
+    z1 = qchess.QChessSparseSimulatorNumpy.from_board(pos_list)
+    for x in range(10):
+        src = 'abcd'[x//8] + str(x%8+1)
+        dst = 'efgh'[x//8] + str(x%8+1)
+        for z in [z0, z1]:
+            z.apply_sqrtiswap(hf0(src), hf0(dst))
+    for x in range(3):
+        src = 'efgh'[x//8] + str(x%8+1)
+        dst = 'abcd'[x//8] + str(x%8+1)
+        for z in [z0, z1]:
+            z.apply_sqrtiswap(hf0(src), hf0(dst))
+    assert len(z1.amplitude)==2**7
+    hf_assert_same_sim(z0, z1)
+    assert np.abs(np.array(z0.get_marginal_probability()[1]) - np.array(z1.get_marginal_probability()[1])).max() < 1e-10
+
+
+def test_incremental_probability():
+    z0 = hf_random_history(40, seed=2)
+    for backend in ['str','int','numpy','factor']:
+        z1 = qchess.QChessGame(backend=backend)
+        z1.sim.check_probability = True
+        for x in z0.history:
+            z1.run_short_cmd(x, tag_print=False)
+        tmp0 = [(z1.sim._compute_probability_i(x) if (z1.sim.pos2tag[x] is not None) else 0) for x in range(64)]
+        assert np.abs(np.array(z1.sim.get_marginal_probability()[1]) - np.array(tmp0)).max() < 1e-10
+
+
+def test_square_index():
+    z0 = hf_random_history(40, seed=3)
+    for backend in ['str','int']:
+        z1 = qchess.QChessGame(backend=backend)
+        z1.sim.enable_square_index()
+        for x in z0.history:
+            z1.run_short_cmd(x, tag_print=False)
+        hf_assert_same_sim(z0.sim, z1.sim)
+        hf0 = lambda x: [{x.id2key[z] for z in y} for y in x.square]
+        tmp0 = hf0(z1.sim._square_index)
+        z1.sim.enable_square_index()
+        assert tmp0==hf0(z1.sim._square_index)
+
+
+def test_factor_backend_component():
+    z0 = qchess.QChessSparseSimulator.from_board('a1R h1R a8r h8r')
+    z1 = qchess.QChessSparseSimulatorFactor.from_board('a1R h1R a8r h8r')
+    for z in [z0, z1]:
+        z.split_jump('a1', 'a2', 'b1')
+        z.split_jump('h8', 'h7', 'g8')
+    hf_assert_same_sim(z0, z1)
+    assert len(z0.coeff)==4
+    assert sorted(len(x) for x in z1.component.values() if len(x)>1)==[2,2]
+    assert np.abs(z0.get_correlation() - z1.get_correlation()).max() < 1e-10
+    for z in [z0, z1]:
+        z.capture_jump('h1', 'h7', measure_fix=1)
+        z.merge_jump('a2', 'b1', 'a1')
+    hf_assert_same_sim(z0, z1)
+    assert sorted(len(x) for x in z1.component.values() if len(x)>1)==[2] #captured h7r entangled with g8r
+
+
+def test_game_copy_on_write():
+    z0 = hf_random_history(20, seed=4)
+    for backend in ['str','int','numpy','factor']:
+        z1 = qchess.QChessGame(backend=backend)
+        for x in z0.history:
+            z1.run_short_cmd(x, tag_print=False)
+        z1.sim.enable_square_index()
+        z2 = z1.copy()
+        coeff = hf_coeff_to_str(z1.sim)
+        history = list(z1.history)
+        move_list = z2.get_all_available_move()
+        for x in move_list[:10]:
+            z2.run_short_cmd(x, tag_print=False)
+            assert hf_coeff_to_str(z1.sim)==coeff
+            z2.restore(z1)
+        assert z1.history==history
+        z3 = z1.snapshot()
+        z1.run_short_cmd(move_list[0], tag_print=False)
+        z1.restore(z3)
+        hf_assert_same_sim(z0.sim, z1.sim)
+        assert z1.history==history
+
+
+def test_push_pop_move():
+    z0 = hf_random_history(20, seed=5)
+    for backend in ['str','int','numpy','factor']:
+        z1 = qchess.QChessGame(backend=backend)
+        for x in z0.history:
+            z1.run_short_cmd(x, tag_print=False)
+        z1.sim.enable_square_index()
+        history = list(z1.history)
+        move_list = z1.get_all_available_move()
+        for x in move_list[:3]:
+            z1.push_move(x)
+            for y in z1.get_all_available_move()[:5]:
+                z1.push_move(y)
+                z1.pop_move()
+            z1.pop_move()
+            hf_assert_same_sim(z0.sim, z1.sim)
+            assert z1.history==history
+            assert sorted(z1.get_all_available_move())==sorted(move_list)
+        if backend in ['str','int']:
+            hf0 = lambda x: [{x.id2key[z] for z in y} for y in x.square]
+            tmp0 = hf0(z1.sim._square_index)
+            z1.sim.enable_square_index()
+            assert tmp0==hf0(z1.sim._square_index)
+
+
+def test_zobrist_hash():
+    z0 = hf_random_history(30, seed=6)
+    hash_list = []
+    for backend in ['str','int','numpy','factor']:
+        z1 = qchess.QChessGame(backend=backend)
+        z1.get_hash()
+        for x in z0.history:
+            z1.run_short_cmd(x, tag_print=False)
+            assert z1.sim.get_hash_amplitude()==z1.sim._compute_hash_amplitude()
+        hash_list.append(z1.get_hash())
+        tmp0 = z1.get_hash()
+        for x in z1.get_all_available_move()[:5]:
+            z1.push_move(x)
+            assert z1.get_hash()!=tmp0
+            z1.pop_move()
+            assert z1.get_hash()==tmp0
+    assert len(set(hash_list))==1
+
+    # same pieces, different relative phase
+    hf0 = lambda x: qchess.ChessPosition(x).pos
+    z0 = qchess.QChessSparseSimulator.from_board('a1R h8r')
+    z0.split_jump('a1', 'a2', 'b1')
+    z1 = z0.copy()
+    z1.apply_iswap(hf0('a2'), hf0('c3'))
+    z1.apply_iswap(hf0('c3'), hf0('a2'))
+    assert z0.pos2tag==z1.pos2tag
+    assert z0.get_hash()!=z1.get_hash()
+
+
+def test_factor_hash():
+    class _SimNoJoint(qchess.QChessSparseSimulatorFactor):
+        coeff = property(lambda self: self.component[self._active], qchess.QChessSparseSimulatorFactor.coeff.fset)
+    hf0 = lambda x: qchess.ChessPosition(x).pos
+    # 10 independent splits: x -> (one rank up, one file right)
+    square = [f'{x}{y}' for y in '147' for x in 'aceg'][:10]
+    split_list = [(x, x[0]+str(int(x[1])+1), chr(ord(x[0])+1)+x[1]) for x in square]
+    z0 = _SimNoJoint.from_board(' '.join(f'{x}N' for x in square))
+    z1 = _SimNoJoint.from_board(' '.join(f'{x}N' for x in square))
+    for x in split_list:
+        z0.split_jump(*x)
+    for x in split_list[::-1]:
+        z1.split_jump(*x)
+    assert sorted(len(x) for x in z0.component.values() if len(x)>1)==[2]*10
+    tmp0 = z0.get_hash()
+    assert (z0._hash_amplitude is not None) and (z0.get_hash()==tmp0) and (z1.get_hash()==tmp0)
+    z2 = z0.copy()
+    z2.apply_iswap(hf0('a2'), hf0('a3'))
+    assert z2.get_hash()!=tmp0
+    assert z0.get_hash()==tmp0
+    z2.measure(hf0('a3'), fix=1)
+    assert z2._hash_amplitude is None
+    assert z2.get_hash()!=tmp0
+    # same product state with two components merged
+    z3 = z0.copy()
+    z3._merge_component([hf0('a2'), hf0('c2')])
+    assert len(z3.component)<len(z0.component)
+    assert z3.get_hash()==tmp0
+
+    hash_list = []
+    for backend in ['str','int','numpy','factor']:
+        z4 = qchess.QChessGame(seed=0, backend=backend)
+        for x in ['b1,a3c3', 'g8,f6h6', 'c3,d5', 'b8,a6c6', 'd5,c7']:
+            z4.run_short_cmd(x, tag_print=False)
+        hash_list.append(z4.get_hash())
+    assert len(set(hash_list))==1
+
+
+def test_classical_fast_path():
+    z0 = qchess.QChessGame(seed=7)
+    for _ in range(60):
+        if z0.is_finish_or_not()!='continue':
+            break
+        z0.random_move(0)
+    assert z0.sim.is_classical()
+    for backend in ['str','int','numpy','factor']:
+        z1 = qchess.QChessGame(backend=backend)
+        z2 = qchess.QChessGame(backend=backend)
+        z1.sim.check_probability = True
+        z2.sim.is_classical = lambda: False #generic path
+        z1.sim.enable_square_index()
+        for x in z0.history:
+            z1.push_move(x)
+            z2.run_short_cmd(x, tag_print=False)
+            hf_assert_same_sim(z1.sim, z2.sim)
+            assert z1.get_hash()==z2.get_hash()
+            assert z1.history==z2.history
+        for _ in z0.history:
+            z1.pop_move()
+        hf_assert_same_sim(z1.sim, qchess.QChessGame(backend=backend).sim)
+
+
+def test_fused_split_merge_slide():
+    rng = random.Random(0)
+    for backend in ['str','int','numpy','factor']:
+        hf0 = qchess.chess_utils.get_simulator_class(backend)
+        z0 = hf0.from_board('d3R c4r e5R a1r')
+        z1 = hf0.from_board('d3R c4r e5R a1r')
+        z0.check_probability = True
+        for z in [z0, z1]:
+            z.split_jump('c4', 'c3', 'd4')
+            z.split_jump('d3', 'd2', 'b3')
+            z.split_jump('e5', 'e4', 'f5')
+        num_run = 0
+        for _ in range(16):
+            src = rng.choice([x for x in range(64) if z0.pos2tag[x] is not None])
+            tmp0 = [x for x in range(64) if (x!=src) and (z0.pos2tag[x] in (None,z0.pos2tag[src]))]
+            x1,x2 = rng.sample(tmp0, 2)
+            # split_slide(src, dst1, dst2) or merge_slide(src1, src2, dst)
+            name = 'merge_slide' if ((z0.pos2tag[x1] is not None) and (rng.random()<0.5)) else 'split_slide'
+            tmp1 = [x for x in range(64) if x not in (src,x1,x2)]
+            path1 = rng.sample(tmp1, rng.randint(0,2))
+            path2 = rng.sample(tmp1, rng.randint(0,2))
+            try:
+                getattr(z0, name)(src, x1, x2, path1, path2)
+            except qchess.utils.QChessInvalidCommand:
+                continue
+            getattr(z1, f'_{name}_gate')(src, x1, x2, path1, path2)
+            hf_assert_same_sim(z0, z1)
+            assert max(abs(x-y) for x,y in zip(z0._probability, z1._probability)) < 1e-10
+            assert z0.get_hash_amplitude()==z1.get_hash_amplitude()
+            num_run += 1
+        assert num_run>=5
+
+
+def test_fused_slide_journal():
+    # pop_journal() after a fused slide whose sqrtiswap output cancels, with the square index
+    for backend in ['str','int']:
+        for seed in range(16):
+            rng = random.Random(seed)
+            z0 = qchess.chess_utils.get_simulator_class(backend).from_board('d3R c4r e5R a1r')
+            z0.enable_square_index()
+            z0.split_jump('c4', 'c3', 'd4')
+            z0.split_jump('d3', 'd2', 'b3')
+            z0.split_jump('e5', 'e4', 'f5')
+            for _ in range(16):
+                src = rng.choice([x for x in range(64) if z0.pos2tag[x] is not None])
+                tmp0 = [x for x in range(64) if (x!=src) and (z0.pos2tag[x] in (None,z0.pos2tag[src]))]
+                x1,x2 = rng.sample(tmp0, 2)
+                name = 'merge_slide' if ((z0.pos2tag[x1] is not None) and (rng.random()<0.5)) else 'split_slide'
+                tmp1 = [x for x in range(64) if x not in (src,x1,x2)]
+                path1 = rng.sample(tmp1, rng.randint(0,2))
+                path2 = rng.sample(tmp1, rng.randint(0,2))
+                z1 = z0.copy()
+                z0.push_journal()
+                try:
+                    getattr(z0, name)(src, x1, x2, path1, path2)
+                except qchess.utils.QChessInvalidCommand:
+                    z0.pop_journal()
+                    continue
+                z0.pop_journal()
+                hf_assert_same_sim(z0, z1)
+                assert [len(x) for x in z0._square_index.square]==[len(x) for x in z1._square_index.square]
+                getattr(z0, name)(src, x1, x2, path1, path2)
+
+
+def test_ancilla_pool():
+    # the ancilla of a capture is released by the measurement which leaves it in a definite state, the keys are back to 64 qubits
+    # a capture onto a square occupied in every key needs no ancilla
+    for index in [0,1]:
+        sim_list = []
+        for backend in ['str','int','numpy','factor']:
+            z0 = qchess.chess_utils.get_simulator_class(backend).from_board('a1R h1R d3R c4r h5r a8r')
+            z0.check_probability = True
+            z0.enable_square_index()
+            z0.split_jump('c4', 'c3', 'd4')
+            z0.capture_jump('d3', 'd4')
+            assert (len(z0.pos2tag)==65) and (z0.pos2tag[64] is not None)
+            z0.capture_jump('c3', 'd4', measure_fix=index)
+            assert len(z0.pos2tag)==64
+            z0.split_jump('a8', 'a7', 'a5')
+            z0.capture_slide('h1', 'h5', ['h2','h3','h4'], measure_fix=1)
+            assert (len(z0.pos2tag)==64) and (z0.pos2tag[qchess.utils.hf_convert_pos_to_int('h5')]=='R')
+            z0.capture_slide('a1', 'a5', ['a2','a3','a4'], measure_fix=1)
+            assert (len(z0.pos2tag)==65) and (z0.pos2tag[64] is not None)
+            z0.measure('a7', fix=1-index)
+            assert len(z0.pos2tag)==64
+            sim_list.append(z0)
+        for z in sim_list[1:]:
+            hf_assert_same_sim(sim_list[0], z)
+
+
+def test_peek_move():
+    z0 = hf_random_history(30, seed=7)
+    for backend in ['str','int','numpy','factor']:
+        z1 = qchess.QChessGame(backend=backend)
+        for x in z0.history:
+            z1.run_short_cmd(x, tag_print=False)
+        z1.sim.enable_square_index()
+        history = list(z1.history)
+        tmp0 = z1.get_hash()
+        num_measure = 0
+        for x in z1.get_all_available_move():
+            outcome = z1.peek_move(x)
+            assert (z1.get_hash()==tmp0) and (z1.history==history)
+            hf_assert_same_sim(z0.sim, z1.sim)
+            z1.push_move(x)
+            if z1.sim.last_measure is None:
+                assert outcome=={None:1}
+            else:
+                num_measure += 1
+                prob1 = z1.sim.last_measure1_prob
+                assert abs(sum(outcome.values())-1)<1e-10
+                assert abs(outcome.get(1,0)-prob1)<1e-10
+                assert z1.sim.last_measure in outcome
+            z1.pop_move()
+        assert num_measure>0
+
+
+def test_push_move_rollback():
+    def hf_raise(*args, **kwargs):
+        raise ValueError('simulated failure')
+    z0 = hf_random_history(10, seed=7)
+    for backend in ['str','int','numpy','factor']:
+        z1 = qchess.QChessGame(backend=backend)
+        for x in z0.history:
+            z1.run_short_cmd(x, tag_print=False)
+        z1.sim.enable_square_index()
+        history = list(z1.history)
+        tmp0 = z1.get_hash()
+        num_raise = 0
+        for x in z1.get_all_available_move():
+            z1.sim.apply_iswap = hf_raise
+            for hf_move in [z1.push_move, z1.peek_move]:
+                try:
+                    hf_move(x)
+                    if hf_move==z1.push_move: #the move does not use apply_iswap
+                        z1.pop_move()
+                except ValueError:
+                    num_raise += 1
+                assert (z1.sim._journal is None) and (len(z1._move_stack)==0)
+                assert (z1.get_hash()==tmp0) and (z1.history==history)
+                hf_assert_same_sim(z0.sim, z1.sim)
+            del z1.sim.apply_iswap
+        assert num_raise>0
+
+
+def test_measure_shared_coeff():
+    hf0 = lambda x: qchess.ChessPosition(x).pos
+    for backend in ['str','int']:
+        z0 = qchess.chess_utils.get_simulator_class(backend).from_board('a1R h8r')
+        z0.enable_square_index()
+        z0.split_jump('a1', 'a2', 'b1')
+        z1 = z0.copy()
+        coeff = z0.coeff
+        z1.push_journal()
+        z1.measure(hf0('a2'), fix=1)
+        assert (z1.coeff is not coeff) and (len(coeff)==2) and (len(z1.coeff)==1)
+        assert len(z0._square_index.square[hf0('b1')])==1
+        z1.pop_journal()
+        assert z1.coeff is coeff
+        hf_assert_same_sim(z0, z1)
+        z1.measure(hf0('a2'), fix=0)
+        assert len(z0.coeff)==2
+        assert z1.pos2tag[hf0('b1')]=='R' and z1.pos2tag[hf0('a2')] is None
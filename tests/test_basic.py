@@ -320,3 +320,86 @@ def test_last_measure1_prob():
         z0.run_short_cmd(x, tag_print=False)
     z0.run_short_cmd('d1,e2')
     assert abs(z0.sim.last_measure1_prob-0.5) < _ZERO_EPS
+
+
+def test_truncation():
+    z0 = qchess.QChessSparseSimulator.from_board('d3R c4r')
+    z0.split_jump('c4', 'c3', 'd4')
+    z0.split_slide('d3', 'd5', 'b3', ['d4'], ['c3'])
+    prob = sorted([abs(x)**2 for x in z0.coeff.values()], reverse=True)
+    z0.set_truncation(max_branch=2)
+    loss = z0.truncate()
+    assert len(z0.coeff)==2
+    assert abs(loss - sum(prob[2:])) < 1e-10
+    assert abs(sum(abs(x)**2 for x in z0.coeff.values()) - 1) < 1e-10
+
+    for backend in ['str','int','numpy']:
+        game = qchess.QChessGame(seed=23, backend=backend)
+        game.set_truncation(threshold=0.05, max_branch=4)
+        for _ in range(30):
+            if game.is_finish_or_not()!='continue':
+                break
+            game.random_move(0.5)
+            assert len(game.sim.coeff)<=4
+        assert len(game.truncation_loss)==len(game.history)
+        assert all(0<=x<1 for x in game.truncation_loss)
+
+def test_undo_buffer():
+    game = qchess.QChessGame(seed=29)
+    game.set_undo_buffer(depth=5)
+    state_list = []
+    for _ in range(8):
+        if game.is_finish_or_not()!='continue':
+            break
+        state_list.append(({k:v for k,v in game.sim.coeff.items()}, list(game.sim.pos2tag), list(game.history)))
+        game.random_move(0.5)
+    assert len(game.undo_buffer)==5
+    for step in [1,2]:
+        coeff,pos2tag,history = state_list[-step]
+        game.revert_cmd(1)
+        assert game.history==history
+        assert game.sim.pos2tag==pos2tag
+        assert (len(coeff)==len(game.sim.coeff)) and all(abs(coeff[x]-y)<_ZERO_EPS for x,y in game.sim.coeff.items())
+    assert not game.undo(4)
+    game.revert_cmd(4) #replay from the start
+    assert game.history==state_list[-6][2]
+    z0 = game.copy()
+    z0.random_move(0.5)
+    assert len(z0.undo_buffer)==0
+
+    game.set_undo_buffer(depth=5, max_amplitude=1)
+    game.random_move(0.5)
+    assert len(game.undo_buffer)<=1
+
+def test_undo_buffer_edit_cmd():
+    # the GUI replays its history (board edits and moves) into a new game, one undo snapshot per entry
+    history = ['add,N,d4', 'e2,e4', 'add,n,d5', 'e7,e5']
+    game = qchess.QChessGame(seed=0)
+    game.set_undo_buffer()
+    state_list = []
+    for cmd in history:
+        if not game.run_edit_cmd(cmd):
+            game.run_short_cmd(cmd, tag_print=False)
+        state_list.append((dict(game.sim.coeff), list(game.sim.pos2tag)))
+    assert len(game.undo_buffer)==len(history)
+    assert game.undo(2)
+    assert (dict(game.sim.coeff), list(game.sim.pos2tag))==state_list[1]
+    assert game.undo(2)
+    assert game.sim.pos2tag==qchess.QChessGame().sim.pos2tag
+    assert not game.run_edit_cmd('e2,e4')
+
+def test_chess_position_interned():
+    import pickle
+    z0 = qchess.ChessPosition('c2')
+    assert (z0 is qchess.ChessPosition(10)) and (z0 is qchess.ChessPosition(2,1))
+    assert (z0.file,z0.rank,z0.pos,z0.str_)==(2,1,10,'c2')
+    assert len({z0, qchess.ChessPosition('c2'), qchess.ChessPosition('c3')})==2
+    assert pickle.loads(pickle.dumps(z0)) is z0
+    z1 = qchess.ChessPosition(70) #ancilla
+    assert (z1.pos==70) and (z1.str_ is None) and (z1==qchess.ChessPosition(70))
+    for x in ['i1', 'a9', 'a10', -1, (8,0)]:
+        try:
+            qchess.ChessPosition(*(x if isinstance(x,tuple) else (x,)))
+            assert False
+        except qchess.utils.QChessInvalidCommand:
+            pass
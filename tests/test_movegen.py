@@ -0,0 +1,151 @@
+import random
+
+import qchess
+
+
+def test_bitboard_move_generator():
+    for seed in range(3):
+        rng = random.Random(seed)
+        z0 = qchess.QChessGame(rng)
+        for _ in range(30):
+            if z0.is_finish_or_not()!='continue':
+                break
+            ret_ = [y for x in range(64) for y in z0._get_all_available_move_i(qchess.ChessPosition(x))]
+            assert qchess.movegen.get_all_available_move_bitboard(z0)==ret_
+            z0.run_short_cmd(rng.choice(ret_), tag_print=False)
+
+
+def test_bitboard_move_table():
+    hf0 = lambda x: qchess.ChessPosition(x).pos
+    assert qchess.utils.KNIGHT_ATTACK[hf0('a1')]==(1<<hf0('b3')) | (1<<hf0('c2'))
+    assert qchess.utils.BETWEEN[hf0('a1')][hf0('d4')]==(1<<hf0('b2')) | (1<<hf0('c3'))
+    assert qchess.utils.BETWEEN[hf0('a1')][hf0('b3')]==0
+    assert bin(qchess.utils.ROOK_RAY[hf0('e4')]).count('1')==14
+
+
+def test_two_point_path_table():
+    for src in range(64):
+        for dst in range(64):
+            file0,rank0,file1,rank1 = src%8, src//8, dst%8, dst//8
+            df,dr = file1-file0, rank1-rank0
+            if (src!=dst) and (df!=0) and (dr!=0) and (abs(df)!=abs(dr)):
+                continue
+            num_step = max(abs(df), abs(dr))
+            tmp0 = [(file0+x*((df>0)-(df<0)), rank0+x*((dr>0)-(dr<0))) for x in range(1, num_step)]
+            ret_ = sorted(x+8*y for x,y in tmp0)
+            ret0 = qchess.utils.get_two_point_path(file0, rank0, file1, rank1)
+            assert sorted(x.pos for x in ret0)==ret_
+            assert qchess.utils.BETWEEN[src][dst]==sum(1<<x for x in ret_)
+
+
+def test_chess_move_record():
+    for x in ['a2,b2', 'a2b2,c3', 'c3,a2b2', 'e1h1,g1f1', 'a7,a8q', 'a2,a3,0']:
+        assert str(qchess.utils.ChessMove.from_str(x))==x
+    rng = random.Random(7)
+    z0 = qchess.QChessGame(rng)
+    z1 = qchess.QChessGame()
+    for _ in range(20):
+        if z0.is_finish_or_not()!='continue':
+            break
+        move_list = z0.get_all_available_move(as_move=True)
+        assert [str(x) for x in move_list]==z0.get_all_available_move()
+        move = rng.choice(move_list)
+        assert qchess.gym.command_to_vector(move)==qchess.gym.command_to_vector(str(move))
+        z0.run_short_cmd(move, tag_print=False)
+        z1.run_short_cmd(z0.history[-1], tag_print=False)
+    assert z0.history==z1.history
+
+
+def test_move_cache():
+    for seed in range(3):
+        rng = random.Random(seed)
+        z0 = qchess.QChessGame(rng)
+        for _ in range(30):
+            if z0.is_finish_or_not()!='continue':
+                break
+            move_list = z0.get_all_available_move()
+            assert move_list==qchess.movegen.get_all_available_move_bitboard(z0)
+            z1 = z0.copy() #share the cache
+            for x in move_list[:3]:
+                z1.push_move(x)
+                assert z1.get_all_available_move()==qchess.movegen.get_all_available_move_bitboard(z1)
+                z1.pop_move()
+            z0.run_short_cmd(rng.choice(move_list), tag_print=False)
+        assert z0._move_cache.num_hit>0
+
+
+def test_validate_move_batch():
+    hf0 = lambda x: None if (x is None) else qchess.utils.SQUARE_STR[x]
+    rng = random.Random(9)
+    z0 = qchess.QChessGame(rng)
+    for _ in range(30):
+        if z0.is_finish_or_not()!='continue':
+            break
+        move_list = z0.get_all_available_move(as_move=True)
+        move_list += [qchess.utils.ChessMove(rng.randrange(64), None, rng.randrange(64)) for _ in range(20)]
+        move_list = [x for x in move_list if x.src!=x.dst]
+        ret_ = []
+        for x in move_list:
+            tag = z0.sim.pos2tag[x.src]
+            src,src1,dst,dst1 = hf0(x.src), hf0(x.src1), hf0(x.dst), hf0(x.dst1)
+            if tag is None:
+                ret_.append('')
+            elif (src1 is not None) and (dst1 is not None):
+                ret_.append(z0.is_valid_castling(src, src1, dst, dst1))
+            elif tag in 'Pp':
+                ret_.append(z0.is_valid_move_pawn(src, dst, x.promotion))
+            else:
+                tmp0 = {'r':'rook', 'b':'bishop', 'q':'queen', 'k':'king', 'n':'knight'}[tag.lower()]
+                ret_.append(getattr(z0, f'is_valid_move_{tmp0}')(src, src1, dst, dst1))
+        assert z0.is_valid_move_batch(move_list)==ret_
+        assert z0.is_valid_move_batch([str(x) for x in move_list])==ret_
+        z0.random_move(0.5)
+
+
+def test_split_merge_move_generator():
+    # superposed queens, most of the moves are split and merge
+    z0 = qchess.QChessGame()
+    z0._reset(0, '')
+    for x,y in [('e1','K'), ('e8','k'), ('d4','Q'), ('a1','R'), ('h8','r')]:
+        z0.add_piece(x, y)
+    for x in ['d4,d5e4', 'e8,f8', 'e4,c4b7', 'f8,e8', 'a1,a3b1', 'e8,f8']:
+        z0.run_short_cmd(x, tag_print=False)
+    ret_ = [y for x in range(64) for y in z0._get_all_available_move_i(qchess.ChessPosition(x))]
+    ret0 = qchess.movegen.get_all_available_move_bitboard(z0, as_move=True)
+    assert [str(x) for x in ret0]==ret_
+    assert sum(x.kind=='merge' for x in ret0) > 0
+
+
+def test_iter_available_move():
+    rng = random.Random(10)
+    z0 = qchess.QChessGame(rng)
+    for _ in range(30):
+        if z0.is_finish_or_not()!='continue':
+            break
+        move_list = z0.get_all_available_move(as_move=True)
+        ret0 = list(z0.iter_available_move(as_move=True))
+        assert sorted(str(x) for x in ret0)==sorted(str(x) for x in move_list)
+        rank = {x:i for i,x in enumerate(qchess.movegen.MOVE_ORDER)}
+        tmp0 = [rank[qchess.movegen._get_move_phase(x, rank) or x.kind] for x in ret0]
+        assert tmp0==sorted(tmp0)
+        ret1 = list(z0.iter_available_move(order=('split',)))
+        assert ret1==[str(x) for x in move_list if x.kind=='split']
+        z0.random_move(0.5)
+
+
+def test_sample_available_move():
+    rng = random.Random(11)
+    z0 = qchess.QChessGame(rng)
+    for _ in range(30):
+        if z0.is_finish_or_not()!='continue':
+            break
+        move_list = z0.get_all_available_move()
+        for weight in [1, 0.2, 0]:
+            tmp0 = [(weight if (len(x.split(',',1)[1])==4) else 1) for x in move_list]
+            for _ in range(5):
+                u = rng.random()
+                tmp1 = random.Random()
+                tmp1.random = lambda: u
+                ret_ = tmp1.choices(move_list, tmp0)[0]
+                assert qchess.movegen.sample_available_move_bitboard(z0, u, weight)==ret_
+        z0.random_move(0.5)
@@ -0,0 +1,27 @@
+import qchess
+
+
+def test_perft_generator():
+    z0 = qchess.QChessGame()
+    for x in ['b1,a3c3', 'b8,a6c6', 'e2,e4', 'd7,d5']:
+        z0.run_short_cmd(x, tag_print=False)
+    history = list(z0.history)
+    ret0 = qchess.perft.perft(z0, 2, generator='reference')
+    for generator in ['cache', 'bitboard', 'iter']:
+        assert qchess.perft.diff_perft(ret0, qchess.perft.perft(z0, 2, generator=generator))==[]
+    assert z0.history==history
+    # the measurements sampled inside perft do not advance the rng
+    tmp0 = z0.rng.getstate()
+    qchess.perft.perft(z0, 2, measure_branch=True)
+    assert z0.rng.getstate()==tmp0
+    # e4,d5 is a capture with measurement, both outcomes are followed
+    ret1 = qchess.perft.perft(z0, 2, measure_branch=True)
+    assert ret1['e4,d5'] > ret0['e4,d5']
+    assert all(ret1[x]>=y for x,y in ret0.items())
+
+
+def test_perft_start():
+    z0 = qchess.QChessGame()
+    ret = qchess.perft.perft(z0, 1)
+    assert len(ret)==len(z0.get_all_available_move()) and all(x==1 for x in ret.values())
+    assert qchess.perft._run_perft(['--depth', '2', '--diff', 'bitboard'])==0
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+import qchess
+from qchess.sparse_batch import QChessSparseSimulatorBatch, QChessGameBatch, hf_position_mask
+
+
+def hf_assert_same_sim(sim0, sim1):
+    assert list(sim0.pos2tag)==list(sim1.pos2tag)
+    coeff0 = sim0.coeff
+    coeff1 = sim1.coeff
+    assert (len(coeff0)==len(coeff1)) and all(abs(coeff0[x]-y)<1e-10 for x,y in coeff1.items())
+
+
+def test_batch_simulator_gate():
+    hf0 = lambda x: qchess.ChessPosition(x).pos
+    board = 'a1R h1R a8r h8r'
+    sim_list = [qchess.QChessSparseSimulatorNumpy.from_board(board) for _ in range(3)]
+    z0 = QChessSparseSimulatorBatch.from_sim_list([x.copy() for x in sim_list])
+    # game 0: split jump, game 1: split slide, game 2: not active
+    sim_list[0].split_jump('a1', 'a2', 'b1')
+    sim_list[1].split_slide('a1', 'a4', 'd1', [], [])
+    tmp0 = np.array([hf0('a2'), hf0('a4'), 0])
+    tmp1 = np.array([hf0('b1'), hf0('d1'), 0])
+    z0.split_slide(np.full(3, hf0('a1')), tmp0, tmp1, np.zeros(3, dtype=np.uint64), np.zeros(3, dtype=np.uint64), active=[True,True,False])
+    # capture with measurement, game 2 captures with a path
+    sim_list[0].capture_jump('h1', 'h8', measure_fix=1)
+    sim_list[2].capture_slide('h8', 'h1', [hf0(f'h{x}') for x in range(2,8)], measure_fix=1)
+    tmp2 = np.array([0, 0, hf_position_mask([hf0(f'h{x}') for x in range(2,8)])], dtype=np.uint64)
+    z0.capture_slide(np.array([hf0('h1'), 0, hf0('h8')]), np.array([hf0('h8'), 0, hf0('h1')]), tmp2, [1,-1,1], active=[True,False,True])
+    for i,x in enumerate(sim_list):
+        hf_assert_same_sim(x, z0.get_sim(i))
+        assert np.abs(np.array(x.get_marginal_probability()[1]) - z0.get_marginal_probability()[i,:64]).max() < 1e-10
+
+
+def hf_assert_same_game(game0, game1):
+    hf_assert_same_sim(game0.sim, game1.sim)
+    assert game0.current_step==game1.current_step
+    assert game0.pawn_last_twostep==game1.pawn_last_twostep
+    assert (game0.tag_wcastling==game1.tag_wcastling) and (game0.tag_bcastling==game1.tag_bcastling)
+    assert sorted(game0.get_all_available_move())==sorted(game1.get_all_available_move())
+
+
+def test_batch_self_play():
+    z0 = QChessGameBatch(8, seed=0)
+    for _ in range(40):
+        z0.random_move(0.5)
+    for i in range(8):
+        z1 = qchess.QChessGame(backend='numpy')
+        for x in z0.get_history(i):
+            z1.run_short_cmd(x, tag_print=False)
+        hf_assert_same_game(z1, z0.to_game(i))
+        assert z1.is_finish_or_not()==z0.is_finish_or_not()[i]
+
+
+def test_batch_self_play_long():
+    # low split weight for classical games, to reach castling, en passant and promotion
+    z0 = QChessGameBatch(32, seed=1)
+    for _ in range(120):
+        z0.random_move(0.05)
+    history = [z0.get_history(i) for i in range(32)]
+    tmp0 = '\n'.join(','.join(x) for x in history)
+    assert ('e1h1' in tmp0) or ('e1a1' in tmp0) or ('e8h8' in tmp0) or ('e8a8' in tmp0)
+    assert any(len(y.split(',')[1])==3 for x in history for y in x) #promotion
+    for i in range(32):
+        z1 = qchess.QChessGame(backend='numpy')
+        for x in history[i]:
+            z1.run_short_cmd(x, tag_print=False)
+        hf_assert_same_game(z1, z0.to_game(i))
+
+
+def test_batch_step():
+    z0 = QChessGameBatch(3, seed=0)
+    z0.step(['e2,e4', 'g1,f3h3', None])
+    z0.step(['d7,d5', 'e7,e5', None])
+    z0.step([qchess.utils.ChessMove.from_str('e4,d5'), 'f3h3,g5', None])
+    z1 = [qchess.QChessGame(backend='numpy') for _ in range(2)]
+    for x in z0.get_history(0):
+        z1[0].run_short_cmd(x, tag_print=False)
+    for x in z0.get_history(1):
+        z1[1].run_short_cmd(x, tag_print=False)
+    hf_assert_same_game(z1[0], z0.to_game(0))
+    hf_assert_same_game(z1[1], z0.to_game(1))
+    hf_assert_same_game(qchess.QChessGame(backend='numpy'), z0.to_game(2))
+    step = z0.current_step.copy()
+    with pytest.raises(qchess.utils.QChessInvalidCommand):
+        z0.step(['a2,a3', 'a2,a5', None]) #game 0 is black to move
+    assert np.all(z0.current_step==step)